@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tables fetched from an asyncio event loop.
+
+The fetch of a table (pd.read_sql_query) and its per table checks block
+until the database answers. With --fetch_executor asyncio the event loop
+hands every table to a worker thread, keeps at most --jobs tables in flight,
+each with its own pooled connection, and gives up on a table whose fetch
+takes longer than --query_timeout seconds: the table comes back as a
+TimeoutError and the other tables are still fetched. The checks of a fetched
+table are not limited. The results come back in table order, whatever order
+the tables finish in.
+
+A thread cannot be stopped from the event loop, so the timeout is also set
+on the connection (see the set_query_timeout of the backends) and the
+database aborts the query itself, and the query of a table that timed out is
+interrupted (see the interrupt of the backends, DuckDB has no statement
+timeout). The fetch does not wait for the thread of a table that timed out.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def gather_in_order(func, items, concurrency, timeout, executor, then=None, on_timeout=None):
+    '''
+    Runs func(item) for every item in the threads of executor, at most
+    concurrency at a time. An item whose func runs longer than timeout, or
+    raises TimeoutError, gives a TimeoutError instead of stopping the other
+    items.
+
+    Parameters
+    ----------
+    func : function
+        blocking function of one item.
+    items : list
+        items, e.g. table names.
+    concurrency : int
+        number of items in flight.
+    timeout : float or None
+        seconds allowed for one item, no limit if None.
+    executor : ThreadPoolExecutor
+        threads running func.
+    then : function, optional
+        blocking function of an item and its result, run in the threads of
+        executor after func without timeout (e.g. the per table checks).
+    on_timeout : function, optional
+        function of an item whose func did not finish in time, run from the
+        event loop (e.g. to interrupt the query of a table).
+
+    Returns
+    -------
+    results : list
+        func(item) in the order of items, a TimeoutError for the items that
+        did not finish in time.
+
+    '''
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(item):
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(loop.run_in_executor(executor, func, item), timeout)
+            except asyncio.TimeoutError:
+                if on_timeout is not None:
+                    on_timeout(item)
+                return TimeoutError("{} did not finish in {} seconds".format(item, timeout))
+            except TimeoutError as error:
+                #raised by func when the database aborts the query
+                return error
+            if then is not None:
+                await loop.run_in_executor(executor, then, item, result)
+            return result
+
+    #gather keeps the order of items, errors other than timeouts are raised
+    return await asyncio.gather(*(run_one(item) for item in items))
+
+
+def fetch_in_order(func, items, concurrency, timeout=None, then=None, on_timeout=None):
+    '''
+    Blocking entry point of gather_in_order, from code that does not run an
+    event loop (data_integrity.get_data_tables).
+
+    Parameters
+    ----------
+    func : function
+        blocking function of one item.
+    items : list
+        items, e.g. table names.
+    concurrency : int
+        number of items in flight.
+    timeout : float, optional
+        seconds allowed for func of one item.
+    then : function, optional
+        function of an item and its result run after func, see
+        gather_in_order.
+    on_timeout : function, optional
+        function of an item that did not finish in time, see
+        gather_in_order.
+
+    Returns
+    -------
+    results : list
+        func(item) in the order of items, a TimeoutError for the items that
+        did not finish in time.
+
+    '''
+
+    concurrency = max(concurrency, 1)
+    #the threads are not shared with the event loop default executor, so at most concurrency queries run even after a timeout
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        return asyncio.run(gather_in_order(func, list(items), concurrency, timeout, executor, then, on_timeout))
+    finally:
+        #a thread still blocked in a query that timed out is not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Database backends of data_integrity.
+
+The checks run against the CALM MySQL server (mysql backend) or against an
+embedded database loaded from the CSV dump of the tables (sqlite backend with
+the standard library, duckdb backend if duckdb is installed), see
+data_cleaning/docs/data_filenames.txt for the file names of the dump
+(<table>-<MM_DD_YYYY>.csv, <table>-<MM_DD_YYYY>-redacted.csv), and the
+gzip files of raw_export (<table>-<MM_DD_YYYY>.csv.gz).
+
+The queries of data_integrity use the %s parameter style of mysql.connector,
+the connections of the embedded backends translate it to ? so the same
+queries run on every backend.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import warnings
+import weakref
+import pandas as pd
+
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+except ImportError:
+    mysql = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+#<table>-<MM_DD_YYYY>.csv or <table>-<MM_DD_YYYY>-redacted.csv, gzipped or not
+CSV_DUMP_PATTERN = re.compile(r'^(?P<table>.+?)-(?P<date>\d{2}_\d{2}_\d{4})(?P<redacted>-redacted)?\.csv(\.gz)?$')
+
+
+def csv_dump_files(csv_dir):
+    '''
+    Table name -> CSV file of a dump directory, in table name order. Files
+    that do not follow the dump naming are ignored.
+
+    When a table has several files, the one of the latest MM_DD_YYYY date is
+    used, and at the same date the raw file is preferred to the -redacted
+    one, it has every column of the table like the database. Dates that are
+    not valid MM_DD_YYYY dates come before every valid date.
+    '''
+
+    candidates = {}
+    for file_name in os.listdir(csv_dir):
+        match = CSV_DUMP_PATTERN.match(file_name)
+        if match is None:
+            continue
+        date = pd.to_datetime(match.group('date'), format='%m_%d_%Y', errors='coerce')
+        key = (pd.Timestamp.min if pd.isna(date) else date, match.group('redacted') is None, file_name)
+        candidates.setdefault(match.group('table'), []).append(key)
+
+    return dict((tbl_name, os.path.join(csv_dir, max(keys)[2])) for tbl_name, keys in sorted(candidates.items()))
+
+
+def error_chain(error):
+    '''
+    The error and the errors it was raised from, pd.read_sql_query raises
+    its own DatabaseError from the error of the driver.
+    '''
+
+    errors = []
+    while error is not None and all(error is not other for other in errors):
+        errors.append(error)
+        error = error.__cause__ if error.__cause__ is not None else error.__context__
+
+    return errors
+
+
+class mysql_backend:
+    '''
+    CALM MySQL server through mysql.connector.
+    '''
+
+    name = 'mysql'
+
+    def __init__(self, host, user, password, database, auth_plugin):
+
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+        self.auth_plugin = auth_plugin
+
+    def connect(self):
+
+        if mysql is None:
+            raise ImportError("the mysql backend needs mysql-connector-python, install it with 'pip install mysql-connector-python'")
+
+        return mysql.connector.connect(host=self.host, user=self.user, password=self.password,
+                                       database=self.database, auth_plugin=self.auth_plugin)
+
+    def connection_pool(self, pool_size):
+        '''
+        Pool of pool_size connections, get_connection() gives a connection
+        that goes back to the pool when it is closed.
+        '''
+
+        return mysql.connector.pooling.MySQLConnectionPool(pool_name="data_integrity", pool_size=pool_size,
+                                                           host=self.host, user=self.user, password=self.password,
+                                                           database=self.database, auth_plugin=self.auth_plugin)
+
+    def set_query_timeout(self, mydb, seconds):
+        '''
+        The server aborts the select queries of the connection that run
+        longer than seconds, no limit if seconds is None.
+        '''
+
+        cursor = mydb.cursor()
+        cursor.execute("SET SESSION MAX_EXECUTION_TIME = {}".format(int(seconds * 1000) if seconds else 0))
+        cursor.close()
+
+    def interrupt(self, mydb):
+        #the server aborts the query itself after MAX_EXECUTION_TIME
+        pass
+
+    def is_query_timeout(self, error):
+        #ER_QUERY_TIMEOUT, maximum statement execution time exceeded
+        return any(getattr(other, 'errno', None) == 3024 or 'maximum statement execution time exceeded' in str(other)
+                   for other in error_chain(error))
+
+    def list_tables(self, mydb):
+        #the column of show tables is Tables_in_<database>
+        return list(pd.read_sql_query("show tables;", mydb).iloc[:, 0].values)
+
+
+class format_cursor(sqlite3.Cursor):
+    '''
+    sqlite3 cursor that accepts the %s parameter style.
+    '''
+
+    def execute(self, query, params=()):
+        return super().execute(query.replace('%s', '?'), [str(param) if isinstance(param, pd.Timestamp) else param for param in params])
+
+
+class format_connection(sqlite3.Connection):
+    '''
+    sqlite3 connection whose cursors accept the %s parameter style, pandas
+    still sees a sqlite3 connection.
+    '''
+
+    def cursor(self, factory=format_cursor):
+        return super().cursor(factory)
+
+
+class sqlite_backend:
+    '''
+    SQLite database file, loaded from a CSV dump.
+
+    Parameters
+    ----------
+    path : str
+        database file, created if it does not exist.
+    csv_dir : str, optional
+        CSV dump whose tables are loaded in the database, tables already in
+        the database are not loaded again.
+    chunksize : int, optional
+        rows read from a CSV file and inserted at a time.
+    '''
+
+    name = 'sqlite'
+
+    def __init__(self, path, csv_dir=None, chunksize=50000):
+
+        self.path = path
+        self.csv_dir = csv_dir
+        self.chunksize = chunksize
+
+    def connect(self):
+
+        #the database file is in --output_dir by default, which may not exist yet
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        mydb = sqlite3.connect(self.path, factory=format_connection, check_same_thread=False)
+        if self.csv_dir is not None:
+            self.load_csv_dump(mydb)
+
+        return mydb
+
+    def load_csv_dump(self, mydb):
+
+        loaded = set(self.list_tables(mydb))
+        for tbl_name, path in csv_dump_files(self.csv_dir).items():
+            if tbl_name in loaded:
+                continue
+            print("loading {} into {}".format(path, self.path))
+            for i, chunk in enumerate(pd.read_csv(path, chunksize=self.chunksize, low_memory=False)):
+                chunk.to_sql(tbl_name, mydb, if_exists='replace' if i == 0 else 'append', index=False)
+        #later connections do not load the dump again
+        self.csv_dir = None
+
+    def connection_pool(self, pool_size):
+        #every connection opens the same file, there is nothing to pool
+        return self
+
+    def get_connection(self):
+        return sqlite3.connect(self.path, factory=format_connection, check_same_thread=False)
+
+    def set_query_timeout(self, mydb, seconds):
+        '''
+        The queries of the connection are interrupted once seconds have
+        passed from now, no limit if seconds is None.
+        '''
+
+        if seconds is None:
+            mydb.set_progress_handler(None, 0)
+        else:
+            deadline = time.time() + seconds
+            #a true value interrupts the running query, checked every 10000 virtual machine instructions
+            mydb.set_progress_handler(lambda: time.time() > deadline, 10000)
+
+    def interrupt(self, mydb):
+        '''
+        Stops the running query of the connection, from another thread.
+        '''
+
+        mydb.interrupt()
+
+    def is_query_timeout(self, error):
+        #a query stopped by the progress handler raises OperationalError: interrupted
+        return any(isinstance(other, sqlite3.OperationalError) and 'interrupted' in str(other) for other in error_chain(error))
+
+    def list_tables(self, mydb):
+        return list(pd.read_sql_query("select name from sqlite_master where type = 'table' order by name;", mydb)['name'].values)
+
+
+class duckdb_connection:
+    '''
+    DuckDB connection whose cursors accept the %s parameter style.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        #pandas runs every query on a new cursor, interrupt has to reach them
+        self.cursors = weakref.WeakSet()
+
+    def cursor(self):
+        cursor = duckdb_connection(self.connection.cursor())
+        self.cursors.add(cursor)
+        return cursor
+
+    def interrupt(self):
+        '''
+        Stops the running queries of the connection and of its cursors.
+        '''
+
+        for connection in [self] + list(self.cursors):
+            try:
+                connection.connection.interrupt()
+            except duckdb.ConnectionException:
+                #a cursor closed in the meantime has nothing to stop
+                pass
+
+    def execute(self, query, params=()):
+        self.connection.execute(query.replace('%s', '?'), [str(param) if isinstance(param, pd.Timestamp) else param for param in params])
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class duckdb_backend(sqlite_backend):
+    '''
+    DuckDB database file, loaded from a CSV dump, the aggregate checks run
+    in its columnar engine.
+    '''
+
+    name = 'duckdb'
+
+    def connect(self):
+
+        if duckdb is None:
+            raise ImportError("the duckdb backend needs duckdb, install it with 'pip install duckdb'")
+
+        #pandas reads from DuckDB through the DB-API cursor and warns that it is not SQLAlchemy
+        warnings.filterwarnings('ignore', message='pandas only supports SQLAlchemy', category=UserWarning)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        mydb = duckdb_connection(duckdb.connect(self.path))
+        if self.csv_dir is not None:
+            self.load_csv_dump(mydb)
+        self.connection = mydb
+
+        return mydb
+
+    def load_csv_dump(self, mydb):
+
+        loaded = set(self.list_tables(mydb))
+        for tbl_name, path in csv_dump_files(self.csv_dir).items():
+            if tbl_name in loaded:
+                continue
+            print("loading {} into {}".format(path, self.path))
+            mydb.execute("create table {} as select * from read_csv_auto('{}', header = true)".format(tbl_name, path.replace("'", "''")))
+        self.csv_dir = None
+
+    def get_connection(self):
+        #cursors of one DuckDB connection can be used from several threads, closing a cursor leaves the connection open
+        return self.connection.cursor()
+
+    def set_query_timeout(self, mydb, seconds):
+        #DuckDB has no statement timeout, only the client side timeout of async_fetch applies, it interrupts the query
+        pass
+
+    def is_query_timeout(self, error):
+        #an interrupted query raises duckdb.InterruptException
+        return duckdb is not None and any(isinstance(other, duckdb.InterruptException) for other in error_chain(error))
+
+    def list_tables(self, mydb):
+        return list(pd.read_sql_query("select table_name from information_schema.tables order by table_name;", mydb)['table_name'].values)
+
+
+def make_backend(args):
+    '''
+    Backend of the command line arguments.
+    '''
+
+    if args.backend == 'mysql':
+        return mysql_backend(args.host, args.user, args.password, args.database, args.auth_plugin)
+
+    path = args.backend_path if args.backend_path else os.path.join(args.output_dir, 'calm.' + args.backend)
+    if args.backend == 'sqlite':
+        return sqlite_backend(path, args.csv_dir, args.chunksize)
+
+    return duckdb_backend(path, args.csv_dir, args.chunksize)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the data integrity stages on synthetic CALM-shaped data.
+
+synthetic_calm generates study, participant, task_log and questionnaire
+tables that follow the TET/GIDI/KAISER/SPANISH protocols of
+study_protocols.json (or of another protocol file, e.g. with other change
+dates): every participant enrolls at a random date, goes through a random
+number of sessions one week apart and does the tasks of the protocol version
+in effect at that date, with some tasks skipped and some duplicated.
+
+run_benchmark times get_data_tables (fetch and per table checks of every
+table from a SQLite copy, see backends), step2 with each engine, final_touch_step2,
+task_log_and_taskname and reconcile_task_log for each number of participants,
+and records the wall time and the peak memory allocated by the stage
+(tracemalloc, worker processes of the parallel engine are not counted).
+
+    python benchmark.py --sizes 1000 10000 100000 --engines groupby parallel --output benchmark.csv
+"""
+
+import io
+import time
+import os
+import sqlite3
+import tempfile
+import argparse
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from study_protocols import protocol_registry, PROTOCOLS_FILE
+from data_integration import data_integrity, parse_args, QUESTIONNAIRE_TABLES
+
+
+STUDIES = ['TET', 'GIDI', 'KAISER', 'SPANISH']
+
+#tasks stored as a tag and a task_name in task_log
+TAGGED_TASKS = {'preAffect': ('pre', 'Affect'), 'postAffect': ('post', 'Affect')}
+
+
+def synthetic_calm(n_participants, studies=STUDIES, skip_rate=0.05, duplicate_rate=0.02,
+                   enrollment_start='2020-04-07', enrollment_days=365, session_days=7,
+                   protocols_file=PROTOCOLS_FILE, seed=4444):
+    '''
+    Synthetic CALM tables.
+
+    Parameters
+    ----------
+    n_participants : int
+        number of participants, spread evenly over the studies.
+    studies : list, optional
+        studies of the participants.
+    skip_rate : float, optional
+        probability that a task is not done (missing from task_log) or that
+        a questionnaire row is missing from its table.
+    duplicate_rate : float, optional
+        probability that a task is logged twice.
+    enrollment_start : str, optional
+        first enrollment date.
+    enrollment_days : int, optional
+        participants enroll over this many days, enrollments that straddle
+        the change dates of the protocols get different versions.
+    session_days : int, optional
+        days between two sessions of a participant.
+    protocols_file : str, optional
+        protocol file the task sequences and change dates are taken from.
+    seed : int, optional
+        random seed.
+
+    Returns
+    -------
+    tables : OrderedDict
+        table name -> DataFrame: study, participant, task_log and the
+        questionnaire tables of QUESTIONNAIRE_TABLES.
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    protocols = protocol_registry(protocols_file)
+
+    participant_ids = np.arange(n_participants) + 2010
+    study_ids = participant_ids + 80000
+    p_studies = np.array(studies, dtype=object)[np.arange(n_participants) % len(studies)]
+    enrolled = pd.Timestamp(enrollment_start) + pd.to_timedelta(rng.integers(0, enrollment_days * 24 * 60, n_participants), unit='m')
+    enrolled = enrolled.values
+    current_session = np.empty(n_participants, dtype=object)
+
+    blocks = []
+    for study in studies:
+        in_study = np.flatnonzero(p_studies == study)
+        sessions = protocols.sessions(study)
+        #number of sessions each participant went through
+        n_reached = rng.integers(1, len(sessions) + 1, len(in_study))
+        current_session[in_study] = np.array(sessions, dtype=object)[n_reached - 1]
+
+        for k, session in enumerate(sessions):
+            ps = in_study[n_reached > k]
+            session_start = enrolled[ps] + np.timedelta64(k * session_days, 'D')
+            version_rows = protocols.version_index(study, session, session_start)
+
+            for v, version in enumerate(protocols.versions(study, session)):
+                pv = ps[version_rows == v]
+                tasks = version['tasks'] + ['SESSION_COMPLETE']
+                if len(pv) == 0:
+                    continue
+
+                #one row per participant and task, in the order of the protocol
+                p_rows = np.repeat(pv, len(tasks))
+                t_rows = np.tile(np.arange(len(tasks)), len(pv))
+                dates = np.repeat(session_start[version_rows == v], len(tasks)) + (t_rows * 3 + rng.integers(0, 3, len(t_rows))).astype('timedelta64[m]')
+
+                #skipped tasks are dropped, duplicated tasks are logged twice in a row
+                kept = np.flatnonzero(rng.random(len(p_rows)) >= skip_rate)
+                kept = np.sort(np.concatenate([kept, kept[rng.random(len(kept)) < duplicate_rate]]), kind='stable')
+
+                task_names = np.array(tasks, dtype=object)[t_rows[kept]]
+                blocks.append(pd.DataFrame({'study_id': study_ids[p_rows[kept]],
+                                            'participantID': participant_ids[p_rows[kept]],
+                                            'session_name': session,
+                                            'task': task_names,
+                                            'date_completed': dates[kept]}))
+
+    task_log = pd.concat(blocks, ignore_index=True)
+    task_log = task_log.sort_values(by='date_completed', kind='stable').reset_index(drop=True)
+    tag_task = task_log['task'].map(lambda task: TAGGED_TASKS.get(task, (None, task)))
+    task_log = pd.DataFrame({'id': np.arange(task_log.shape[0]) + 1,
+                             'study_id': task_log['study_id'].values,
+                             'participantID': task_log['participantID'].values,
+                             'session_name': task_log['session_name'].values,
+                             'tag': [tag for tag, task_name in tag_task],
+                             'task_name': [task_name for tag, task_name in tag_task],
+                             'date_completed': task_log['date_completed'].values})
+
+    tables = OrderedDict()
+    tables['study'] = pd.DataFrame({'id': study_ids, 'study_extension': p_studies, 'current_session': current_session})
+    tables['participant'] = pd.DataFrame({'id': participant_ids, 'study_id': study_ids,
+                                          'test_account': (rng.random(n_participants) < 0.01).astype(int),
+                                          'admin': np.zeros(n_participants, dtype=int)})
+    tables['task_log'] = task_log
+
+    #one questionnaire row per task_log row of the questionnaire, some of them missing
+    #the task_log names are the ones of the protocols (Credibility, RR, ...), QUESTIONNAIRE_TABLES has the same casing
+    p_study = pd.Series(participant_ids, index=study_ids)
+    for task_name, tbl_name in QUESTIONNAIRE_TABLES.items():
+        rows = task_log[(task_log['task_name'] == task_name).values & (rng.random(task_log.shape[0]) >= skip_rate)]
+        tables[tbl_name] = pd.DataFrame({'id': np.arange(rows.shape[0]) + 1,
+                                         'participant_id': p_study.loc[rows['study_id'].values].values,
+                                         'session': rows['session_name'].values,
+                                         'date': rows['date_completed'].values})
+
+    return tables
+
+
+def measure(function):
+    '''
+    Runs function with its output silenced.
+
+    Returns
+    -------
+    result
+        what function returns.
+    wall_time : float
+        seconds.
+    peak_memory : float
+        peak of the memory allocated while function runs, in MB.
+
+    '''
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    wall_time = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, wall_time, peak / 1e6
+
+
+def run_benchmark(sizes, engines, study='TET', loop_max=1000, jobs=1, **synthetic_args):
+    '''
+    Times every stage for every number of participants.
+
+    Parameters
+    ----------
+    sizes : list
+        numbers of participants.
+    engines : list
+        step2 engines: loop, groupby, parallel.
+    study : str, optional
+        study checked by step2, final_touch_step2 and task_log_and_taskname.
+    loop_max : int, optional
+        the loop engine is only run up to this number of participants.
+    jobs : int, optional
+        worker processes of the parallel engine.
+    **synthetic_args
+        passed to synthetic_calm.
+
+    Returns
+    -------
+    results : DataFrame
+        one row per (participants, stage) with the wall time and peak memory.
+
+    '''
+
+    results = []
+    for n_participants in sizes:
+        tables = synthetic_calm(n_participants, **synthetic_args)
+        print("{} participants, {} task_log rows".format(n_participants, tables['task_log'].shape[0]))
+
+        def record(stage, function):
+            result, wall_time, peak_memory = measure(function)
+            results.append({'participants': n_participants, 'task_log_rows': tables['task_log'].shape[0],
+                            'stage': stage, 'wall_time': wall_time, 'peak_memory_mb': peak_memory})
+            print("{:<24} {:>10.2f} s {:>10.1f} MB".format(stage, wall_time, peak_memory))
+            return result
+
+        #get_data_tables reads a SQLite copy of the synthetic tables
+        backend_dir = tempfile.mkdtemp()
+        backend_path = os.path.join(backend_dir, 'calm.sqlite')
+        mydb = sqlite3.connect(backend_path)
+        for tbl_name, df in tables.items():
+            df.to_sql(tbl_name, mydb, index=False)
+        mydb.close()
+
+        argv = ['--study', study, '--jobs', str(jobs), '--backend', 'sqlite', '--backend_path', backend_path, '--output_dir', backend_dir]
+        if synthetic_args.get('protocols_file'):
+            argv += ['--protocols', synthetic_args['protocols_file']]
+        integrity = data_integrity(parse_args(argv))
+        integrity.study_structure()
+
+        integrity.connect_database()
+        record('get_data_tables', integrity.get_data_tables)
+        integrity.mydb.close()
+        os.remove(backend_path)
+
+        #step2 checks the task log of one study
+        study_tasklog = tables['task_log'][tables['task_log']['study_id'].isin(tables['study'].query('study_extension == @study')['id'])]
+        flagged_ps_session = None
+        for engine in engines:
+            if engine == 'loop' and n_participants > loop_max:
+                continue
+            integrity.dataset_dfs = OrderedDict(tables, task_log=study_tasklog.copy())
+            if engine == 'loop':
+                flagged_ps_session = record('step2_loop', integrity.step2)
+            elif engine == 'groupby':
+                flagged_ps_session = record('step2_groupby', integrity.step2_groupby)
+            else:
+                flagged_ps_session = record('step2_parallel', integrity.step2_parallel)
+
+        if flagged_ps_session is not None:
+            record('final_touch_step2', lambda: integrity.final_touch_step2(flagged_ps_session))
+
+        integrity.dataset_dfs = tables
+        record('task_log_and_taskname', integrity.task_log_and_taskname)
+        record('reconcile_task_log', integrity.reconcile_task_log)
+
+    return pd.DataFrame(results)
+
+
+def parse_benchmark_args():
+
+    parser = argparse.ArgumentParser(description='Benchmark of the data integrity stages on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help= 'numbers of participants')
+    parser.add_argument('--engines', type=str, nargs='+', choices=['loop', 'groupby', 'parallel'], default=['groupby'])
+    parser.add_argument('--study', type=str, choices=STUDIES, default='TET')
+    parser.add_argument('--loop_max', type=int, default=1000, help= 'the loop engine is only run up to this number of participants')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--skip_rate', type=float, default=0.05)
+    parser.add_argument('--duplicate_rate', type=float, default=0.02)
+    parser.add_argument('--enrollment_start', type=str, default='2020-04-07')
+    parser.add_argument('--enrollment_days', type=int, default=365)
+    parser.add_argument('--protocols', type=str, default=PROTOCOLS_FILE, help= 'protocol file with the task sequences and change dates')
+    parser.add_argument('--seed', type=int, default=4444)
+    parser.add_argument('--output', type=str, default=None, help= 'CSV file of the results')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_benchmark_args()
+    results = run_benchmark(args.sizes, args.engines, study=args.study, loop_max=args.loop_max, jobs=args.jobs,
+                            skip_rate=args.skip_rate, duplicate_rate=args.duplicate_rate,
+                            enrollment_start=args.enrollment_start, enrollment_days=args.enrollment_days,
+                            protocols_file=args.protocols, seed=args.seed)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -7,6 +7,7 @@ Created on Tue Aug 14 12:24:27 2021
 """
 
 import sys, os, glob, argparse
+import hashlib, pickle
 import numpy as np
 import time
 import pandas as pd
@@ -14,13 +15,70 @@ import matplotlib.pyplot as plt
 from collections import defaultdict, OrderedDict
 
 
-import mysql.connector
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from backends import make_backend
+from instrumentation import instrumentation
+from table_store import spilled_tables, read_columns
+from fetch_plan import fetch_planner, compact_dtypes
+from snapshot_cache import snapshot_cache
+from study_encoding import study_vocabulary, encode_task_column, distinct_tasks
+from study_protocols import protocol_registry, PROTOCOLS_FILE
+from sequence_index import sequence_index, codes_mask
+from flagged_report import flagged_report, SESSION_ORDER
+from reconciliation import reconcile, questionnaire_task_names
+from task_log_io import read_task_log, TASK_LOG_COLUMNS
+from redaction import redaction_spec, REDACTION_SPEC_FILE
+from participant_index import participant_index
+from async_fetch import fetch_in_order
 
 from datetime import date
 random_state = 4444
 
 plt.rcParams['figure.figsize'] = [20, 8]  # Bigger images
 
+#log and administrative tables that are not checked, except action_log
+EXCLUDED_TABLES = ["attrition_prediction", "coach_log",
+                   "condition_assignment_settings", "data",
+                   "demographics_race", "error_log",
+                   "evaluation_coach_help_topics", "evaluation_devices",
+                   "evaluation_how_learn", "evaluation_places",
+                   "evaluation_preferred_platform",
+                   "evaluation_reasons_control",
+                   "export_log", "gift_log", "id_gen", "import_log", "media",
+                   "mental_health_change_help",
+                   "mental_health_disorders",
+                   "mental_health_help",
+                   "mental_health_why_no_help",
+                   "missing_data_log",
+                   "password_token",
+                   "random_condition",
+                   "reasons_for_ending_change_med",
+                   "reasons_for_ending_device_use",
+                   "reasons_for_ending_location",
+                   "reasons_for_ending_reasons",
+                   "session_review_distractions",
+                   "sms_log", "stimuli", "verification_code", "visit"]
+
+#non-test and non-admin participants of a study, the study_extension is passed as a query parameter
+ELIGIBLE_PARTICIPANTS_CTE = "with eligible as (select participant.id as participant_id, participant.study_id from participant " \
+                            "join study on study.id = participant.study_id " \
+                            "where study.study_extension = %s and participant.test_account = 0 and participant.admin = 0) "
+
+
+#task_name in task_log -> questionnaire table, as in runSQL.py but with the task names of task_log (runSQL.py relies on the case-insensitive MySQL collation)
+QUESTIONNAIRE_TABLES = OrderedDict([('Credibility', 'credibility'), ('Demographics', 'demographics'), ('MentalHealthHistory', 'mental_health_history'),
+                                    ('AnxietyIdentity', 'anxiety_identity'), ('OA', 'oa'), ('AnxietyTriggers', 'anxiety_triggers'), ('RR', 'rr'), ('BBSIQ', 'bbsiq'),
+                                    ('Comorbid', 'comorbid'), ('Wellness', 'wellness'), ('Mechanisms', 'mechanisms'), ('Covid19', 'covid19'), ('TechnologyUse', 'technology_use'),
+                                    ('Affect', 'affect'), ('SessionReview', 'session_review'), ('CoachPrompt', 'coach_prompt'), ('ReturnIntention', 'return_intention'),
+                                    ('HelpSeeking', 'help_seeking'), ('Evaluation', 'evaluation'), ('AssessingProgram', 'assessing_program')])
+
+#steps of --task, always run in this order
+TASKS = ['step1', 'step2', 'step3']
+
+#layout of the step 2 checkpoint, the flagged rows of every participant are flagged reports
+CHECKPOINT_VERSION = 2
+
 
 class data_integrity:
     def __init__(self, args):
@@ -37,6 +95,10 @@ class data_integrity:
         self.input_dir = args.input_dir
         
         self.study = args.study
+        self.step2_engine = args.step2_engine
+        self.step2_order = args.step2_order
+        self.checkpoint = args.checkpoint
+        self.query_mode = args.query_mode
         self.data = pd.DataFrame()
         self.data_summary = pd.DataFrame()
         
@@ -46,9 +108,48 @@ class data_integrity:
         self.tasks = []
         self.dataset_dfs = OrderedDict()
         self.study_session_order = defaultdict()
+        self.protocols_file = args.protocols
+        self.protocols = None
+        self.vocabulary = None
+        self.reconciliation = pd.DataFrame()
         
         self.output_dir = args.output_dir
         self.report = pd.DataFrame()
+        #exported task log checked by step 2 instead of the task_log table
+        self.task_log_csv = args.task_log_csv
+        #the tables are fetched once, by the first step that needs them
+        self.tables_loaded = False
+        #eligible participants of every study, built once from the tables of the run
+        self.eligible = None
+
+        self.fetch_mode = args.fetch_mode
+        #identifiers and free-text answers are redacted as the tables are fetched, before they are kept or written
+        self.redaction = redaction_spec(args.redaction_spec) if args.redact else None
+        #only the columns the checks need, with compact dtypes, with --fetch_columns pruned
+        self.planner = fetch_planner() if args.fetch_columns == 'pruned' else None
+        self.chunksize = args.chunksize
+        self.spill_dir = args.spill_dir if args.spill_dir else os.path.join(self.output_dir, 'tables')
+        self.snapshot_dir = args.snapshot_dir if args.snapshot_dir else os.path.join(self.output_dir, 'snapshot')
+        self.offline = args.offline
+
+        #the SQL checks need the database and are run for one study
+        self.sql_checks = not self.offline and self.study != 'all'
+
+        self.jobs = args.jobs
+        self.pool = None
+        self.fetch_executor = args.fetch_executor
+        self.query_timeout = args.query_timeout
+        self.fetch_times = OrderedDict()
+        #tables the fetch gave up on after --query_timeout seconds -> reason
+        self.failed_tables = OrderedDict()
+        #table -> connection of the tables being fetched, to interrupt a fetch that timed out
+        self.fetch_connections = {}
+
+        #MySQL server or embedded database loaded from the CSV dump
+        self.backend = make_backend(args)
+
+        #query and stage records, written as JSON lines to --metrics
+        self.instrumentation = instrumentation(args.metrics)
         
     def connect_database(self):
         '''       
@@ -58,15 +159,13 @@ class data_integrity:
             DESCRIPTION.
 
         '''
-        mydb = mysql.connector.connect(
-            host=self.host,
-            user=self.user,
-            password= self.password,
-            database=self.database,
-            auth_plugin = self.auth_plugin
-            )
+        mydb = self.backend.connect()
 
         self.mydb = mydb
+
+        #extra connections for fetching tables in parallel
+        if self.jobs > 1:
+            self.pool = self.backend.connection_pool(self.jobs)
         
         return mydb
     
@@ -82,319 +181,459 @@ class data_integrity:
         '''
         
         mydb = self.mydb
-        study_name = self.study
         
-        task_tables = defaultdict(list)
-        if study_name == 'TET':
+        #every study checks all the tables, the queries and the pandas checks keep the participants of its study_extension
+        if self.offline:
+            #without database the tables are the ones of the snapshot
+            snapshot = snapshot_cache(self.snapshot_dir)
+            task_tables = pd.DataFrame({'table_name': list(snapshot.manifest.keys())})
+        else:
             ## extract all the tables in this dataset
-            query = "show tables;"
-            task_tables = pd.read_sql_query(query,mydb)
-            
-            self.tasks = task_tables
-            #exclude log and administrative tables except action_log
-            task_tables = task_tables[~task_tables.Tables_in_calm.isin(["attrition_prediction", "coach_log", 
-                                                                        "condition_assignment_settings", "data",
-                                                                       "demographics_race", "error_log",
-                                                                       "evaluation_coach_help_topics", "evaluation_devices",
-                                                                       "evaluation_how_learn", "evaluation_places",
-                                                                       "evaluation_preferred_platform", 
-                                                                       "evaluation_reasons_control",
-                                                                       "export_log", "gift_log", "id_gen", "import_log", "media",
-                                                                       "mental_health_change_help",
-                                                                       "mental_health_disorders",
-                                                                       "mental_health_help",
-                                                                       "mental_health_why_no_help",
-                                                                       "missing_data_log",
-                                                                       "password_token",
-                                                                       "random_condition",
-                                                                       "reasons_for_ending_change_med",
-                                                                       "reasons_for_ending_device_use",
-                                                                       "reasons_for_ending_location",
-                                                                       "reasons_for_ending_reasons",
-                                                                       "session_review_distractions",
-                                                                       "sms_log", "stimuli", "verification_code", "visit"])]
-        
-            
+            task_tables = pd.DataFrame({'table_name': self.backend.list_tables(mydb)})
+        
+        self.tasks = task_tables
+        #exclude log and administrative tables except action_log
+        task_tables = task_tables[~task_tables.table_name.isin(EXCLUDED_TABLES)]
+        
+        if self.offline or self.fetch_mode == 'snapshot':
+            #the snapshot is brought up to date with the rows that changed since the last run, then read locally
+            dataset_dfs = snapshot_cache(self.snapshot_dir, list(task_tables.table_name.values), self.redaction)
+            if not self.offline:
+                with self.instrumentation.stage('snapshot_refresh'):
+                    fetched_rows = dataset_dfs.refresh(list(task_tables.table_name.values), mydb)
+                for tbl_name, n_rows in fetched_rows.items():
+                    self.instrumentation.record('snapshot_refresh', table=tbl_name, rows=n_rows)
+            if self.query_mode == 'per_table' and self.sql_checks:
+                for tbl_name in dataset_dfs:
+                    if tbl_name != 'participant':
+                        self.per_table_checks(tbl_name)
+            elif self.query_mode == 'batched' and self.sql_checks:
+                self.batched_table_checks(dataset_dfs)
+
+            self.dataset_dfs = dataset_dfs
+            self.eligible = None
+
+            return dataset_dfs
+
+        #in stream mode the tables are spilled to disk in chunks and loaded when they are used
+        if self.fetch_mode == 'stream':
+            dataset_dfs = spilled_tables(self.spill_dir, compact_dtypes if self.planner is not None else None)
+        else:
             dataset_dfs = OrderedDict()
-            
-            ## overview of each table in the study
-            for tbl in task_tables.values:
-                tblName = tbl
-                print("--------------------------------------")
-                print("The name of the table is: {}".format(tblName[0]))
-                select_query = "select * from {}".format(tblName[0])
-                df = pd.read_sql_query(select_query,mydb)
-                dataset_dfs[tblName[0]] = df
-                print("--------------------------------------")
-                if tblName[0] != 'participant':
-                    query = "select count(distinct(study_id)) as freq,  count(distinct session_name) as sessions from task_log where task_name = '{}' " \
-                              "and study_id in (select id from calm.study where study_extension = {} and id in (select study_id from participant where test_account = 0 and admin = 0))".format(tblName[0], repr(study_name))
-                    data = pd.read_sql_query(query,mydb)
-                    if data['freq'].values[0] > 0:
-                        print("The name of the table is: {} \nthe frequency values: {} \nthe number of sessions:  {}".format(tblName[0],data['freq'].values[0],data['sessions'].values[0]))
-                        print("--------------------------------------")
-            
-            
-                    query ="SELECT study_id, session_name, COUNT(*) as count from task_log where task_name = '{}' " \
-                              "and study_id in (select id from calm.study where study_extension = {} and id in (select study_id from participant where test_account = 0 and admin = 0)) " \
-                                "GROUP BY study_id, session_name HAVING COUNT(*) > 1;".format(tblName[0], repr(study_name))
-                    data = pd.read_sql_query(query,mydb)
-                    if data.shape[0] > 0:
-                        print("The name of the table is: {} \nthe study_id: {} \nthe session:  {} \nthe number of duplications:  {}".format(tblName[0],data['study_id'].values[0],data['session_name'].values[0], data['count'].values[0]))
-                        print("--------------------------------------")
-            
-                    query = ""
-                    if tblName[0] == 'action_log':
-                        query = " select count(distinct participant_id) as freq, count(distinct session_name) as count_session from {} " \
-                                "where participant_id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tblName[0], repr(study_name))
-                    elif tblName[0] == 'study':
-                        query = " select count(distinct id) as freq, count(distinct current_session) as count_session from {} " \
-                                "where id in (select study_id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tblName[0], repr(study_name))
-                    elif tblName[0] == 'task_log':
-                        query = " select count(distinct id) as freq, count(distinct session_name) as count_session from {} " \
-                                "where id in (select study_id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tblName[0], repr(study_name))
-                    else:
-                        query = " select count(distinct participant_id) as freq, count(distinct session) as count_session from {} " \
-                                "where participant_id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tblName[0], repr(study_name))
-                    data = pd.read_sql_query(query,mydb)
-                    if data.shape[0] > 0:
-                        print("The name of the table is: {} \nthe frequency: {} \nthe number of sessions:  {} ".format(tblName[0],data['freq'].values[0],data['count_session'].values[0]))
-                        print("--------------------------------------")
-                    
-                    
-                    if tblName[0] == 'action_log':
-                        query = " SELECT participant_id, session_name, COUNT(*) as dup FROM {} " \
-                                  "where participant_id in (select id from participant where study_id in (select id from study where study_extension = 'TET') and test_account = 0 and admin = 0) " \
-                                    "GROUP BY participant_id, session_name HAVING COUNT(*) > 1;".format(tblName[0], repr(study_name))
-                    elif tblName[0] == 'study':
-                        query = " SELECT id, current_session, COUNT(*) as dup FROM {} " \
-                                  "where id in (select study_id from participant where study_id in (select id from study where study_extension = 'TET') and test_account = 0 and admin = 0) " \
-                                    "GROUP BY id, current_session HAVING COUNT(*) > 1;".format(tblName[0], repr(study_name))
-                    elif tblName[0] == 'task_log':
-                        query = " SELECT id, session_name, COUNT(*) as dup FROM {} " \
-                              "where id in (select id from participant where study_id in (select id from study where study_extension = 'TET') and test_account = 0 and admin = 0) " \
-                                "GROUP BY id, session_name HAVING COUNT(*) > 1;".format(tblName[0], repr(study_name))
-                    else:
-                        query = " SELECT participant_id, session, COUNT(*) as dup FROM {} " \
-                              "where participant_id in (select id from participant where study_id in (select id from study where study_extension = 'TET') and test_account = 0 and admin = 0) " \
-                                "GROUP BY participant_id, session HAVING COUNT(*) > 1;".format(tblName[0], repr(study_name))
-                    data = pd.read_sql_query(query,mydb)
-                    if data.shape[0] > 0:
-                        print("The name of the table is: {} \nthe participant/study id: {} \nthe number of sessions:  {} \nthe number of duplication: {} ".format(tblName[0],data.iloc[:,0].values[0],data.iloc[:,1].values[0], data['dup'].values[0]))
-                        print("--------------------------------------")
         
+        ## overview of each table in the study
+        tbl_names = list(task_tables.table_name.values)
+
+        def fetch_or_timeout(tbl_name):
+            #a table the database aborted is left out, the other tables are still fetched
+            try:
+                return self.fetch_table(tbl_name, dataset_dfs)
+            except TimeoutError as error:
+                return error
+
+        if self.fetch_executor == 'asyncio':
+            #at most --jobs tables in flight from an event loop, each table in a worker thread with its own pooled connection,
+            #--query_timeout only limits the fetch, the per table checks run after it
+            results = fetch_in_order(lambda tbl_name: self.fetch_table(tbl_name, dataset_dfs, checks=False), tbl_names, self.jobs,
+                                     self.query_timeout, then=lambda tbl_name, result: self.check_table(tbl_name),
+                                     on_timeout=self.interrupt_fetch)
+        elif self.pool is not None:
+            #tables are fetched and checked concurrently, each worker with its own pooled connection
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(fetch_or_timeout, tbl_names))
+        else:
+            results = [fetch_or_timeout(tbl_name) for tbl_name in tbl_names]
+
+        #results come back in table order
+        for tbl_name, result in zip(tbl_names, results):
+            if isinstance(result, TimeoutError):
+                print("{} is left out: {}".format(tbl_name, result))
+                self.failed_tables[tbl_name] = str(result)
+                self.instrumentation.record('fetch_timeout', table=tbl_name, wall_time=self.query_timeout)
+                continue
+            df, fetch_time = result
+            if df is not None:
+                dataset_dfs[tbl_name] = df
+            self.fetch_times[tbl_name] = fetch_time
+        if self.fetch_mode == 'stream':
+            dataset_dfs.reorder([tbl_name for tbl_name in tbl_names if tbl_name not in self.failed_tables])
+
+        print("Fetch time per table (seconds):")
+        for tbl_name, fetch_time in sorted(self.fetch_times.items(), key=lambda item: item[1], reverse=True):
+            print("{:<40} {:>10.2f}".format(tbl_name, fetch_time))
+        if len(self.failed_tables) > 0:
+            print("Tables not fetched in {} seconds: {}".format(self.query_timeout, ", ".join(self.failed_tables)))
+        print("--------------------------------------")
+
+        if self.query_mode == 'batched' and self.sql_checks:
+            self.batched_table_checks(dataset_dfs)
+
         self.dataset_dfs = dataset_dfs
+        #the participant index is built again from the new tables
+        self.eligible = None
         
         return dataset_dfs
 
 
-    def TET_structure(self):
+    def fetch_table(self, tbl_name, dataset_dfs, checks=True):
         '''
-        
+        Fetches one table, and runs its per table checks in per_table query
+        mode. With a connection pool the table uses its own connection so
+        several tables can be fetched at the same time.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        dataset_dfs : OrderedDict or spilled_tables
+            in stream mode the table is spilled to this store.
+        checks : bool, optional
+            False to only fetch the table, the checks are then run by
+            check_table.
+
         Returns
         -------
-        tet_session_task_order : TYPE
-            DESCRIPTION.
+        df : DataFrame
+            the table, None in stream mode.
+        fetch_time : float
+            seconds spent fetching the table.
+
+        Raises
+        ------
+        TimeoutError
+            the database aborted the fetch after --query_timeout seconds.
 
         '''
-        
-        
-        # create task structure for TET
-        #dictionary to store tasks in a session
-        tet_session_task_order = defaultdict(list)
-        
-        #I commented out Eligibility since the participant can retake the DASS or OA multiple times
-        #Maybe it would be better to check if the participant completed eligibility or if they did the DASS and OA at least once
-        #tet_session_task_order["Eligibility"] =np.array(["DASS21_AS","OA"])
-        
-        tet_session_task_order["preTest"] = ["Credibility","Demographics","MentalHealthHistory","AnxietyIdentity","AnxietyTriggers",
-                                                  "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","TechnologyUse"]
-        
-        tet_session_task_order["firstSession"] = ["preAffect","1","postAffect","CC","SessionReview","OA","CoachPrompt","Gidi","ReturnIntention"]
-        
-        tet_session_task_order["secondSession"] = ["2","SessionReview","OA","ReturnIntention"]
-        
-        tet_session_task_order["thirdSession"] = ["preAffect","3","postAffect","CC","SessionReview","AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","ReturnIntention"]
-        
-        tet_session_task_order["fourthSession"] = ["4","SessionReview","OA","ReturnIntention"]
-        
-        tet_session_task_order["fifthSession"] = ["preAffect","5","postAffect","CC","SessionReview","AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking",
-                                                       "Evaluation","AssessingProgram"]
-        
-        tet_session_task_order["PostFollowUp"] = ["AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking"]
-        
-        
-        return tet_session_task_order
-    
-    def GIDI_structure(self):
+
+        mydb = self.pool.get_connection() if self.pool is not None else self.mydb
+
+        try:
+            self.fetch_connections[tbl_name] = mydb
+            try:
+                df, fetch_time = self.fetch_rows(tbl_name, dataset_dfs, mydb)
+            finally:
+                self.fetch_connections.pop(tbl_name, None)
+            if checks and self.query_mode == 'per_table' and self.sql_checks and tbl_name != 'participant':
+                self.per_table_checks(tbl_name, mydb)
+        finally:
+            #pooled connections go back to the pool
+            if self.pool is not None:
+                mydb.close()
+
+        return df, fetch_time
+
+    def fetch_rows(self, tbl_name, dataset_dfs, mydb):
+        '''
+        Query of fetch_table, only this query is limited by --query_timeout,
+        not the per table checks that follow it.
         '''
-        
-        Returns
-        -------
-        gidi_session_task_order : TYPE
-            DESCRIPTION.
 
+        try:
+            if self.query_timeout is not None:
+                #the database aborts the fetch of the table if it runs longer than --query_timeout
+                self.backend.set_query_timeout(mydb, self.query_timeout)
+            print("--------------------------------------")
+            print("The name of the table is: {}".format(tbl_name))
+            select_query = "select * from {}".format(tbl_name)
+            if self.planner is not None:
+                #columns of the table without fetching any row
+                table_columns = list(self.instrumentation.read_sql("select * from {} limit 0".format(tbl_name), mydb, 'fetch_plan', tbl_name).columns)
+                select_query = self.planner.query(tbl_name, table_columns)
+            df = None
+            start = time.time()
+            if self.fetch_mode == 'stream':
+                transform = (lambda chunk: self.redaction.apply(tbl_name, chunk)) if self.redaction is not None else None
+                n_rows = dataset_dfs.spill(tbl_name, select_query, mydb, self.chunksize, transform=transform)
+                print("{} rows written to {}".format(n_rows, dataset_dfs.table_files[tbl_name]))
+                #database and pandas time are interleaved chunk by chunk, only the wall time is recorded
+                self.instrumentation.record('fetch', table=tbl_name, query=select_query, rows=n_rows,
+                                            bytes=os.path.getsize(dataset_dfs.table_files[tbl_name]), wall_time=time.time() - start)
+            else:
+                df = self.instrumentation.read_sql(select_query, mydb, 'fetch', tbl_name)
+                if self.redaction is not None:
+                    df = self.redaction.apply(tbl_name, df)
+                if self.planner is not None:
+                    df = compact_dtypes(df)
+            fetch_time = time.time() - start
+            print("--------------------------------------")
+        except Exception as error:
+            if self.query_timeout is not None and self.backend.is_query_timeout(error):
+                raise TimeoutError("{} did not finish in {} seconds".format(tbl_name, self.query_timeout)) from error
+            raise
+        finally:
+            if self.query_timeout is not None:
+                self.backend.set_query_timeout(mydb, None)
+
+        return df, fetch_time
+
+    def interrupt_fetch(self, tbl_name):
+        '''
+        Interrupts the query of a table whose fetch timed out, the thread of
+        the fetch is not waited for.
         '''
-        
-        # create task structure for GIDI
-        #dictionary to store tasks in a session
-        gidi_session_task_order = defaultdict()
-        
-        #I commented out Eligibility since the participant can retake the DASS or OA multiple times
-        #Maybe it would be better to check if the participant completed eligibility or if they did the DASS and OA at least once
-        #gidi_session_task_order["Eligibility"] =np.array(["OA","DASS21_AS"])
-        
-        gidi_session_task_order["preTest"] = ["Credibility","Demographics","MentalHealthHistory","AnxietyIdentity","AnxietyTriggers",
-                                                  "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","TechnologyUse"]
-        
-        gidi_session_task_order["firstSession"] = ["preAffect","1","postAffect","CC","SessionReview","OA","CoachPrompt","Gidi","ReturnIntention"]
-        
-        gidi_session_task_order["secondSession"] = ["2","SessionReview","OA","ReturnIntention"]
-        
-        gidi_session_task_order["thirdSession"] = ["preAffect","3","postAffect","CC","SessionReview","AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","ReturnIntention"]
-        
-        gidi_session_task_order["fourthSession"] = ["4","SessionReview","OA","ReturnIntention"]
-        
-        gidi_session_task_order["fifthSession"] = ["preAffect","5","postAffect","CC","SessionReview","AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking",
-                                                       "Evaluation","AssessingProgram"]
-        
-        gidi_session_task_order["PostFollowUp"] = ["AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking"]
-        
-        gidi_session_task_order["PostFollowUp2"] = ["AnxietyIdentity","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","BBSIQ","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking"]
-        
-        return gidi_session_task_order
 
-    def Kaiser_structure(self):
+        mydb = self.fetch_connections.get(tbl_name)
+        if mydb is not None:
+            self.backend.interrupt(mydb)
+
+    def check_table(self, tbl_name):
+        '''
+        Per table checks of a table fetched with fetch_table(checks=False),
+        on a pooled connection when there is a pool.
         '''
-        
 
-        Returns
-        -------
-        kaiser_session_task_order : TYPE
-            DESCRIPTION.
+        if not (self.query_mode == 'per_table' and self.sql_checks and tbl_name != 'participant'):
+            return
 
+        mydb = self.pool.get_connection() if self.pool is not None else self.mydb
+        try:
+            self.per_table_checks(tbl_name, mydb)
+        finally:
+            if self.pool is not None:
+                mydb.close()
+
+    def per_table_checks(self, tbl_name, mydb=None):
         '''
-        
-        # create task structure for Kaiser
-        #dictionary to store tasks in a session
-        kaiser_session_task_order = dict()
-        
-        kaiser_session_task_order["preTest"] = ["Identity","Credibility","Demographics","MentalHealthHistory","OA","DASS21_AS",
-                                                         "AnxietyTriggers","recognitionRatings","RR","Comorbid","Wellness","Mechanisms","Covid19","TechnologyUse"]
-        
-        kaiser_session_task_order["firstSession"] = ["preAffect","1","postAffect","CC","SessionReview","OA","CoachPrompt","ReturnIntention"]
-        
-        kaiser_session_task_order["secondSession"] = ["2","SessionReview","OA","ReturnIntention"]
-        
-        kaiser_session_task_order["thirdSession"] = ["preAffect","3","postAffect","CC","SessionReview","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","Comorbid","Wellness","Mechanisms","Covid19","ReturnIntention"]
-        
-        kaiser_session_task_order["fourthSession"] = ["4","SessionReview","OA","ReturnIntention"]
-        
-        kaiser_session_task_order["fifthSession"] = ["preAffect","5","postAffect","CC","SessionReview","OA","DASS21_AS",
-                                                       "recognitionRatings","RR","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking",
-                                                       "Evaluation","AssessingProgram"]
-        
-        kaiser_session_task_order["PostFollowUp"] = ["OA","DASS21_AS", "recognitionRatings","RR","Comorbid","Wellness","Mechanisms","Covid19","HelpSeeking"]
-        
-        return kaiser_session_task_order
-        
-    def Spanish_structure(self):
+        Runs the four integrity queries of one table against the database:
+        task_log frequency, task_log duplicates, table frequency and table
+        duplicates.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        mydb : connection, optional
+            connection used for the queries, the main connection by default.
+
         '''
-        
+
+        mydb = mydb if mydb is not None else self.mydb
+        study_name = self.study
+
+        query = "select count(distinct(study_id)) as freq,  count(distinct session_name) as sessions from task_log where task_name = '{}' " \
+                  "and study_id in (select id from study where study_extension = {} and id in (select study_id from participant where test_account = 0 and admin = 0))".format(tbl_name, repr(study_name))
+        data = self.instrumentation.read_sql(query, mydb, 'per_table_checks', tbl_name)
+        if data['freq'].values[0] > 0:
+            print("The name of the table is: {} \nthe frequency values: {} \nthe number of sessions:  {}".format(tbl_name,data['freq'].values[0],data['sessions'].values[0]))
+            print("--------------------------------------")
+
+
+        query ="SELECT study_id, session_name, COUNT(*) as count from task_log where task_name = '{}' " \
+                  "and study_id in (select id from study where study_extension = {} and id in (select study_id from participant where test_account = 0 and admin = 0)) " \
+                    "GROUP BY study_id, session_name HAVING COUNT(*) > 1;".format(tbl_name, repr(study_name))
+        data = self.instrumentation.read_sql(query, mydb, 'per_table_checks', tbl_name)
+        if data.shape[0] > 0:
+            print("The name of the table is: {} \nthe study_id: {} \nthe session:  {} \nthe number of duplications:  {}".format(tbl_name,data['study_id'].values[0],data['session_name'].values[0], data['count'].values[0]))
+            print("--------------------------------------")
+
+        query = ""
+        if tbl_name == 'action_log':
+            query = " select count(distinct participant_id) as freq, count(distinct session_name) as count_session from {} " \
+                    "where participant_id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tbl_name, repr(study_name))
+        elif tbl_name == 'study':
+            query = " select count(distinct id) as freq, count(distinct current_session) as count_session from {} " \
+                    "where id in (select study_id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tbl_name, repr(study_name))
+        elif tbl_name == 'task_log':
+            query = " select count(distinct id) as freq, count(distinct session_name) as count_session from {} " \
+                    "where id in (select study_id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tbl_name, repr(study_name))
+        else:
+            query = " select count(distinct participant_id) as freq, count(distinct session) as count_session from {} " \
+                    "where participant_id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0);".format(tbl_name, repr(study_name))
+        data = self.instrumentation.read_sql(query, mydb, 'per_table_checks', tbl_name)
+        if data.shape[0] > 0:
+            print("The name of the table is: {} \nthe frequency: {} \nthe number of sessions:  {} ".format(tbl_name,data['freq'].values[0],data['count_session'].values[0]))
+            print("--------------------------------------")
+
+
+        if tbl_name == 'action_log':
+            query = " SELECT participant_id, session_name, COUNT(*) as dup FROM {} " \
+                      "where participant_id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0) " \
+                        "GROUP BY participant_id, session_name HAVING COUNT(*) > 1;".format(tbl_name, repr(study_name))
+        elif tbl_name == 'study':
+            query = " SELECT id, current_session, COUNT(*) as dup FROM {} " \
+                      "where id in (select study_id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0) " \
+                        "GROUP BY id, current_session HAVING COUNT(*) > 1;".format(tbl_name, repr(study_name))
+        elif tbl_name == 'task_log':
+            query = " SELECT id, session_name, COUNT(*) as dup FROM {} " \
+                  "where id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0) " \
+                    "GROUP BY id, session_name HAVING COUNT(*) > 1;".format(tbl_name, repr(study_name))
+        else:
+            query = " SELECT participant_id, session, COUNT(*) as dup FROM {} " \
+                  "where participant_id in (select id from participant where study_id in (select id from study where study_extension = {}) and test_account = 0 and admin = 0) " \
+                    "GROUP BY participant_id, session HAVING COUNT(*) > 1;".format(tbl_name, repr(study_name))
+        data = self.instrumentation.read_sql(query, mydb, 'per_table_checks', tbl_name)
+        if data.shape[0] > 0:
+            print("The name of the table is: {} \nthe participant/study id: {} \nthe number of sessions:  {} \nthe number of duplication: {} ".format(tbl_name,data.iloc[:,0].values[0],data.iloc[:,1].values[0], data['dup'].values[0]))
+            print("--------------------------------------")
+
+    def batched_table_checks(self, dataset_dfs):
+        '''
+        Batched version of per_table_checks. The eligible participants of the
+        study (non-test, non-admin) are defined once as a CTE and the
+        aggregates of all tables are computed with four queries instead of
+        four queries per table.
+
+        Parameters
+        ----------
+        dataset_dfs : OrderedDict, spilled_tables or snapshot_cache
+            tables extracted from the database, used for the table names and
+            their columns.
+
         Returns
         -------
-        spanish_session_task_order : TYPE
-            DESCRIPTION.
+        data_summary : DataFrame
+            one row per table with the task_log and table frequencies, number
+            of sessions and number of duplicated rows.
 
         '''
-        
-        # create task structure for Spanish
-        #dictionary to store tasks in a session
-        spanish_session_task_order = defaultdict()
-        
-        spanish_session_task_order["Eligibility"] = ["OA","DASS21_AS"]
-        
-        spanish_session_task_order["preTest"] = ["Demographics","MentalHealthHistory","Acculturation","Ethnicity"
-                                                          "Comorbid", "recognitionRatings","RR","Covid19","preAffect","1","postAffect","CC"]
-        
-        spanish_session_task_order["secondSession"] = ["preAffect","2","postAffect","OA","Comorbid","DASS21_AS","recognitionRatings","RR","Evaluation"] 
-        
-        return spanish_session_task_order
+
+        mydb = self.mydb
+        study_name = self.study
+
+        tbl_names = [tbl_name for tbl_name in dataset_dfs.keys() if tbl_name != 'participant']
+        task_names = ", ".join(repr(tbl_name) for tbl_name in tbl_names)
+
+        #task_log frequency and number of sessions of every task in one query
+        query = ELIGIBLE_PARTICIPANTS_CTE + \
+                "select task_name, count(distinct study_id) as freq, count(distinct session_name) as sessions from task_log " \
+                "where study_id in (select study_id from eligible) and task_name in ({}) group by task_name;".format(task_names)
+        tasklog_freq = self.instrumentation.read_sql(query, mydb, 'batched_table_checks', 'task_log', params=[study_name])
+
+        #task_log duplications of every task in one query
+        query = ELIGIBLE_PARTICIPANTS_CTE + \
+                "select task_name, study_id, session_name, count(*) as count from task_log " \
+                "where study_id in (select study_id from eligible) and task_name in ({}) " \
+                "group by task_name, study_id, session_name having count(*) > 1;".format(task_names)
+        tasklog_dup = self.instrumentation.read_sql(query, mydb, 'batched_table_checks', 'task_log', params=[study_name])
+
+        #per table frequency and duplications, one select per table joined with UNION ALL
+        freq_selects = []
+        dup_selects = []
+        for tbl_name in tbl_names:
+            #spilled and snapshot tables know their columns without being loaded
+            if isinstance(dataset_dfs, (spilled_tables, snapshot_cache)):
+                columns = dataset_dfs.table_columns[tbl_name]
+            else:
+                columns = dataset_dfs[tbl_name].columns
+            if tbl_name == 'study':
+                id_clm, session_clm, eligible_clm = 'id', 'current_session', 'study_id'
+            elif tbl_name == 'task_log':
+                id_clm, session_clm, eligible_clm = 'study_id', 'session_name', 'study_id'
+            elif tbl_name == 'action_log':
+                id_clm, session_clm, eligible_clm = 'participant_id', 'session_name', 'participant_id'
+            else:
+                id_clm, session_clm, eligible_clm = 'participant_id', 'session', 'participant_id'
+
+            if id_clm not in columns or session_clm not in columns:
+                print("The table {} has no {} or {} column, it is not checked".format(tbl_name, id_clm, session_clm))
+                continue
+
+            freq_selects.append("select '{0}' as table_name, count(distinct {1}) as freq, count(distinct {2}) as count_session from {0} "
+                                "where {1} in (select {3} from eligible)".format(tbl_name, id_clm, session_clm, eligible_clm))
+            #task_log has many rows per session, its duplications are the ones of the task_log query above
+            if tbl_name != 'task_log':
+                dup_selects.append("select '{0}' as table_name, {1} as id, {2} as session, count(*) as dup from {0} "
+                                   "where {1} in (select {3} from eligible) group by {1}, {2} having count(*) > 1".format(tbl_name, id_clm, session_clm, eligible_clm))
+
+        table_freq = pd.DataFrame(columns=['table_name', 'freq', 'count_session'])
+        table_dup = pd.DataFrame(columns=['table_name', 'id', 'session', 'dup'])
+        if len(freq_selects) > 0:
+            query = ELIGIBLE_PARTICIPANTS_CTE + " union all ".join(freq_selects) + ";"
+            table_freq = self.instrumentation.read_sql(query, mydb, 'batched_table_checks', params=[study_name])
+        if len(dup_selects) > 0:
+            query = ELIGIBLE_PARTICIPANTS_CTE + " union all ".join(dup_selects) + ";"
+            table_dup = self.instrumentation.read_sql(query, mydb, 'batched_table_checks', params=[study_name])
+
+        #same report as per_table_checks, one block per table
+        for tbl_name in tbl_names:
+            data = tasklog_freq[tasklog_freq.task_name == tbl_name]
+            if data.shape[0] > 0 and data['freq'].values[0] > 0:
+                print("The name of the table is: {} \nthe frequency values: {} \nthe number of sessions:  {}".format(tbl_name,data['freq'].values[0],data['sessions'].values[0]))
+                print("--------------------------------------")
+
+            data = tasklog_dup[tasklog_dup.task_name == tbl_name]
+            if data.shape[0] > 0:
+                print("The name of the table is: {} \nthe study_id: {} \nthe session:  {} \nthe number of duplications:  {}".format(tbl_name,data['study_id'].values[0],data['session_name'].values[0], data['count'].values[0]))
+                print("--------------------------------------")
+
+            data = table_freq[table_freq.table_name == tbl_name]
+            if data.shape[0] > 0:
+                print("The name of the table is: {} \nthe frequency: {} \nthe number of sessions:  {} ".format(tbl_name,data['freq'].values[0],data['count_session'].values[0]))
+                print("--------------------------------------")
+
+            data = table_dup[table_dup.table_name == tbl_name]
+            if data.shape[0] > 0:
+                print("The name of the table is: {} \nthe participant/study id: {} \nthe number of sessions:  {} \nthe number of duplication: {} ".format(tbl_name,data['id'].values[0],data['session'].values[0], data['dup'].values[0]))
+                print("--------------------------------------")
+
+        #summary with one row per table
+        data_summary = pd.DataFrame({'table_name': tbl_names})
+        data_summary = data_summary.merge(tasklog_freq.rename(columns={'task_name': 'table_name', 'freq': 'tasklog_freq', 'sessions': 'tasklog_sessions'}),
+                                          on='table_name', how='left')
+        data_summary = data_summary.merge(tasklog_dup.groupby('task_name').size().rename('tasklog_duplicates').reset_index().rename(columns={'task_name': 'table_name'}),
+                                          on='table_name', how='left')
+        data_summary = data_summary.merge(table_freq.rename(columns={'freq': 'table_freq', 'count_session': 'table_sessions'}),
+                                          on='table_name', how='left')
+        data_summary = data_summary.merge(table_dup.groupby('table_name').size().rename('table_duplicates').reset_index(),
+                                          on='table_name', how='left')
+
+        self.data_summary = data_summary
+
+        return data_summary
+
 
     def study_structure(self):
         '''
-        
+        Loads the study protocols (study_protocols.json or --protocols) once.
+        Each session of each study has date-versioned task sequences, see
+        study_protocols. The latest versions are also kept in
+        study_session_order.
+
+        Based on the MT Program Schedule files for TET,GIDI,KAISER,SPANISH.
+        If the structure changes throughout a study, a new version is added
+        to the protocol file with the date it took effect.
+
         Returns
         -------
-        study_session_order : TYPE
-            DESCRIPTION.
+        study_session_order : OrderedDict
+            study -> session -> latest list of tasks.
 
         '''
-        
-        
-        #TODO: change to the parameter for maintanence
-        '''
-        We are going to hardcode the study structure
-        
-        Based on the MT Program Schedule files for TET,GIDI,KAISER,SPANISH
-        
-        If it changes throughout the study for some reason then we will have to adjust the code as well
-        
-        Important changes affecting study order for TET and GIDI
-        Taken from the Issues and Changes Log
-        
-        #4/7/2020 TET study Launched
-        #4/23/2020 Covid-19 questionnaire added preTest
-        #5/8/2020 OA added to eligibility
-        #5/12/2020 OA is removed from preTest
-        #7/10/2020 GIDI study launched
-        #12/07/2020 GIDI study disabled, no new accounts can be created
-        '''
-        study_session_order = self.study_session_order
-        study_name = 'TET'
-        study_session_order[study_name] = self.TET_structure()
-        study_name = 'GIDI'
-        study_session_order[study_name] = self.GIDI_structure()
-        study_name = 'Kaiser'
-        study_session_order[study_name] = self.Kaiser_structure()
-        study_name = 'spanish'
-        study_session_order[study_name] = self.Spanish_structure()
-        
-       
-        
-        self.study_session_order = study_session_order
-        
-        return study_session_order
-        
+
+        protocols = protocol_registry(self.protocols_file)
+
+        self.protocols = protocols
+        self.study_session_order = protocols.structure()
+
+        return self.study_session_order
+
     #TODO: there is no participant ID in tasklog table
-    def step2(self):
+    def step2(self, taslog_data=None):
         '''
         
 
+        Parameters
+        ----------
+        taslog_data : DataFrame, optional
+            task log to check, the task_log table by default.
+
         Returns
         -------
-        flagged_ps_session : TYPE
-            DESCRIPTION.
+        flagged_ps_session : flagged_report
+            flagged participant session orders and participant sessions.
 
         '''
         
         dataset_dfs = self.dataset_dfs
         study_session_order = self.study_session_order
+        protocols = self.protocols
         study_to_check = self.study
         
-        taslog_data = dataset_dfs['task_log']
+        taslog_data = dataset_dfs['task_log'] if taslog_data is None else taslog_data
         
         #we create a new column named Task
         #combined the tag with the task_name, it only affects the Affect task name. Changes it to preAffect of postAffect
-        taslog_data["Task"] = taslog_data["tag"].fillna('') + taslog_data["task_name"]
+        taslog_data["Task"] = taslog_data["tag"].astype(object).fillna('') + taslog_data["task_name"].astype(object)
         
         print(taslog_data.columns)
         
@@ -407,12 +646,21 @@ class data_integrity:
         
         #take into account all sessions except Eligibility
         sub_tasklog_data = sub_tasklog_data[sub_tasklog_data["session_name"] != "Eligibility"]
+
+        #participants in id order and their sessions and tasks in completion order, instead of the row order of the task log
+        if self.step2_order == 'date_completed':
+            sub_tasklog_data = sub_tasklog_data.sort_values(by=['participantID', 'date_completed'], kind='stable')
+
+        #expected sequences compiled once per study, session and protocol version (see sequence_index)
+        vocabulary = study_vocabulary(study_session_order, set(sub_tasklog_data["Task"].unique()) | protocols.all_tasks(), sub_tasklog_data["session_name"].unique())
+        sequences = sequence_index(protocols, vocabulary)
+        sub_tasklog_data = sub_tasklog_data.assign(task_code=vocabulary.encode_tasks(sub_tasklog_data["Task"]))
         
         #store distinct participant IDs found in the task log
         participant_ids = sub_tasklog_data["participantID"].unique()
         
-        #list to add participant ids and sessions that do not match study task sequence order
-        flagged_ps_session = list()
+        #participant ids and sessions that do not match study task sequence order
+        flagged_ps_session = flagged_report(vocabulary)
         
         checking_tasklog_data = sub_tasklog_data
         # loop over each participant in study
@@ -441,20 +689,16 @@ class data_integrity:
             #if the participant session order is not the same as the study session order then flag
             #checking to see if the participant skipped a session
             if not np.array_equal(p_sessions_array, study_sessions_array[:lenght_p_sessions]):
-                # difference between the two sets, set1 - set2
-                diff1 = np.setdiff1d(p_sessions_array, study_sessions_array[:lenght_p_sessions])
-        
-                # difference between the two sets, set2- set1
-                diff2 = np.setdiff1d(study_sessions_array[:lenght_p_sessions], p_sessions_array)
-        
-                #store in list
-                differences = [diff1, diff2]
+                #sessions of the participant and of the study as masks of their codes
+                p_session_codes = vocabulary.encode_sessions(p_sessions_array)
+                p_mask = codes_mask(p_session_codes)
+                study_mask = codes_mask(vocabulary.encode_sessions(study_sessions_array[:lenght_p_sessions]))
         
                 #calculate the difference between the two arrays
                 length_diff = lenght_p_sessions - len(study_sessions_array[:lenght_p_sessions])
         
-                #append information to flagged list
-                flagged_ps_session.append([p,study_id, "SessionOrder", length_diff, differences[0], differences[1], None, study_sessions_array, p_sessions_array])
+                #differences between the two sets, set1 - set2 and set2 - set1, are added to the report
+                flagged_ps_session.add(p, study_id, SESSION_ORDER, length_diff, p_mask & ~study_mask, study_mask & ~p_mask, None, study_sessions_array, p_session_codes)
         
             #loop over each session that the participant has completed or is currently working on
             for session in p_sessions:
@@ -464,136 +708,787 @@ class data_integrity:
                 #order the values based on completion date
                 p_session_tasks.sort_values(by=['date_completed'], ascending=True)
         
-                #store ordered task in array
-                p_ordered_tasks = np.array(p_session_tasks["Task"])
-        
-                #calculate the length of the array
-                length_tasks = len(p_ordered_tasks)
-        
                 #get the max date from the tasks that were completed in a session
-                #we will use this to check with the dates when changes were made to the study session task structure
+                #we use it to pick the version of the session task structure in effect at that date
                 max_date = p_session_tasks.date_completed.max()
+                sequence = sequences.sequence(study_to_check, session, max_date)
+                p_task_codes = p_session_tasks["task_code"].tolist()
         
-                #check to see if participant task array matches the study ordered task array
-                #if not flag participant id and session
-                if not np.array_equal(p_ordered_tasks, study_session_order[study_to_check][session][:length_tasks]):
-                    #difference between the two sets, set1 - set2
-                    diff1 = np.setdiff1d(p_ordered_tasks, study_session_order[study_to_check][session][:length_tasks])
-        
-                    #difference between the two sets, set2- set1
-                    diff2 = np.setdiff1d(study_session_order[study_to_check][session][:length_tasks], p_ordered_tasks)
+                #walk the expected sequence, optional tasks of the version are skipped
+                #if the participant leaves it flag participant id and session
+                if sequence.walk(p_task_codes) >= 0:
+                    #differences between the two sets, set1 - set2 and set2 - set1, as masks of the task codes
+                    length_diff, extra_mask, missing_mask = sequence.difference_masks(p_task_codes)
         
-                    #store in list
-                    differences = [diff1, diff2]
-        
-                    #calculate the difference between the two arrays
-                    length_diff = length_tasks - len(study_session_order[study_to_check][session][:length_tasks])
-        
-                    #append information to flagged list
-                    flagged_ps_session.append([p,study_id, session, length_diff, differences[0], differences[1], max_date, study_session_order[study_to_check][session][:], p_ordered_tasks])
+                    #append information to flagged report
+                    flagged_ps_session.add(p, study_id, session, length_diff, extra_mask, missing_mask, max_date, sequence.tasks, p_task_codes)
                     
         
         self.flagged_ps_session = flagged_ps_session
-        
+
         return flagged_ps_session
+
+    def step2_groupby(self, taslog_data=None):
+        '''
+        Vectorized version of step2, see check_task_log. The flagged rows
+        have the same layout and order as the ones returned by step2.
+
+        Parameters
+        ----------
+        taslog_data : DataFrame, optional
+            task log to check, the task_log table by default.
+
+        Returns
+        -------
+        flagged_ps_session : flagged_report
+            one row per flagged participant session order or participant session.
+
+        '''
+
+        taslog_data = self.dataset_dfs['task_log'] if taslog_data is None else taslog_data
+        flagged_ps_session, vocabulary = check_task_log(taslog_data, self.protocols, self.study, self.step2_order)
+
+        self.vocabulary = vocabulary
+        self.flagged_ps_session = flagged_ps_session
+
+        return flagged_ps_session
+
+    def step2_parallel(self, taslog_data=None):
+        '''
+        Runs check_task_log in a process pool of --jobs workers. The
+        participants of each study are split in --jobs shards, every shard
+        is checked by one worker and the flagged rows are merged in shard
+        order. With --study all every study of the study table is checked
+        and each flagged row ends with the study it belongs to.
+
+        Parameters
+        ----------
+        taslog_data : DataFrame, optional
+            task log to check, the task_log table by default.
+
+        Returns
+        -------
+        flagged_ps_session : flagged_report
+            flagged participant sessions, with the study of every row.
+
+        '''
+
+        dataset_dfs = self.dataset_dfs
+        study_session_order = self.study_session_order
+
+        taslog_data = dataset_dfs['task_log'] if taslog_data is None else taslog_data
+        selected_clms = ["study_id","participantID","date_completed","session_name","tag","task_name"]
+
+        #study of every task_log row, from the task log itself or from the study table
+        if self.study != 'all':
+            studies = pd.Series(self.study, index=taslog_data.index)
+        elif 'study_extension' in taslog_data.columns:
+            studies = taslog_data['study_extension']
+        else:
+            study_data = dataset_dfs['study']
+            studies = taslog_data['study_id'].map(pd.Series(study_data['study_extension'].values, index=study_data['id'].values))
+
+        #one shard is a study and a contiguous block of its participants, in order of first appearance
+        shards = []
+        for study in pd.unique(studies.dropna()):
+            if study not in study_session_order:
+                print("There is no study structure for {}, it is not checked".format(study))
+                continue
+            study_tasklog = taslog_data.loc[(studies == study).values, selected_clms]
+            #in completion order the shards are ranges of participant ids, the merged rows stay in id order
+            p_codes, participant_ids = pd.factorize(study_tasklog["participantID"], sort=(self.step2_order == 'date_completed'))
+            shard_ids = p_codes * self.jobs // max(len(participant_ids), 1)
+            for shard_id in range(self.jobs):
+                shard = study_tasklog[shard_ids == shard_id]
+                if shard.shape[0] > 0:
+                    shards.append((study, shard))
+
+        #the study protocols are sent once to every worker, the shards are sent one by one
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=init_step2_worker, initargs=(self.protocols, self.step2_order)) as executor:
+            results = list(executor.map(check_step2_shard, shards))
+
+        #the shards are checked with their own vocabulary, concat translates their codes
+        flagged_ps_session = flagged_report.concat(results, studies=[study for study, shard in shards])
+
+        self.flagged_ps_session = flagged_ps_session
+
+        return flagged_ps_session
+
+    def step2_incremental(self, taslog_data=None):
+        '''
+        Runs check_task_log only for the participants with task_log rows
+        added since the last run. The checkpoint (--checkpoint) keeps the
+        largest task_log id and date_completed seen, the order of the
+        participants and the flagged rows of every participant; the flagged
+        rows of the participants without new rows are taken from it. If the
+        study or its structure changed, every participant is checked again.
+        The task log only has the eligible participants of the study: the
+        participants that left it (e.g. flagged as test accounts since the
+        last run) are dropped from the checkpoint, and the ones the
+        checkpoint does not know are checked.
+
+        Parameters
+        ----------
+        taslog_data : DataFrame, optional
+            task log to check, the task_log table by default.
+
+        Returns
+        -------
+        flagged_ps_session : flagged_report
+            flagged participant sessions, same as step2_groupby.
+
+        '''
+
+        taslog_data = self.dataset_dfs['task_log'] if taslog_data is None else taslog_data
+        study_to_check = self.study
+
+        #the verdicts are only valid for the same study structure
+        structure_key = hashlib.sha1(self.protocols.fingerprint(study_to_check).encode()).hexdigest()
+
+        checkpoint = None
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint, 'rb') as f:
+                checkpoint = pickle.load(f)
+            if checkpoint['study'] != study_to_check or checkpoint['structure_key'] != structure_key:
+                print("The checkpoint is for another study or study structure, every participant is checked")
+                checkpoint = None
+            elif checkpoint.get('step2_order', 'rows') != self.step2_order:
+                #the tasks of the verdicts were taken in another order
+                print("The checkpoint was written with --step2_order {}, every participant is checked".format(checkpoint.get('step2_order', 'rows')))
+                checkpoint = None
+            elif checkpoint.get('version') != CHECKPOINT_VERSION:
+                print("The checkpoint was written by an older version, every participant is checked")
+                checkpoint = None
+
+        if checkpoint is None:
+            checkpoint = {'version': CHECKPOINT_VERSION, 'study': study_to_check, 'structure_key': structure_key, 'step2_order': self.step2_order,
+                          'max_id': None, 'max_date': None, 'participant_order': [], 'verdicts': {}}
+
+        #rows added since the last run, by id when the task log has one and by completion date otherwise
+        if checkpoint['max_id'] is not None and 'id' in taslog_data.columns:
+            new_rows = (taslog_data['id'] > checkpoint['max_id']).values
+        elif checkpoint['max_date'] is not None:
+            new_rows = (taslog_data['date_completed'] > checkpoint['max_date']).values
+        else:
+            new_rows = np.ones(taslog_data.shape[0], dtype=bool)
+
+        #participants in the order of their first task_log row, the ones that are not eligible any more keep no verdict, like in a full run
+        participant_order = list(pd.unique(taslog_data['participantID'].dropna()))
+        eligible = set(participant_order)
+        known = set(p for p in checkpoint['participant_order'] if p in eligible)
+        for p in [p for p in checkpoint['verdicts'] if p not in eligible]:
+            del checkpoint['verdicts'][p]
+
+        #every row of the touched participants is checked again, the session order depends on all of them,
+        #participants that became eligible since the last run have no new rows but are not in the checkpoint
+        new_participants = pd.unique(taslog_data.loc[new_rows, 'participantID'].dropna())
+        touched_rows = (taslog_data['participantID'].isin(new_participants) | ~taslog_data['participantID'].isin(known)).values & \
+            taslog_data['participantID'].notna().values
+        touched = pd.unique(taslog_data.loc[touched_rows, 'participantID'])
+        flagged, vocabulary = check_task_log(taslog_data[touched_rows], self.protocols, study_to_check, self.step2_order)
+        print("{} of {} task_log rows are new, {} participants checked again".format(new_rows.sum(), taslog_data.shape[0], len(touched)))
+
+        #flagged rows of every touched participant, none if the participant is not flagged any more
+        verdicts = checkpoint['verdicts']
+        for p in touched:
+            verdicts.pop(p, None)
+        flagged_rows = defaultdict(list)
+        for i, p in enumerate(flagged.participants):
+            flagged_rows[p].append(i)
+        for p, rows in flagged_rows.items():
+            verdicts[p] = flagged.take(rows)
+
+        checkpoint['participant_order'] = participant_order
+
+        if taslog_data.shape[0] > 0:
+            if 'id' in taslog_data.columns:
+                checkpoint['max_id'] = taslog_data['id'].max()
+            checkpoint['max_date'] = taslog_data['date_completed'].max()
+
+        with open(self.checkpoint, 'wb') as f:
+            pickle.dump(checkpoint, f)
+
+        #in completion order the other engines report the participants in id order
+        if self.step2_order == 'date_completed':
+            participant_order = sorted(participant_order)
+        flagged_ps_session = flagged_report.concat([verdicts[p] for p in participant_order if p in verdicts])
+        if flagged_ps_session.vocabulary is None:
+            flagged_ps_session.vocabulary = vocabulary
+
+        self.vocabulary = vocabulary
+        self.flagged_ps_session = flagged_ps_session
+
+        return flagged_ps_session
+
+    def run_step2(self, taslog_data=None):
+        '''
+        Runs the step 2 engine selected with --step2_engine: incrementally
+        with --checkpoint, in a process pool for --study all or --jobs larger
+        than 1.
+
+        Parameters
+        ----------
+        taslog_data : DataFrame, optional
+            task log to check, the task_log table by default.
+
+        Returns
+        -------
+        flagged_ps_session : flagged_report
+            flagged participant sessions.
+
+        '''
+
+        if self.step2_engine == 'loop':
+            return self.step2(taslog_data)
+
+        #only the participants with new task_log rows are checked
+        if self.checkpoint is not None and self.study != 'all':
+            return self.step2_incremental(taslog_data)
+
+        #all the studies or several workers go through the process pool
+        if self.study == 'all' or self.jobs > 1:
+            return self.step2_parallel(taslog_data)
+
+        return self.step2_groupby(taslog_data)
+
+
+
+    def final_touch_step2(self, flagged_ps_session):
         
         
-        
-    def final_touch_step2(self, report_df):
-        
-        
-        report_df = report_df
         study_to_check = self.study
         
-        #change date column to datetime type
-        report_df['Last_Date'] = pd.to_datetime(report_df['Last_Date'])
-        #change array difference to string type
+        #the report is expanded to names only now: Last_Date as datetime, the differences and sequences as strings
         #mainly to avoid errors when using these columns later on
-        report_df['Diff_P_S'] = report_df['Diff_P_S'].astype(str)
-        report_df['Diff_S_P'] = report_df['Diff_S_P'].astype(str)
-        
-        #the current code will flag participans in TET since changes to the study structure were made throughout the course of the study
-        #we could also ignore this and just identify in the report file that the flag p is appearing because of the changes in the study structure
-        #for now TET is the only study where we have to do this
-        if study_to_check == "TET":
-            #4/7/2020 TET study Launched
-            #4/23/2020 Covid-19 questionnaire added preTest
-            #5/8/2020 OA added to eligibility
-            #5/12/2020 OA is removed from preTest
-            #7/10/2020 GIDI study launched
-            #12/07/2020 GIDI study disabled, no new accounts can be created
-        
-            #7/10/2020 GIDI study launched
-            #participants who started TET before GIDI launched and therefore do not have GIDI in their tasks for the first session
-            report_index = np.array(report_df[(report_df["Diff_S_P"] == "['Gidi']") & (
-                        report_df["Diff_P_S"] == "['ReturnIntention']") & (report_df["Last_Date"] < "2020-08-10")].index)
-        
-            #remove those cases from list
-            report_df = report_df.drop(report_index)
-        
-            #12/07/2020 GIDI study disabled, no new accounts can be created
-            #participants who enrolled in TET after GIDI study disabled and therefore do not have GIDI in their tasks for the first session
-            report_index_2 = np.array(report_df[(report_df["Diff_S_P"] == "['Gidi']") & (
-                        report_df["Diff_P_S"] == "['ReturnIntention']") & (report_df["Last_Date"] > "2020-12-07")].index)
-        
-            #remove those cases from list
-            report_df = report_df.drop(report_index_2)
-        
-            #participants who started TET with OA in preTest which was removed on 5/12/2020 and COVID 19 Q which was added on 4/23/2020. Remove any flagged id before 4/23/2020
-            #since they are supposed to have OA and no Covid19 Q
-            report_index_3 = np.array(report_df[
-                                          (report_df["Diff_S_P"] == "['Covid19']") & (report_df["Diff_P_S"] == "['OA']") & (
-                                                      report_df["Last_Date"] < "2020-04-23")].index)
-            #remove those cases from list
-            report_df = report_df.drop(report_index_3)
-        
-            #5/12/2020 OA is removed from preTest
-            report_index_4 = np.array(
-                report_df[(report_df["Diff_P_S"] == "['OA']") & (report_df["Last_Date"] < "2020-05-12")].index)
-        
-            #remove those cases from list
-            report_df = report_df.drop(report_index_4)
+        report_df = flagged_ps_session.to_frame()
         
+        #changes to the study structures over the course of a study (e.g. Gidi in the TET firstSession from 8/10/2020 to 12/7/2020,
+        #OA in the TET preTest until 5/12/2020) are versions of the protocol in study_protocols.json and are handled by the check itself
 
         return report_df
         
      
+    def participant_study(self):
+        '''
+        participant id -> study_id of the eligible participants (non-test,
+        non-admin) of the study, of every study with --study all.
+
+        Returns
+        -------
+        participant_study : Series
+
+        '''
+
+        return self.eligible_participants().participant_study(self.study)
+
+    def eligible_participants(self):
+        '''
+        Index of the eligible participants of every study, built from the
+        participant and study tables the first time it is used and shared
+        by the checks of the run, see participant_index.
+
+        Returns
+        -------
+        eligible : participant_index
+
+        '''
+
+        if self.eligible is None:
+            self.eligible = participant_index.from_tables(self.dataset_dfs)
+
+        return self.eligible
+
     def task_log_and_taskname(self):
+        '''
+        Duplicated questionnaires of the eligible participants (non-test,
+        non-admin) of the study, in task_log and in the questionnaire tables.
+        task_log is grouped once by (task_name, study_id, session_name) and
+        every questionnaire table once by (participant_id, session), the
+        duplicates of the tables are mapped to the study_id of the
+        participant and both are joined on (task_name, study_id, session).
+
+        Returns
+        -------
+        duplicated_tasks : DataFrame
+            one row per duplicated (task_name, study_id, session) with the
+            number of rows in task_log and in the questionnaire table, 0 when
+            the duplication is only on one side.
+
+        '''
         
         dataset_dfs = self.dataset_dfs
-        study_to_check = self.study
-        
-        #extract the study specific participants
-        participant_data = dataset_dfs['participant']
-        participant_data = participant_data.query("test_account == 0 and admin == 0")
-        
-        study_data = dataset_dfs['study']
-        study_data = study_data[study_data.id.isin(participant_data.study_id.values)]
-        study_data = study_data.query('study_extension == {}'.format(repr(study_to_check)))
-        
-        taskLog_data = dataset_dfs['task_log']
-        taskLog_data = taskLog_data[taskLog_data.study_id.isin(study_data.id.values)]
 
-        participant_session_task = []
-        duplicated_tasks_taskLog = []
-        duplicated_tasks = []
+        #participant -> study_id and back, built once for all the tables
+        eligible = self.eligible_participants()
+        participant_study = eligible.participant_study(self.study)
+        study_participant = pd.Series(participant_study.index, index=participant_study.values)
+        study_participant = study_participant[~study_participant.index.duplicated()]
+        
+        taskLog_data = read_columns(dataset_dfs, 'task_log', ['study_id', 'session_name', 'task_name'])
+        #task names are matched without case, like the SQL checks on MySQL
+        taskLog_data = taskLog_data.assign(task_name=questionnaire_task_names(taskLog_data.task_name, QUESTIONNAIRE_TABLES).values)
+        taskLog_data = taskLog_data[eligible.has_study_id(taskLog_data.study_id, self.study) & taskLog_data.task_name.notna().values]
+
+        #Affect has a pre and a post row in the same session, it is not a duplication (it is skipped in runSQL.py too)
+        taskLog_data = taskLog_data[taskLog_data.task_name != 'Affect']
+
+        #one pass over task_log for all the questionnaires
+        tasklog_count = taskLog_data.groupby(['task_name', 'study_id', 'session_name'], observed=True).size()
+        duplicated_tasks_taskLog = tasklog_count[tasklog_count > 1].rename('task_log_count').reset_index().rename(columns={'session_name': 'session'})
+
+        #one pass over each questionnaire table
+        duplicated_tables = []
+        for task_name, tbl_name in QUESTIONNAIRE_TABLES.items():
+            if task_name == 'Affect' or tbl_name not in dataset_dfs.keys():
+                continue
+            table_data = read_columns(dataset_dfs, tbl_name, ['participant_id', 'session'])
+            table_data = table_data[eligible.has_participant(table_data.participant_id, self.study)]
+            table_count = table_data.groupby(['participant_id', 'session'], observed=True).size()
+            table_count = table_count[table_count > 1].rename('table_count').reset_index()
+            if table_count.shape[0] > 0:
+                table_count.insert(0, 'task_name', task_name)
+                table_count.insert(1, 'table_name', tbl_name)
+                table_count.insert(2, 'study_id', table_count.participant_id.map(participant_study).values)
+                duplicated_tables.append(table_count)
+
+        if len(duplicated_tables) > 0:
+            duplicated_tasks_table = pd.concat(duplicated_tables, ignore_index=True)
+        else:
+            duplicated_tasks_table = pd.DataFrame(columns=['task_name', 'table_name', 'study_id', 'participant_id', 'session', 'table_count'])
+
+        #single report, a duplication found only on one side has a 0 count on the other
+        duplicated_tasks = duplicated_tasks_taskLog.merge(duplicated_tasks_table, on=['task_name', 'study_id', 'session'], how='outer')
+        duplicated_tasks['table_name'] = duplicated_tasks['task_name'].map(QUESTIONNAIRE_TABLES)
+        duplicated_tasks['participant_id'] = duplicated_tasks['participant_id'].fillna(duplicated_tasks['study_id'].map(study_participant)).astype('Int64')
+        duplicated_tasks[['task_log_count', 'table_count']] = duplicated_tasks[['task_log_count', 'table_count']].fillna(0).astype(int)
+        duplicated_tasks = duplicated_tasks[['task_name', 'table_name', 'study_id', 'participant_id', 'session', 'task_log_count', 'table_count']]
+        duplicated_tasks = duplicated_tasks.sort_values(by=['task_name', 'study_id', 'session'], kind='stable').reset_index(drop=True)
+
+        print(duplicated_tasks)
+
+        self.flagg_study_id = duplicated_tasks.study_id.unique()
         
-        for task_name in dataset_dfs.keys():
-            
-            print(task_name)
-            tmp_tasklog_task = taskLog_data[taskLog_data.task_name == task_name]
-            
-            # add them to the flag participants 
-            duplicated_rows = tmp_tasklog_task[tmp_tasklog_task.duplicated(['study_id', 'session_name'], keep=False)]
-            if duplicated_rows.shape[0] > 0:
-                duplicated_tasks_taskLog.append(duplicated_rows)
-                
-        flagg_study_id = duplicated_tasks_taskLog.study_id.unique()
-        
-        return duplicated_tasks_taskLog
-    
-def parse_args():
+        return duplicated_tasks
+
+
+    def reconcile_task_log(self):
+        '''
+        Matrix of (participant, session, task) -> in task_log, in the
+        questionnaire table and number of rows on each side, see
+        reconciliation. Replaces the per table queries of runSQL.py and
+        tables-dataIntegrity.sql with one pass over task_log and one over
+        each questionnaire table.
+
+        Returns
+        -------
+        reconciliation : DataFrame
+
+        '''
+
+        dataset_dfs = self.dataset_dfs
+
+        participant_study = self.participant_study()
+        task_log = read_columns(dataset_dfs, 'task_log', ['study_id', 'session_name', 'task_name'])
+        tables = {tbl_name: read_columns(dataset_dfs, tbl_name, ['participant_id', 'session'])
+                  for tbl_name in QUESTIONNAIRE_TABLES.values() if tbl_name in dataset_dfs.keys()}
+
+        reconciliation = reconcile(task_log, participant_study, tables, QUESTIONNAIRE_TABLES)
+
+        #participant sessions where task_log and the table do not agree
+        mismatch = reconciliation[reconciliation.task_log_count != reconciliation.table_count]
+        print("{} of {} (participant, session, task) do not match between task_log and the questionnaire tables".format(mismatch.shape[0], reconciliation.shape[0]))
+        print(mismatch.groupby('table_name').size())
+
+        self.reconciliation = reconciliation
+
+        return reconciliation
+
+    def load_tables(self):
+        '''
+        Tables shared by the steps of the run. They are fetched (and checked
+        against the database, see get_data_tables) by the first step that
+        needs them, the next steps use the same tables.
+
+        Returns
+        -------
+        dataset_dfs : OrderedDict, spilled_tables or snapshot_cache
+
+        '''
+
+        if self.tables_loaded:
+            return self.dataset_dfs
+
+        if not self.offline and self.mydb == '':
+            self.connect_database()
+        with self.instrumentation.stage('get_data_tables'):
+            self.get_data_tables()
+        self.tables_loaded = True
+
+        return self.dataset_dfs
+
+    def step2_task_log(self):
+        '''
+        Task log checked by step 2: the CSV or Arrow export of
+        --task_log_csv, read like in MindTrails_DataIntegrity_Step2.py (see
+        task_log_io), or the task_log table of
+        the shared tables restricted to the eligible participants of the
+        study, like the export query of MindTrails_DataIntegrity_Step2.py.
+
+        Returns
+        -------
+        taslog_data : DataFrame
+
+        '''
+
+        if self.task_log_csv is not None:
+            #id for the checkpoint of step2_incremental, study_extension for --study all
+            taslog_data = read_task_log(self.task_log_csv, ['id'] + TASK_LOG_COLUMNS + ['study_extension'])
+            if self.planner is not None:
+                taslog_data = compact_dtypes(taslog_data)
+            return taslog_data
+
+        dataset_dfs = self.load_tables()
+        if 'task_log' not in dataset_dfs.keys():
+            raise ValueError("there is no task_log table for {}, export the task log of the study and pass it with --task_log_csv".format(self.study))
+
+        eligible = self.eligible_participants()
+        participant_study = eligible.participant_study(self.study)
+        taslog_data = dataset_dfs['task_log']
+        taslog_data = taslog_data[eligible.has_study_id(taslog_data.study_id, self.study)]
+
+        #select * of task_log has no participant id, it is the participant of the study_id
+        if 'participantID' not in taslog_data.columns:
+            study_participant = pd.Series(participant_study.index, index=participant_study.values)
+            study_participant = study_participant[~study_participant.index.duplicated()]
+            taslog_data = taslog_data.assign(participantID=taslog_data.study_id.map(study_participant).values)
+
+        return taslog_data
+
+    def report_path(self, step, name):
+        '''
+        <output_dir>/<study>_<date>_DataIntegrity<step>_<name>.csv, the
+        output directory is created if needed.
+        '''
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        return os.path.join(self.output_dir, '{}_{}_DataIntegrity{}_{}.csv'.format(self.study, time.strftime("%Y%m%d"), step, name))
+
+    def step1_tables(self):
+        '''
+        Step 1: fetches the tables and runs the per table checks, the
+        summary of the batched checks is saved to the output directory.
+
+        Returns
+        -------
+        data_summary : DataFrame
+            empty in per_table query mode, the checks are printed.
+
+        '''
+
+        self.load_tables()
+
+        if self.data_summary.shape[0] > 0:
+            self.data_summary.to_csv(self.report_path('S1', 'Report'), index=False)
+
+        return self.data_summary
+
+    def step2_report(self):
+        '''
+        Step 2: checks the task order of every participant session against
+        the study protocols and saves the report of the flagged participant
+        sessions to the output directory.
+
+        Returns
+        -------
+        report_df : DataFrame
+
+        '''
+
+        if self.protocols is None:
+            self.study_structure()
+
+        taslog_data = self.step2_task_log()
+        with self.instrumentation.stage('step2'):
+            flagged_ps_session = self.run_step2(taslog_data)
+
+        #store flagged information in df, the parallel engine adds the study of each row
+        report_df = self.final_touch_step2(flagged_ps_session)
+        print(report_df.describe())
+
+        #save report to CSV file
+        report_df.to_csv(self.report_path('S2', 'Report'), index=False)
+
+        self.report = report_df
+
+        return report_df
+
+    def step3_reconciliation(self):
+        '''
+        Step 3: duplicated questionnaires and reconciliation of task_log
+        with the questionnaire tables, both saved to the output directory.
+
+        Returns
+        -------
+        duplicated_tasks : DataFrame
+        reconciliation : DataFrame
+
+        '''
+
+        self.load_tables()
+
+        with self.instrumentation.stage('task_log_and_taskname'):
+            duplicated_tasks = self.task_log_and_taskname()
+        with self.instrumentation.stage('reconcile_task_log'):
+            reconciliation = self.reconcile_task_log()
+
+        duplicated_tasks.to_csv(self.report_path('S3', 'Duplicates'), index=False)
+        reconciliation.to_csv(self.report_path('S3', 'Reconciliation'), index=False)
+
+        return duplicated_tasks, reconciliation
+
+    def run_tasks(self, tasks):
+        '''
+        Runs the steps of --task in the order of TASKS, the tables are
+        loaded once and shared by the steps.
+
+        Parameters
+        ----------
+        tasks : list
+            steps to run, among step1, step2 and step3.
+
+        Returns
+        -------
+        results : OrderedDict
+            step -> what the step returns.
+
+        '''
+
+        steps = {'step1': self.step1_tables, 'step2': self.step2_report, 'step3': self.step3_reconciliation}
+
+        results = OrderedDict()
+        for task in TASKS:
+            if task in tasks:
+                print("--------------------------------------")
+                print("Data integrity {}".format(task))
+                results[task] = steps[task]()
+
+        return results
+
+
+#study protocols and task order of the step 2 workers, set once per worker process by init_step2_worker
+worker_protocols = None
+worker_order = 'rows'
+
+
+def check_task_log(taslog_data, protocols, study_to_check, order='rows'):
+    '''
+    Checks the task log of one study against its study structure. Instead of
+    masking the task log once per participant and once per session like
+    step2, the task log is sorted once by participant and every
+    (participantID, session_name) group is checked with array operations on
+    small integer codes of the tasks and sessions (see study_encoding),
+    against the protocol version in effect at the last completion date of
+    the group (see study_protocols).
+
+    Parameters
+    ----------
+    taslog_data : DataFrame
+        task log with study_id, participantID, date_completed, session_name,
+        tag and task_name.
+    protocols : protocol_registry
+        date-versioned study protocols.
+    study_to_check : str
+        study of the task log.
+    order : str, optional
+        'rows' takes the sessions and tasks of a participant in the row
+        order of the task log, like step2 (the export has to be sorted by
+        completion date). 'date_completed' sorts the task log once, stably,
+        by participantID and date_completed: the participants are checked in
+        id order and their sessions and tasks in completion order.
+
+    Returns
+    -------
+    flagged_ps_session : flagged_report
+        one row per flagged participant session order or participant session,
+        in the same order as step2.
+    vocabulary : study_vocabulary
+        codes of the tasks and sessions.
+
+    '''
+
+    #Task (tag + task_name) and session_name as codes, the Task strings are only built for the distinct (tag, task_name) pairs
+    study_session_order = protocols.structure()
+    vocabulary = study_vocabulary(study_session_order, set(distinct_tasks(taslog_data)) | protocols.all_tasks(), taslog_data["session_name"].unique())
+    sub_tasklog_data = pd.DataFrame({"study_id": taslog_data["study_id"].values,
+                                     "participantID": taslog_data["participantID"].values,
+                                     "date_completed": taslog_data["date_completed"].values,
+                                     "session": vocabulary.encode_sessions(taslog_data["session_name"]),
+                                     "task": encode_task_column(taslog_data, vocabulary)})
+
+    #same filters as step2: no SESSION_COMPLETE, no Eligibility, and rows without participant or session can not be grouped
+    session_complete = vocabulary.encode_tasks(["SESSION_COMPLETE"])[0]
+    eligibility = vocabulary.encode_sessions(["Eligibility"])[0]
+    sub_tasklog_data = sub_tasklog_data[((sub_tasklog_data["task"] != session_complete) | (session_complete < 0)) &
+                                        ((sub_tasklog_data["session"] != eligibility) | (eligibility < 0)) &
+                                        sub_tasklog_data["participantID"].notna() &
+                                        (sub_tasklog_data["session"] >= 0)]
+
+    if order == 'date_completed':
+        #participant code in id order, one stable sort by participant and completion date (missing dates last)
+        p_codes, participant_ids = pd.factorize(sub_tasklog_data["participantID"], sort=True)
+        dates = pd.to_datetime(sub_tasklog_data["date_completed"]).values
+        date_keys = np.where(np.isnat(dates), np.iinfo(np.int64).max, dates.view(np.int64))
+        p_order = np.lexsort((date_keys, p_codes))
+    else:
+        #participant code in order of first appearance, like unique() in step2
+        p_codes, participant_ids = pd.factorize(sub_tasklog_data["participantID"])
+
+        #one stable sort keeps the row order of each participant
+        p_order = np.argsort(p_codes, kind='stable')
+    sub_tasklog_data = sub_tasklog_data.iloc[p_order].reset_index(drop=True)
+    p_codes = p_codes[p_order]
+
+    #group id of each (participant, session) in order of first appearance within the participant
+    group_ids = sub_tasklog_data.groupby([p_codes, sub_tasklog_data["session"].values], sort=False).ngroup().values
+
+    #second stable sort makes every group contiguous while keeping the task order inside the group
+    g_order = np.argsort(group_ids, kind='stable')
+    sub_tasklog_data = sub_tasklog_data.iloc[g_order].reset_index(drop=True)
+    p_codes = p_codes[g_order]
+    group_ids = group_ids[g_order]
+
+    n_groups = group_ids[-1] + 1 if len(group_ids) > 0 else 0
+    group_starts = np.searchsorted(group_ids, np.arange(n_groups + 1))
+    session_codes = sub_tasklog_data["session"].values
+    task_codes = sub_tasklog_data["task"].values
+    group_sessions = session_codes[group_starts[:-1]]
+    group_p_codes = p_codes[group_starts[:-1]]
+
+    #per participant and per group values used in the report and to pick the protocol versions
+    study_ids = sub_tasklog_data.groupby(p_codes)["study_id"].max().values
+    max_dates = sub_tasklog_data.groupby(group_ids)["date_completed"].max().values
+
+    #one protocol row per (session, version) of the study, plus an empty last row for sessions not in the study
+    session_order = study_session_order[study_to_check]
+    study_sessions_array = np.array(list(session_order.keys()))
+    study_session_codes = vocabulary.session_codes[study_to_check]
+    protocol_versions = []
+    first_protocol_row = np.full(len(vocabulary.session_names), -1, dtype=np.int64)
+    for session, code in zip(study_sessions_array, study_session_codes):
+        first_protocol_row[code] = len(protocol_versions)
+        protocol_versions += protocols.versions(study_to_check, session)
+    n_protocol_rows = len(protocol_versions) + 1
+
+    #expected task codes as a padded matrix and optional tasks as a boolean matrix, one row per protocol row
+    max_length = max([len(version['tasks']) for version in protocol_versions] + [1])
+    protocol_lengths = np.zeros(n_protocol_rows, dtype=np.int64)
+    expected_matrix = np.full((n_protocol_rows, max_length), -1, dtype=vocabulary.task_dtype)
+    optional_matrix = np.zeros((n_protocol_rows, len(vocabulary.task_names) + 1), dtype=bool)
+    for row, version in enumerate(protocol_versions):
+        protocol_lengths[row] = len(version['tasks'])
+        expected_matrix[row, :protocol_lengths[row]] = vocabulary.encode_tasks(version['tasks'])
+        optional_matrix[row, vocabulary.encode_tasks(version['optional_tasks'])] = True
+    #the last column is the one of the missing task code -1
+    optional_matrix[:, -1] = False
+
+    #protocol row of every group: the version in effect at its last completion date
+    group_protocol_rows = np.full(n_groups, n_protocol_rows - 1, dtype=np.int64)
+    for session, code in zip(study_sessions_array, study_session_codes):
+        in_session = group_sessions == code
+        if in_session.any():
+            group_protocol_rows[in_session] = first_protocol_row[code] + protocols.version_index(study_to_check, session, max_dates[in_session])
+
+    #optional tasks of the version are dropped before the comparison
+    row_protocol_rows = group_protocol_rows[group_ids]
+    compared = ~optional_matrix[row_protocol_rows, task_codes]
+    compared_count = np.cumsum(compared)
+    compared_before_group = np.concatenate([[0], compared_count])[group_starts[:-1]]
+
+    #position of each compared task inside its session
+    task_position = compared_count - 1 - compared_before_group[group_ids]
+
+    in_range = task_position < protocol_lengths[row_protocol_rows]
+    expected_tasks = expected_matrix[row_protocol_rows, np.clip(task_position, 0, max_length - 1)]
+    task_mismatch = compared & (~in_range | (task_codes != expected_tasks) | (task_codes < 0))
+    flagged_group = np.bincount(group_ids, weights=task_mismatch, minlength=n_groups) > 0
+
+    #session order: the k-th session of a participant has to be the k-th session of the study
+    p_first_group = np.searchsorted(group_p_codes, np.arange(len(participant_ids) + 1))
+    session_rank = np.arange(n_groups) - p_first_group[group_p_codes]
+    rank_in_range = session_rank < len(study_session_codes)
+    expected_sessions = study_session_codes[np.minimum(session_rank, len(study_session_codes) - 1)]
+    session_mismatch = ~rank_in_range | (group_sessions != expected_sessions)
+    flagged_participant = np.bincount(group_p_codes, weights=session_mismatch, minlength=len(participant_ids)) > 0
+
+    #participant ids and sessions that do not match study task sequence order
+    flagged_ps_session = flagged_report(vocabulary)
+
+    #only the flagged participants are expanded, differences are kept as masks of the codes and decoded when the report is written
+    for p_code in np.flatnonzero(flagged_participant | (np.bincount(group_p_codes, weights=flagged_group, minlength=len(participant_ids)) > 0)):
+        p = participant_ids[p_code]
+        study_id = study_ids[p_code]
+        first_group, last_group = p_first_group[p_code], p_first_group[p_code + 1]
+
+        if flagged_participant[p_code]:
+            p_session_codes = group_sessions[first_group:last_group]
+            lenght_p_sessions = len(p_session_codes)
+
+            p_mask = codes_mask(p_session_codes)
+            study_mask = codes_mask(study_session_codes[:lenght_p_sessions])
+            length_diff = lenght_p_sessions - len(study_session_codes[:lenght_p_sessions])
+
+            flagged_ps_session.add(p, study_id, SESSION_ORDER, length_diff, p_mask & ~study_mask, study_mask & ~p_mask, None, study_sessions_array, p_session_codes)
+
+        for g in range(first_group, last_group):
+            if not flagged_group[g]:
+                continue
+            session = vocabulary.session_names[group_sessions[g]]
+            protocol_row = group_protocol_rows[g]
+            p_task_codes = task_codes[group_starts[g]:group_starts[g + 1]]
+            p_compared_codes = p_task_codes[compared[group_starts[g]:group_starts[g + 1]]]
+            length_tasks = len(p_compared_codes)
+            expected = protocol_versions[protocol_row]['tasks'] if protocol_row < len(protocol_versions) else []
+            expected_codes = expected_matrix[protocol_row, :protocol_lengths[protocol_row]]
+
+            p_mask = codes_mask(p_compared_codes)
+            expected_mask = codes_mask(expected_codes[:length_tasks])
+            length_diff = length_tasks - len(expected_codes[:length_tasks])
+
+            flagged_ps_session.add(p, study_id, session, length_diff, p_mask & ~expected_mask, expected_mask & ~p_mask, max_dates[g], expected, p_task_codes)
+
+    return flagged_ps_session, vocabulary
+
+
+def init_step2_worker(protocols, order='rows'):
+    '''
+    Initializer of the step 2 worker processes.
+    '''
+
+    global worker_protocols, worker_order
+    worker_protocols = protocols
+    worker_order = order
+
+
+def check_step2_shard(shard):
+    '''
+    Checks one (study, task log) shard in a worker process.
     '''
+
+    study, taslog_data = shard
+    flagged_ps_session, vocabulary = check_task_log(taslog_data, worker_protocols, study, worker_order)
+
+    return flagged_ps_session
+
+
+def parse_args(argv=None):
+    '''
+    Parameters
+    ----------
+    argv : list, optional
+        command line arguments, sys.argv[1:] by default.
+
     Returns
     -------
     args : TYPE
@@ -608,10 +1503,31 @@ def parse_args():
     parser.add_argument('--password', type=str, default='soniabaee')
     parser.add_argument('--database', type=str, default='calm')
     parser.add_argument('--auth_plugin', type=str, default='mysql_native_password')
+    parser.add_argument('--backend', type=str, choices=['mysql', 'sqlite', 'duckdb'], default='mysql', help= 'sqlite and duckdb run the checks on an embedded database file')
+    parser.add_argument('--backend_path', type=str, default=None, help= 'database file of the sqlite and duckdb backends, default is <output_dir>/calm.<backend>')
+    parser.add_argument('--metrics', type=str, default=None, help= 'JSON lines file of the query and stage records, a summary is printed at the end of the run')
+    parser.add_argument('--csv_dir', type=str, default=None, help= 'CSV dump loaded into the embedded database (e.g. data/1_raw_calm_full), tables already loaded are kept')
 
     # Dataset
-    parser.add_argument('--study', type=str, choices=['TET','GIDI','KAISER','SPANISH'], default='TET')
-    parser.add_argument('--task', type=str, choices=['step1', 'step2', 'step3'], default='step1')
+    parser.add_argument('--study', type=str, choices=['TET','GIDI','KAISER','SPANISH','all'], default='TET', help= 'all checks every study of the task log in step 2')
+    parser.add_argument('--task', type=str, nargs='+', choices=TASKS, default=['step1'], help= 'steps to run, in order and on the same tables: step1 fetches and checks the tables, step2 checks the task order of the task log, step3 reconciles task_log with the questionnaire tables')
+    parser.add_argument('--task_log_csv', type=str, default=None, help= 'CSV export of the task log checked by step 2 instead of the task_log table (e.g. a KAISER export), or its Arrow conversion (see task_log_io), only with --task step2')
+    parser.add_argument('--query_mode', type=str, choices=['per_table', 'batched'], default='per_table', help= 'per_table runs four queries per table, batched runs four queries for all tables')
+    parser.add_argument('--fetch_mode', type=str, choices=['memory', 'stream', 'snapshot'], default='memory', help= 'memory keeps every table in memory, stream writes each table to disk in chunks, snapshot refreshes the local Parquet snapshot')
+    parser.add_argument('--fetch_columns', type=str, choices=['pruned', 'all'], default='all', help= 'all runs select * like before, pruned (opt-in) fetches only the columns the checks need with compact dtypes (the snapshot always keeps every column)')
+    parser.add_argument('--chunksize', type=int, default=50000, help= 'number of rows fetched at a time in stream mode')
+    parser.add_argument('--redact', action='store_true', help= 'redact identifiers and free-text answers while the tables are fetched (every chunk in stream mode), see redaction')
+    parser.add_argument('--redaction_spec', type=str, default=REDACTION_SPEC_FILE, help= 'redaction rules of the tables')
+    parser.add_argument('--spill_dir', type=str, default=None, help= 'directory of the streamed tables, default is <output_dir>/tables')
+    parser.add_argument('--snapshot_dir', type=str, default=None, help= 'directory of the Parquet snapshot, default is <output_dir>/snapshot')
+    parser.add_argument('--offline', action='store_true', help= 'read the tables from the snapshot without connecting to the database')
+    parser.add_argument('--jobs', type=int, default=1, help= 'number of tables fetched at the same time, each with its own pooled connection (at most 32), and number of step 2 worker processes')
+    parser.add_argument('--fetch_executor', type=str, choices=['threads', 'asyncio'], default='threads', help= 'threads fetches the tables in a thread pool with --jobs, asyncio keeps at most --jobs tables in flight from an event loop with --query_timeout')
+    parser.add_argument('--query_timeout', type=float, default=None, help= 'seconds allowed to fetch one table (not its checks), the database aborts longer queries and the table is left out')
+    parser.add_argument('--step2_engine', type=str, choices=['loop', 'groupby'], default='groupby', help= 'loop is the original per participant check, groupby checks all participants in one pass')
+    parser.add_argument('--step2_order', type=str, choices=['rows', 'date_completed'], default='rows', help= 'rows takes the tasks of a participant in the row order of the task log (sorted export), date_completed sorts the task log once by participant and completion date')
+    parser.add_argument('--protocols', type=str, default=PROTOCOLS_FILE, help= 'study protocol file with the date-versioned task order of every session')
+    parser.add_argument('--checkpoint', type=str, default=None, help= 'step 2 checkpoint file, only participants with new task_log rows are checked again')
     
     
     # directory
@@ -628,7 +1544,10 @@ def parse_args():
     # visualization
     parser.add_argument('--visualization', type=bool,  default=False, help= 'if you want to visualize your data')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    #steps 1 and 3 use the tables of the database, step 2 would check another task log than theirs
+    if args.task_log_csv is not None and set(args.task) != {'step2'}:
+        parser.error("--task_log_csv can only be used with --task step2")
     return args
 
 
@@ -639,26 +1558,7 @@ if __name__ == '__main__':
     args = parse_args()
     #-------------------------------------
     data_integrity = data_integrity(args)
-    data_integrity.connect_database()
-    data_integrity.get_data_tables()
-    # study_session_order = data_integrity.study_structure()
-    # flagged_ps_session = data_integrity.step2()
-    # #store flagged information in df
-    # report_df = pd.DataFrame(flagged_ps_session, 
-    #                          columns=["ParticipantID","StudyID", "Session", "PTaskLength", "Diff_P_S",
-    #                                   "Diff_S_P", "Last_Date","SessionOrder", "ParticipantOrder"])
-    
-    # print(report_df.describe())
-    # #Todo; need to integrate this to step2 function and add it as a seperate function
-    # cleaned_report = data_integrity.final_touch_step2(report_df)
-    # #save report to CSV file
-    # cleaned_report.to_csv('{}_{}_DataIntegrityS2_Report.csv'.format(args.study, time.strftime("%Y%m%d")), index=False)
-    
-    duplicated_tasks_taskLog = data_integrity.task_log_and_taskname()
-    
-    
-    
-    
-    
-    
-    
+    data_integrity.run_tasks(args.task)
+
+    print("Summary of the run:")
+    print(data_integrity.instrumentation.summary().to_string(index=False))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content manifest of exported tables and change detection between exports.
+
+Every table of an export directory (the files of raw_export, or a CSV dump
+like ./data/1_raw_calm_full, see backends.csv_dump_files) has an entry in
+the manifest of the directory (export_manifest.json) with its number of
+rows, largest id, largest date_completed/date, a SHA-256 hash of its
+content (the CSV text, uncompressed) and the size and modification time of
+the file, so a file exported again in place gets a new entry. The Parquet
+snapshot of snapshot_cache keeps similar fields in snapshot_manifest.json,
+with a hash of the DataFrame instead of the CSV text.
+
+changed_tables compares two manifests of the same kind (two exports, or two
+snapshots) and tells which tables are new, changed or removed, so the later
+stages can skip the tables that did not change since an earlier export:
+
+    python dump_manifest.py ./data/1_raw_calm_full --since ./data/1_raw_calm_full_04_10_2023
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import argparse
+import pandas as pd
+from collections import OrderedDict
+
+from backends import csv_dump_files
+from snapshot_cache import DATE_COLUMNS, MANIFEST_NAME as SNAPSHOT_MANIFEST_NAME
+
+
+MANIFEST_NAME = 'export_manifest.json'
+
+
+def file_hash(path, block_size=1 << 20):
+    '''
+    SHA-256 of the content of a file, of the uncompressed content for a
+    .gz file, so a table has the same hash gzipped or not.
+    '''
+
+    digest = hashlib.sha256()
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_signature(path):
+    '''
+    Size and modification time of a file, a manifest entry is only reused
+    while they stay the same.
+    '''
+
+    stat = os.stat(path)
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def max_date(dates, previous=None):
+    '''
+    Largest date of a column as a string, compared with the largest date
+    found so far (e.g. in the previous chunks of a table).
+    '''
+
+    dates = pd.to_datetime(dates, errors='coerce')
+    if previous is not None:
+        dates = pd.concat([pd.Series(dates), pd.Series([pd.Timestamp(previous)])])
+
+    return str(dates.max()) if dates.notna().any() else None
+
+
+def table_stats(path, chunksize=50000):
+    '''
+    Manifest entry of a CSV file of a table: rows, largest id, largest date
+    and content hash. The file is read in chunks.
+
+    Parameters
+    ----------
+    path : str
+        CSV file, gzipped or not.
+    chunksize : int, optional
+        rows read at a time.
+
+    Returns
+    -------
+    entry : dict
+
+    '''
+
+    entry = {'file': os.path.basename(path), 'rows': 0, 'last_id': None, 'date_column': None, 'max_date': None}
+    for chunk in pd.read_csv(path, chunksize=chunksize, low_memory=False):
+        entry['rows'] += chunk.shape[0]
+        if 'id' in chunk.columns and chunk['id'].notna().any():
+            chunk_max = chunk['id'].max()
+            entry['last_id'] = chunk_max.item() if entry['last_id'] is None else max(entry['last_id'], chunk_max.item())
+        if entry['date_column'] is None:
+            entry['date_column'] = next((clm for clm in DATE_COLUMNS if clm in chunk.columns), None)
+        if entry['date_column'] is not None:
+            entry['max_date'] = max_date(chunk[entry['date_column']], entry['max_date'])
+    entry['content_hash'] = file_hash(path)
+    entry.update(file_signature(path))
+    entry['done'] = True
+
+    return entry
+
+
+def build_manifest(dump_dir, chunksize=50000):
+    '''
+    Writes the manifest of a dump directory. Tables already in the manifest
+    with a content hash (e.g. exported by raw_export) are kept while their
+    file has the same name, size and modification time, the other files are
+    read to make their entry.
+
+    Parameters
+    ----------
+    dump_dir : str
+        directory of the CSV files.
+    chunksize : int, optional
+        rows read at a time.
+
+    Returns
+    -------
+    manifest : dict
+
+    '''
+
+    manifest_path = os.path.join(dump_dir, MANIFEST_NAME)
+    manifest = {'tables': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    for tbl_name, path in csv_dump_files(dump_dir).items():
+        entry = manifest['tables'].get(tbl_name)
+        #a file exported again in place keeps its name, its size or modification time changes
+        if entry is None or entry.get('content_hash') is None or entry.get('file') != os.path.basename(path) \
+                or any(entry.get(key) != value for key, value in file_signature(path).items()):
+            print("{}: reading {}".format(tbl_name, path))
+            manifest['tables'][tbl_name] = table_stats(path, chunksize)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def read_manifest(location):
+    '''
+    Manifest of an export directory, of a snapshot directory or of a
+    manifest file, as it is written.
+    '''
+
+    manifest = location
+    if not isinstance(location, dict):
+        path = location
+        if os.path.isdir(location):
+            path = os.path.join(location, MANIFEST_NAME)
+            if not os.path.exists(path):
+                path = os.path.join(location, SNAPSHOT_MANIFEST_NAME)
+        with open(path) as f:
+            manifest = json.load(f)
+
+    return manifest
+
+
+def manifest_kind(manifest):
+    #the export manifest keeps the tables under 'tables', the snapshot manifest is only the tables
+    return 'export' if 'tables' in manifest else 'snapshot'
+
+
+def load_manifest(location):
+    '''
+    Table name -> manifest entry of an export directory, of a snapshot
+    directory or of a manifest file.
+
+    Parameters
+    ----------
+    location : str or dict
+        directory, manifest file, or a manifest already loaded.
+
+    Returns
+    -------
+    tables : dict
+
+    '''
+
+    manifest = read_manifest(location)
+
+    return manifest['tables'] if manifest_kind(manifest) == 'export' else manifest
+
+
+def changed_tables(current, since):
+    '''
+    Tables of the current export that are new or changed since an earlier
+    export, and tables of the earlier export that are gone. Tables are
+    compared by content hash, by rows, largest id and largest date when one
+    of the manifests has no hash. Both manifests have to be export manifests
+    or snapshot manifests: the hash of an export is the one of the CSV text
+    and the one of a snapshot the one of the DataFrame, they never match.
+
+    Parameters
+    ----------
+    current : str or dict
+        current export, see load_manifest.
+    since : str or dict
+        earlier export.
+
+    Returns
+    -------
+    changes : OrderedDict
+        table name -> 'new', 'changed' or 'removed', in table name order,
+        unchanged tables are left out.
+
+    Raises
+    ------
+    ValueError
+        an export manifest is compared with a snapshot manifest.
+
+    '''
+
+    current, since = read_manifest(current), read_manifest(since)
+    if manifest_kind(current) != manifest_kind(since):
+        raise ValueError("an {} manifest can not be compared with a {} manifest, their hashes are not of the same content".format(
+            manifest_kind(current), manifest_kind(since)))
+    current = load_manifest(current)
+    since = load_manifest(since)
+
+    changes = OrderedDict()
+    for tbl_name in sorted(set(current) | set(since)):
+        if tbl_name not in since:
+            changes[tbl_name] = 'new'
+        elif tbl_name not in current:
+            changes[tbl_name] = 'removed'
+        else:
+            entry, previous = current[tbl_name], since[tbl_name]
+            if entry.get('content_hash') is not None and previous.get('content_hash') is not None:
+                changed = entry['content_hash'] != previous['content_hash']
+            else:
+                #last_id in export manifests, max_id in snapshot manifests
+                changed = any(entry.get(key) != previous.get(key) for key in ['rows', 'last_id', 'max_id', 'max_date'])
+            if changed:
+                changes[tbl_name] = 'changed'
+
+    return changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manifest of an export directory and tables changed since an earlier export')
+    parser.add_argument('dump_dir', type=str, help= 'directory of the exported CSV files')
+    parser.add_argument('--since', type=str, default=None, help= 'earlier export directory or manifest, the changed tables are printed')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    args = parser.parse_args()
+
+    build_manifest(args.dump_dir, args.chunksize)
+    if args.since is not None:
+        #one table per line, for the cleaning scripts
+        for tbl_name, change in changed_tables(args.dump_dir, args.since).items():
+            print("{}\t{}".format(tbl_name, change))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Column-pruned, dtype-aware fetch of the tables used by the checks.
+
+Each check declares the columns it reads from each table (CHECK_COLUMNS),
+get_data_tables selects only the union of them instead of select * and the
+fetched columns get compact dtypes: categorical session and task names,
+int32 ids and datetime64 dates.
+
+task_log has no participant id, the participantID column step 2 needs is
+joined from participant on study_id, like in the export query of
+MindTrails_DataIntegrity_Step2.py.
+"""
+
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+#check -> table -> columns read by the check, '*' stands for every other table
+CHECK_COLUMNS = OrderedDict([
+    ('step2', {'task_log': ['id', 'study_id', 'participantID', 'date_completed', 'session_name', 'tag', 'task_name'],
+               'study': ['id', 'study_extension']}),
+    ('table_checks', {'study': ['id', 'current_session'],
+                      'task_log': ['study_id', 'session_name'],
+                      'action_log': ['participant_id', 'session_name'],
+                      '*': ['participant_id', 'session']}),
+    ('task_log_and_taskname', {'participant': ['id', 'study_id', 'test_account', 'admin'],
+                               'study': ['id', 'study_extension'],
+                               'task_log': ['study_id', 'session_name', 'task_name'],
+                               '*': ['participant_id', 'session']}),
+    ('reconcile_task_log', {'participant': ['id', 'study_id', 'test_account', 'admin'],
+                            'study': ['id', 'study_extension'],
+                            'task_log': ['study_id', 'session_name', 'task_name'],
+                            '*': ['participant_id', 'session']}),
+    ])
+
+#columns that are not in the table and are joined from another one: column -> (table, its column, join column of both tables)
+JOINED_COLUMNS = {'task_log': {'participantID': ('participant', 'id', 'study_id')}}
+
+#compact dtypes by column name
+CATEGORY_COLUMNS = ['session', 'session_name', 'current_session', 'task_name', 'tag', 'study_extension']
+ID_COLUMNS = ['id', 'study_id', 'participant_id', 'participantID']
+DATE_COLUMNS = ['date', 'date_completed']
+
+
+class fetch_planner:
+    '''
+    Columns and select query of each table.
+
+    Parameters
+    ----------
+    checks : list, optional
+        checks of CHECK_COLUMNS the tables are fetched for, all by default.
+    '''
+
+    def __init__(self, checks=None):
+
+        self.checks = list(CHECK_COLUMNS.keys()) if checks is None else list(checks)
+
+    def columns(self, tbl_name, table_columns):
+        '''
+        Columns of the table needed by the checks, in the order of the table,
+        then the joined ones.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        table_columns : list
+            columns of the table in the database.
+
+        Returns
+        -------
+        columns : list
+        joined : list
+
+        '''
+
+        needed = set()
+        for check in self.checks:
+            check_columns = CHECK_COLUMNS[check]
+            needed.update(check_columns.get(tbl_name, check_columns.get('*', [])))
+
+        columns = [clm for clm in table_columns if clm in needed]
+        joined = [clm for clm in JOINED_COLUMNS.get(tbl_name, {}) if clm in needed and clm not in table_columns]
+
+        return columns, joined
+
+    def query(self, tbl_name, table_columns):
+        '''
+        Select query of the needed columns of the table, select * when the
+        checks need none of its columns (it is still fetched).
+        '''
+
+        columns, joined = self.columns(tbl_name, table_columns)
+        if len(columns) == 0:
+            return "select * from {}".format(tbl_name)
+
+        selects = ["{}.{}".format(tbl_name, clm) for clm in columns]
+        joins = []
+        for clm in joined:
+            join_tbl, join_clm, on_clm = JOINED_COLUMNS[tbl_name][clm]
+            selects.append("{}.{} as {}".format(join_tbl, join_clm, clm))
+            joins.append(" left join {0} on {0}.{2} = {1}.{2}".format(join_tbl, tbl_name, on_clm))
+
+        query = "select {} from {}{}".format(", ".join(selects), tbl_name, "".join(joins))
+        #a join does not keep the row order of the table, step 2 needs the task_log rows in id order
+        if len(joins) > 0 and 'id' in columns:
+            query += " order by {}.id".format(tbl_name)
+
+        return query
+
+
+def compact_dtypes(df):
+    '''
+    Categorical session and task names, int32 ids and datetime64 dates.
+    Columns are converted in place of the DataFrame and it is returned.
+    '''
+
+    for clm in df.columns:
+        if clm in CATEGORY_COLUMNS:
+            df[clm] = df[clm].astype('category')
+        elif clm in ID_COLUMNS and pd.api.types.is_numeric_dtype(df[clm]):
+            values = df[clm]
+            fits = values.shape[0] == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max)
+            if fits:
+                #missing ids need the nullable integer type
+                df[clm] = values.astype('Int32' if values.isna().any() else np.int32)
+        elif clm in DATE_COLUMNS:
+            df[clm] = pd.to_datetime(df[clm], errors='coerce')
+
+    return df
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact report of the participant sessions flagged by step 2.
+
+The step 2 checks used to return one list per flagged row, with arrays of
+the names of the extra and missing tasks, a copy of the expected sequence and
+the tasks of the participant, and final_touch_step2 turned the differences
+into strings. flagged_report keeps the rows as columns of the codes of a
+study_vocabulary:
+
+- the extra and missing tasks (sessions for the SessionOrder rows) as bit
+  masks of their codes, see sequence_index,
+- the expected sequence as an id in a table where every distinct sequence
+  (protocol version, or the sessions of the study) is kept once,
+- the tasks (sessions) of the participant as int16 codes in one flat array,
+  with the offset of every row.
+
+The names are only expanded by to_frame, when the report is written, once
+for every distinct difference and expected sequence. The strings are the
+ones of the CSV of the list report (str of the arrays and lists).
+"""
+
+import numpy as np
+import pandas as pd
+from array import array
+
+from study_encoding import study_vocabulary, decode
+from sequence_index import mask_codes, codes_mask
+
+
+#columns of the step 2 report, the parallel engine adds the study of each row
+STEP2_REPORT_COLUMNS = ["ParticipantID","StudyID", "Session", "PTaskLength", "Diff_P_S",
+                        "Diff_S_P", "Last_Date","SessionOrder", "ParticipantOrder"]
+
+#session of the rows that flag the session order of a participant, their codes are session codes
+SESSION_ORDER = "SessionOrder"
+
+
+class flagged_report:
+    '''
+    Flagged participant sessions of step 2.
+
+    Parameters
+    ----------
+    vocabulary : study_vocabulary, optional
+        codes of the tasks and sessions of the rows, the one of the first
+        report appended if None.
+    '''
+
+    def __init__(self, vocabulary=None):
+
+        self.vocabulary = vocabulary
+
+        self.participants = []
+        self.study_ids = []
+        self.sessions = []
+        self.length_diffs = []
+        self.extra_masks = []
+        self.missing_masks = []
+        self.last_dates = []
+        self.sequence_ids = array('i')
+        #tasks of the participant of row i are observed[observed_offsets[i]:observed_offsets[i + 1]]
+        self.observed = array('h')
+        self.observed_offsets = array('q', [0])
+        #study of every row, only set by the parallel engine
+        self.studies = []
+
+        #distinct expected sequences, a list of tasks or an array of sessions
+        self.sequences = []
+        self.sequence_keys = {}
+
+    def __len__(self):
+        return len(self.participants)
+
+    def sequence_id(self, sequence):
+        '''
+        Id of an expected sequence, the sequence is added to the table the
+        first time it is seen.
+        '''
+
+        #arrays and lists are kept apart, they are not written the same way
+        key = (isinstance(sequence, np.ndarray), tuple(sequence))
+        sequence_id = self.sequence_keys.get(key)
+        if sequence_id is None:
+            sequence_id = self.sequence_keys[key] = len(self.sequences)
+            self.sequences.append(sequence.copy() if isinstance(sequence, np.ndarray) else list(sequence))
+
+        return sequence_id
+
+    def add(self, participant, study_id, session, length_diff, extra_mask, missing_mask, last_date, expected, observed, study=None):
+        '''
+        Appends a flagged row.
+
+        Parameters
+        ----------
+        participant : int
+            participant id.
+        study_id : int
+            study_id of the participant.
+        session : str
+            flagged session, SESSION_ORDER when the order of the sessions of
+            the participant is flagged.
+        length_diff : int
+            number of tasks (sessions) beyond the expected sequence.
+        extra_mask : int
+            mask of the codes done by the participant and not expected.
+        missing_mask : int
+            mask of the codes expected and not done by the participant.
+        last_date : Timestamp or None
+            last completion date of the session.
+        expected : list or array
+            expected tasks of the session, sessions of the study for
+            SESSION_ORDER.
+        observed : array
+            codes of the tasks (sessions) of the participant.
+        study : str, optional
+            study of the row.
+
+        '''
+
+        self.participants.append(participant)
+        self.study_ids.append(study_id)
+        self.sessions.append(session)
+        self.length_diffs.append(length_diff)
+        self.extra_masks.append(extra_mask)
+        self.missing_masks.append(missing_mask)
+        self.last_dates.append(last_date)
+        self.sequence_ids.append(self.sequence_id(expected))
+        self.observed.frombytes(np.asarray(observed, dtype=np.int16).tobytes())
+        self.observed_offsets.append(len(self.observed))
+        self.studies.append(study)
+
+    def extend(self, other, rows=None, study=None):
+        '''
+        Appends rows of another report, with their codes translated to the
+        vocabulary of this report when the vocabularies are not the same.
+
+        Parameters
+        ----------
+        other : flagged_report
+            report of the rows.
+        rows : list, optional
+            positions of the rows in other, all the rows by default.
+        study : str, optional
+            study of the rows, the one of other by default.
+
+        '''
+
+        if self.vocabulary is None:
+            self.vocabulary = other.vocabulary
+        if len(other) == 0:
+            return
+
+        translate = not same_vocabulary(self.vocabulary, other.vocabulary)
+        if translate:
+            #the -1 code of a missing name stays -1 (last element)
+            task_map = np.append(self.vocabulary.encode_tasks(other.vocabulary.task_names), -1)
+            session_map = np.append(self.vocabulary.encode_sessions(other.vocabulary.session_names), -1)
+
+        observed = np.frombuffer(other.observed, dtype=np.int16)
+        for i in (range(len(other)) if rows is None else rows):
+            extra_mask, missing_mask = other.extra_masks[i], other.missing_masks[i]
+            row_observed = observed[other.observed_offsets[i]:other.observed_offsets[i + 1]]
+            if translate:
+                code_map = session_map if other.sessions[i] == SESSION_ORDER else task_map
+                extra_mask = codes_mask(code_map[mask_codes(extra_mask)])
+                missing_mask = codes_mask(code_map[mask_codes(missing_mask)])
+                row_observed = code_map[row_observed]
+            self.add(other.participants[i], other.study_ids[i], other.sessions[i], other.length_diffs[i], extra_mask, missing_mask,
+                     other.last_dates[i], other.sequences[other.sequence_ids[i]], row_observed, other.studies[i] if study is None else study)
+
+    def take(self, rows):
+        '''
+        Report of some rows, e.g. the rows of one participant.
+        '''
+
+        report = flagged_report(self.vocabulary)
+        report.extend(self, rows)
+
+        return report
+
+    @classmethod
+    def concat(cls, reports, studies=None):
+        '''
+        Rows of several reports (e.g. of the shards of the parallel engine),
+        in order. Reports made with different vocabularies are translated to
+        a vocabulary of all their names.
+
+        Parameters
+        ----------
+        reports : list
+            flagged reports.
+        studies : list, optional
+            study of the rows of each report.
+
+        Returns
+        -------
+        report : flagged_report
+
+        '''
+
+        vocabularies = []
+        for report in reports:
+            if report.vocabulary is not None and not any(report.vocabulary is vocabulary for vocabulary in vocabularies):
+                vocabularies.append(report.vocabulary)
+
+        vocabulary = vocabularies[0] if len(vocabularies) > 0 else None
+        if any(not same_vocabulary(vocabulary, other) for other in vocabularies[1:]):
+            vocabulary = study_vocabulary({}, set().union(*[other.task_names for other in vocabularies]),
+                                          set().union(*[other.session_names for other in vocabularies]))
+
+        concatenated = cls(vocabulary)
+        for i, report in enumerate(reports):
+            concatenated.extend(report, study=None if studies is None else studies[i])
+
+        return concatenated
+
+    def to_frame(self):
+        '''
+        Report with the names expanded: the differences, the expected
+        sequences and the tasks of the participants as strings, like
+        astype(str) of the arrays and lists of the list report. Every
+        distinct difference and expected sequence is expanded once.
+
+        Returns
+        -------
+        report_df : DataFrame
+            STEP2_REPORT_COLUMNS, and Study when the rows have a study.
+
+        '''
+
+        vocabulary = self.vocabulary
+        session_rows = [session == SESSION_ORDER for session in self.sessions]
+
+        expanded = {}
+        def expand(session_row, mask):
+            if (session_row, mask) not in expanded:
+                names = vocabulary.session_names if session_row else vocabulary.task_names
+                expanded[(session_row, mask)] = str(decode(names, mask_codes(mask)))
+            return expanded[(session_row, mask)]
+
+        sequence_strings = [str(sequence) for sequence in self.sequences]
+        observed = np.frombuffer(self.observed, dtype=np.int16)
+        offsets = self.observed_offsets
+
+        report_df = pd.DataFrame({"ParticipantID": self.participants,
+                                  "StudyID": self.study_ids,
+                                  "Session": self.sessions,
+                                  "PTaskLength": self.length_diffs,
+                                  "Diff_P_S": [expand(session_row, mask) for session_row, mask in zip(session_rows, self.extra_masks)],
+                                  "Diff_S_P": [expand(session_row, mask) for session_row, mask in zip(session_rows, self.missing_masks)],
+                                  "Last_Date": pd.to_datetime(pd.Series(self.last_dates, dtype=object)),
+                                  "SessionOrder": [sequence_strings[sequence_id] for sequence_id in self.sequence_ids],
+                                  "ParticipantOrder": [str(decode(vocabulary.session_names if session_row else vocabulary.task_names, observed[offsets[i]:offsets[i + 1]]))
+                                                       for i, session_row in enumerate(session_rows)]},
+                                 columns=STEP2_REPORT_COLUMNS)
+
+        if any(study is not None for study in self.studies):
+            report_df["Study"] = self.studies
+
+        return report_df
+
+
+def same_vocabulary(vocabulary, other):
+    '''
+    True if both vocabularies give the same codes to the same names.
+    '''
+
+    if vocabulary is other:
+        return True
+
+    return (vocabulary is not None and other is not None and
+            np.array_equal(vocabulary.task_names, other.task_names) and
+            np.array_equal(vocabulary.session_names, other.session_names))
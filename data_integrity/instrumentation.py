@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing, row count and memory records of the data integrity stages.
+
+Every query run through instrumentation.read_sql is recorded with the hash of
+its text, the table it is about, the rows fetched, the bytes of the
+resulting DataFrame, the wall time split into database time (execute and
+fetch) and pandas time (DataFrame construction), and the peak RSS of the
+process. Whole stages (get_data_tables, step2, ...) are recorded with
+instrumentation.stage. Records are appended to a JSON lines file as they are
+made and summarized per stage and table at the end of the run.
+"""
+
+import json
+import time
+import hashlib
+import threading
+import contextlib
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    '''
+    Peak resident set size of the process in MB, None where the resource
+    module does not exist (Windows).
+    '''
+
+    if resource is None:
+        return None
+
+    #ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def query_hash(query):
+    return hashlib.sha1(query.encode()).hexdigest()[:12]
+
+
+class instrumentation:
+    '''
+    Records of one run.
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON lines file the records are appended to, records are only kept
+        in memory without it.
+    '''
+
+    def __init__(self, path=None):
+
+        self.path = path
+        self.records = []
+        #tables are fetched by several threads
+        self.lock = threading.Lock()
+
+    def record(self, stage, table=None, query=None, rows=None, bytes=None, wall_time=None, db_time=None, pandas_time=None):
+        '''
+        Adds one record and writes it to the JSON lines file.
+        '''
+
+        record = {'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'stage': stage, 'table': table,
+                  'query_hash': query_hash(query) if query is not None else None,
+                  'rows': rows, 'bytes': bytes, 'wall_time': wall_time, 'db_time': db_time, 'pandas_time': pandas_time,
+                  'peak_rss_mb': peak_rss()}
+
+        with self.lock:
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+        return record
+
+    def read_sql(self, query, mydb, stage, table=None, params=None):
+        '''
+        pd.read_sql_query with the database and pandas times recorded.
+
+        Parameters
+        ----------
+        query : str
+            select query.
+        mydb : connection
+            database connection.
+        stage : str
+            stage the query belongs to.
+        table : str, optional
+            table the query is about.
+        params : list, optional
+            query parameters.
+
+        Returns
+        -------
+        df : DataFrame
+
+        '''
+
+        start = time.perf_counter()
+        cursor = mydb.cursor()
+        try:
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        db_time = time.perf_counter() - start
+
+        #same construction as pd.read_sql_query on a DB-API connection
+        df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        pandas_time = time.perf_counter() - start - db_time
+
+        self.record(stage, table=table, query=query, rows=df.shape[0], bytes=int(df.memory_usage(deep=True).sum()),
+                    wall_time=db_time + pandas_time, db_time=db_time, pandas_time=pandas_time)
+
+        return df
+
+    @contextlib.contextmanager
+    def stage(self, stage, table=None):
+        '''
+        Records the wall time of the block as one record of stage.
+        '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, table=table, wall_time=time.perf_counter() - start)
+
+    def summary(self):
+        '''
+        Records summed per stage and table, slowest first.
+
+        Returns
+        -------
+        summary : DataFrame
+
+        '''
+
+        if len(self.records) == 0:
+            return pd.DataFrame()
+
+        records = pd.DataFrame(self.records)
+        records['table'] = records['table'].fillna('')
+        #a value that is never recorded (e.g. the database time of a streamed table) stays empty instead of 0
+        total = lambda values: values.sum(min_count=1)
+        summary = records.groupby(['stage', 'table']).agg(records=('stage', 'size'), queries=('query_hash', 'nunique'),
+                                                          rows=('rows', total), bytes=('bytes', total),
+                                                          wall_time=('wall_time', total), db_time=('db_time', total),
+                                                          pandas_time=('pandas_time', total), peak_rss_mb=('peak_rss_mb', 'max'))
+
+        return summary.sort_values(by='wall_time', ascending=False).reset_index()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index of the eligible participants of every study.
+
+The SQL checks, runSQL.py and the .sql scripts select the non-test,
+non-admin participants of a study_extension with a join of participant and
+study in every query. The pandas checks use the same participants: the
+index is built once per run from the participant and study tables, and keeps
+for every study_extension the sorted ids of its eligible participants and of
+their study_id. Rows of a table (e.g. a task log of millions of rows) are
+then filtered with a binary search in these sorted arrays, instead of
+joining participant and study again.
+"""
+
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from table_store import read_columns
+
+
+def in_sorted(values, sorted_ids):
+    '''
+    Boolean mask of the values found in a sorted id array, missing values
+    are not found.
+
+    Parameters
+    ----------
+    values : Series or array
+        ids to look up (int, nullable int or categorical).
+    sorted_ids : array
+        sorted ids.
+
+    Returns
+    -------
+    found : array of bool
+
+    '''
+
+    #float keeps the missing ids as NaN, ids are far below 2**53
+    values = pd.Series(values).to_numpy(dtype='float64', na_value=np.nan)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(values), dtype=bool)
+
+    positions = np.minimum(np.searchsorted(sorted_ids, values), len(sorted_ids) - 1)
+
+    return sorted_ids[positions] == values
+
+
+class participant_index:
+    '''
+    Eligible (non-test, non-admin) participants of every study.
+
+    Parameters
+    ----------
+    participant : DataFrame
+        participant table with id, study_id, test_account and admin.
+    study : DataFrame
+        study table with id and study_extension.
+    '''
+
+    def __init__(self, participant, study):
+
+        eligible = ((participant.test_account == 0) & (participant.admin == 0)).fillna(False)
+        participant = participant[eligible.astype(bool).values & participant.id.notna().values & participant.study_id.notna().values]
+        study_extension = pd.Series(study['study_extension'].astype(object).values, index=study['id'].values)
+        participant_ids = participant['id'].to_numpy(dtype='int64')
+        study_ids = participant['study_id'].to_numpy(dtype='int64')
+        extensions = study_extension.reindex(study_ids).values
+
+        #participants in id order, their study_id in the same order
+        order = np.argsort(participant_ids, kind='stable')
+        self.participant_ids = OrderedDict()
+        self.participant_study_ids = OrderedDict()
+        self.study_ids = OrderedDict()
+        for extension in sorted(pd.unique(extensions[pd.notna(extensions)])):
+            in_study = order[extensions[order] == extension]
+            self.participant_ids[extension] = participant_ids[in_study]
+            self.participant_study_ids[extension] = study_ids[in_study]
+            self.study_ids[extension] = np.unique(study_ids[in_study])
+
+        #every study, for --study all
+        self.participant_ids['all'] = participant_ids[order]
+        self.participant_study_ids['all'] = study_ids[order]
+        self.study_ids['all'] = np.unique(study_ids)
+
+    @classmethod
+    def from_tables(cls, dataset_dfs):
+        '''
+        Index of the participant and study tables of dataset_dfs (OrderedDict,
+        spilled_tables or snapshot_cache), only the columns it needs are
+        read.
+        '''
+
+        return cls(read_columns(dataset_dfs, 'participant', ['id', 'study_id', 'test_account', 'admin']),
+                   read_columns(dataset_dfs, 'study', ['id', 'study_extension']))
+
+    def studies(self):
+        return [study for study in self.participant_ids.keys() if study != 'all']
+
+    def participants(self, study):
+        '''
+        Sorted ids of the eligible participants of the study, of every
+        study for 'all'. Unknown studies have no participant.
+        '''
+
+        return self.participant_ids.get(study, np.array([], dtype='int64'))
+
+    def study_id_array(self, study):
+        '''
+        Sorted study_id of the eligible participants of the study.
+        '''
+
+        return self.study_ids.get(study, np.array([], dtype='int64'))
+
+    def participant_study(self, study):
+        '''
+        participant id -> study_id of the eligible participants of the
+        study, in participant id order.
+
+        Returns
+        -------
+        participant_study : Series
+
+        '''
+
+        return pd.Series(self.participant_study_ids.get(study, np.array([], dtype='int64')), index=self.participants(study))
+
+    def has_participant(self, participant_ids, study):
+        '''
+        Boolean mask of the participant ids (e.g. participant_id of a
+        questionnaire table) that are eligible participants of the study.
+        '''
+
+        return in_sorted(participant_ids, self.participants(study))
+
+    def has_study_id(self, study_ids, study):
+        '''
+        Boolean mask of the study ids (e.g. study_id of task_log) that
+        belong to eligible participants of the study.
+        '''
+
+        return in_sorted(study_ids, self.study_id_array(study))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel, resumable export of the raw CALM tables.
+
+Replaces the loop of data_cleaning/code/1_get_raw_data.ipynb, which read
+every table in full with one connection and wrote <table>-<date>.csv,
+and had to start again from the first table when it failed.
+
+Tables are exported at the same time, each with its own pooled connection
+(see backends). The rows of a table are read in chunks ordered by id, the
+next chunk starting after the last id of the previous one (keyset
+pagination), and every chunk is appended to <table>-<MM_DD_YYYY>.csv.gz as
+its own gzip member, so the file is a valid gzip file after every chunk.
+A manifest (export_manifest.json) records, after every chunk, the rows,
+the size of the file, the last id and the largest date of each table, and
+the content hash of the table once it is exported (see dump_manifest). When the export runs
+again in the same directory, finished tables are skipped and the other ones
+go on after the last chunk of the manifest (what was written after it is
+cut off). Tables without an id column are read in chunks in one pass and
+exported again from the start.
+
+The files have the same content as the ones of the notebook: the first
+column is the row number of the table (the "X" column of the cleaning
+scripts), then the columns of the table. With a redaction spec (see
+redaction) every chunk is redacted before it is written and the files of the
+redacted tables are named <table>-<MM_DD_YYYY>-redacted.csv.gz, like the ones
+of 3_redact_data.R.
+
+    python raw_export.py --save_dir /Data/CalmThinking-04_10_2023 --jobs 8 --redact
+"""
+
+import os
+import gzip
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import make_backend
+from snapshot_cache import DATE_COLUMNS
+from dump_manifest import MANIFEST_NAME, file_hash, file_signature, max_date
+from redaction import redaction_spec, REDACTION_SPEC_FILE, REDACTED_SUFFIX
+
+#use a special character for spliting the table name from the date
+SPLIT_CHAR = "-"
+
+
+class raw_exporter:
+    '''
+    Export of the tables of a database to a directory.
+
+    Parameters
+    ----------
+    backend : mysql_backend, sqlite_backend or duckdb_backend
+        database the tables are exported from.
+    save_dir : str
+        directory of the files and of the manifest, created if needed.
+    dl_date : str, optional
+        date in the file names (MM_DD_YYYY), today by default. An export
+        that is resumed keeps the date of its manifest.
+    jobs : int, optional
+        number of tables exported at the same time.
+    chunksize : int, optional
+        rows read and written at a time.
+    compression : str, optional
+        gzip, or None for plain CSV files.
+    redaction : redaction_spec, optional
+        redaction applied to every chunk, the raw values are exported
+        without it.
+    '''
+
+    def __init__(self, backend, save_dir, dl_date=None, jobs=4, chunksize=50000, compression='gzip', redaction=None):
+
+        self.backend = backend
+        self.redaction = redaction
+        self.save_dir = save_dir
+        self.jobs = jobs
+        self.chunksize = chunksize
+        self.compression = compression
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        self.manifest_path = os.path.join(save_dir, MANIFEST_NAME)
+        self.manifest = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            print("Resuming the export of {} in {}".format(self.manifest['dl_date'], save_dir))
+        else:
+            self.manifest = {'dl_date': dl_date if dl_date else datetime.today().strftime('%m_%d_%Y'),
+                             'compression': compression, 'redaction': redaction.path if redaction is not None else None,
+                             'tables': {}}
+
+        #the tables already written must not be mixed with tables redacted another way
+        if (self.manifest['redaction'] is None) != (redaction is None):
+            raise ValueError("the export in {} was started {} redaction, resume it the same way".format(
+                save_dir, 'without' if self.manifest['redaction'] is None else 'with'))
+
+        #a resumed export keeps the file names of its manifest
+        self.dl_date = self.manifest['dl_date']
+        self.compression = self.manifest['compression']
+        #the manifest is saved by every worker
+        self.lock = threading.Lock()
+
+    def file_name(self, tbl_name):
+        suffix = REDACTED_SUFFIX if self.redaction is not None and self.redaction.redacts(tbl_name) else ""
+        return tbl_name + SPLIT_CHAR + self.dl_date + suffix + (".csv.gz" if self.compression == 'gzip' else ".csv")
+
+    def save_manifest(self):
+        '''
+        Writes the manifest, through a temporary file so an interrupted
+        write leaves the previous manifest.
+        '''
+
+        with self.lock:
+            tmp_path = self.manifest_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.manifest, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.manifest_path)
+
+    def write_chunk(self, tbl_name, path, entry, chunk):
+        '''
+        Appends one chunk to the file of the table, redacted if the table has
+        redaction rules, and records it in the manifest entry. The header is
+        only written with the first chunk.
+        '''
+
+        if self.redaction is not None:
+            chunk = self.redaction.apply(tbl_name, chunk)
+
+        #row numbers go on from the previous chunk, like the index of the whole table
+        chunk.index = pd.RangeIndex(entry['rows'], entry['rows'] + chunk.shape[0])
+        data = chunk.to_csv(header=(entry['chunks'] == 0)).encode()
+        if self.compression == 'gzip':
+            data = gzip.compress(data)
+
+        with open(path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        entry['rows'] += chunk.shape[0]
+        entry['chunks'] += 1
+        entry['bytes'] = os.path.getsize(path)
+        if chunk.shape[0] > 0 and 'id' in chunk.columns:
+            last_id = chunk['id'].iloc[-1]
+            entry['last_id'] = last_id.item() if isinstance(last_id, np.generic) else last_id
+        if entry['date_column'] is not None and chunk.shape[0] > 0:
+            entry['max_date'] = max_date(chunk[entry['date_column']], entry['max_date'])
+        self.save_manifest()
+
+    def export_table(self, tbl_name, mydb):
+        '''
+        Exports one table, from the last chunk of the manifest if it was
+        interrupted.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        mydb : connection
+            database connection.
+
+        Returns
+        -------
+        entry : dict
+            manifest entry of the table.
+
+        '''
+
+        entry = self.manifest['tables'].get(tbl_name)
+        if entry is not None and entry['done']:
+            print("{} is already exported".format(tbl_name))
+            return entry
+
+        #columns of the table, without fetching any row
+        columns = list(pd.read_sql_query("select * from {} limit 0".format(tbl_name), mydb).columns)
+        keyset = 'id' in columns
+
+        #a table without id can not go on from a chunk, it is exported again
+        if entry is None or not keyset or entry['last_id'] is None:
+            entry = {'file': self.file_name(tbl_name), 'columns': columns, 'rows': 0, 'chunks': 0, 'bytes': 0, 'last_id': None,
+                     'date_column': next((clm for clm in DATE_COLUMNS if clm in columns), None), 'max_date': None,
+                     'done': False, 'started': time.strftime("%Y-%m-%d %H:%M:%S")}
+        else:
+            print("{}: going on after id {}, {} rows already exported".format(tbl_name, entry['last_id'], entry['rows']))
+        self.manifest['tables'][tbl_name] = entry
+
+        #anything written after the last chunk of the manifest is cut off
+        path = os.path.join(self.save_dir, entry['file'])
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.truncate(entry['bytes'])
+
+        if keyset:
+            while True:
+                if entry['last_id'] is None:
+                    chunk = pd.read_sql_query("select * from {} order by id limit %s".format(tbl_name), mydb, params=[self.chunksize])
+                else:
+                    chunk = pd.read_sql_query("select * from {} where id > %s order by id limit %s".format(tbl_name), mydb,
+                                              params=[entry['last_id'], self.chunksize])
+                if chunk.shape[0] == 0:
+                    break
+                self.write_chunk(tbl_name, path, entry, chunk)
+                if chunk.shape[0] < self.chunksize:
+                    break
+        else:
+            for chunk in pd.read_sql_query("select * from {}".format(tbl_name), mydb, chunksize=self.chunksize):
+                self.write_chunk(tbl_name, path, entry, chunk)
+
+        #an empty table still gets a file with the header
+        if entry['chunks'] == 0:
+            self.write_chunk(tbl_name, path, entry, pd.DataFrame(columns=columns))
+
+        #hash of the uncompressed content, the same whatever the chunks and the compression
+        entry['content_hash'] = file_hash(path)
+        #build_manifest reuses the entry while the file keeps this size and modification time
+        entry.update(file_signature(path))
+        entry['done'] = True
+        entry['finished'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.save_manifest()
+        print("{}: {} rows in {} chunks written to {}".format(tbl_name, entry['rows'], entry['chunks'], entry['file']))
+
+        return entry
+
+    def export(self, tbl_names=None):
+        '''
+        Exports the tables, --jobs at a time.
+
+        Parameters
+        ----------
+        tbl_names : list, optional
+            tables to export, every table of the database by default.
+
+        Returns
+        -------
+        manifest : dict
+
+        '''
+
+        mydb = self.backend.connect()
+        if tbl_names is None:
+            ## extract all the tables in this dataset
+            tbl_names = self.backend.list_tables(mydb)
+        self.manifest['table_names'] = list(tbl_names)
+        self.save_manifest()
+
+        if self.jobs > 1:
+            pool = self.backend.connection_pool(self.jobs)
+
+            def export_pooled(tbl_name):
+                #each worker has its own connection, it goes back to the pool when it is closed
+                pooled_db = pool.get_connection()
+                try:
+                    return self.export_table(tbl_name, pooled_db)
+                finally:
+                    pooled_db.close()
+
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                list(executor.map(export_pooled, tbl_names))
+        else:
+            for tbl_name in tbl_names:
+                self.export_table(tbl_name, mydb)
+        mydb.close()
+
+        print("--------------------------------------")
+        print("There should be {} number of tables in {} folder".format(len(tbl_names), self.save_dir))
+        print("--------------------------------------")
+
+        return self.manifest
+
+
+def parse_export_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Parallel, resumable export of the raw CALM tables')
+
+    # server
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--user', type=str, default='root')
+    parser.add_argument('--password', type=str, default='soniabaee')
+    parser.add_argument('--database', type=str, default='calm')
+    parser.add_argument('--auth_plugin', type=str, default='mysql_native_password')
+    parser.add_argument('--backend', type=str, choices=['mysql', 'sqlite', 'duckdb'], default='mysql')
+    parser.add_argument('--backend_path', type=str, default=None, help= 'database file of the sqlite and duckdb backends')
+    parser.add_argument('--csv_dir', type=str, default=None, help= 'CSV dump loaded into the embedded database')
+
+    # export
+    parser.add_argument('--save_dir', type=str, required=True, help= 'directory of the exported files, an export interrupted in this directory is resumed')
+    parser.add_argument('--dl_date', type=str, default=None, help= 'date in the file names (MM_DD_YYYY, the naming of the dump read by the backends), default is today')
+    parser.add_argument('--tables', type=str, nargs='+', default=None, help= 'tables to export, default is every table')
+    parser.add_argument('--jobs', type=int, default=4, help= 'number of tables exported at the same time')
+    parser.add_argument('--chunksize', type=int, default=50000, help= 'number of rows read and written at a time')
+    parser.add_argument('--compression', type=str, choices=['gzip', 'none'], default='gzip')
+    parser.add_argument('--redact', action='store_true', help= 'redact the tables while they are exported, see redaction')
+    parser.add_argument('--redaction_spec', type=str, default=REDACTION_SPEC_FILE, help= 'redaction rules of the tables')
+
+    args = parser.parse_args(argv)
+    #the embedded database file goes next to the export by default
+    args.output_dir = args.save_dir
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_export_args()
+    exporter = raw_exporter(make_backend(args), args.save_dir, dl_date=args.dl_date, jobs=args.jobs,
+                            chunksize=args.chunksize, compression=None if args.compression == 'none' else args.compression,
+                            redaction=redaction_spec(args.redaction_spec) if args.redact else None)
+    exporter.export(args.tables)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reconciliation of task_log with the questionnaire tables.
+
+tables-dataIntegrity.sql, Table-TaskLog-DataIntegrity.sql and runSQL.py
+compare task_log with each questionnaire table with one query per table and
+per check. Here task_log is counted once by (study_id, session_name,
+task_name), every questionnaire table once by (participant_id, session), the
+participants are mapped to their study_id, and both sides are joined in memory
+on (study_id, session, task_name).
+"""
+
+import numpy as np
+import pandas as pd
+
+from participant_index import in_sorted
+
+
+RECONCILIATION_COLUMNS = ['participant_id', 'study_id', 'session', 'task_name', 'table_name',
+                          'in_task_log', 'in_table', 'task_log_count', 'table_count']
+
+
+def questionnaire_task_names(task_names, questionnaire_tables):
+    '''
+    task_name of task_log rows as the key of their questionnaire in
+    questionnaire_tables, None for the other tasks. Names are compared
+    without case, like the MySQL collation of the SQL checks (RR and rr are
+    the same task), every distinct name is looked up once.
+
+    Parameters
+    ----------
+    task_names : Series
+        task_name column of task_log.
+    questionnaire_tables : dict
+        task_name in task_log -> table name.
+
+    Returns
+    -------
+    task_names : Series
+
+    '''
+
+    keys = {task_name.lower(): task_name for task_name in questionnaire_tables}
+    names = {name: keys.get(name.lower()) if isinstance(name, str) else None for name in pd.unique(task_names)}
+
+    return task_names.astype(object).map(names)
+
+
+def reconcile(task_log, participant_study, tables, questionnaire_tables):
+    '''
+    (participant, session, task) matrix of task_log and the questionnaire
+    tables.
+
+    Parameters
+    ----------
+    task_log : DataFrame
+        task log with study_id, session_name and task_name.
+    participant_study : Series
+        participant id -> study_id of the participants to reconcile.
+    tables : dict
+        table name -> DataFrame with participant_id and session.
+    questionnaire_tables : dict
+        task_name in task_log -> table name.
+
+    Returns
+    -------
+    matrix : DataFrame
+        one row per (participant, session, task) found in task_log or in the
+        table of the task, with in_task_log, in_table and the number of rows
+        on each side.
+
+    '''
+
+    #study_id -> participant, the first participant of a study_id
+    study_participant = pd.Series(participant_study.index, index=participant_study.values)
+    study_participant = study_participant[~study_participant.index.duplicated()]
+
+    #binary search in the sorted ids instead of a hash set of every id
+    participant_ids = np.unique(participant_study.index.values)
+    study_ids = np.unique(participant_study.values)
+
+    #task names are matched without case, like the SQL checks on MySQL
+    task_log = task_log.assign(task_name=questionnaire_task_names(task_log.task_name, questionnaire_tables).values)
+    task_log = task_log[in_sorted(task_log.study_id, study_ids) & task_log.task_name.notna().values]
+    task_log_count = task_log.groupby(['study_id', 'session_name', 'task_name'], observed=True).size().rename('task_log_count').reset_index()
+    task_log_count = task_log_count.rename(columns={'session_name': 'session'})
+
+    table_counts = []
+    for task_name, tbl_name in questionnaire_tables.items():
+        if tbl_name not in tables:
+            continue
+        table_data = tables[tbl_name]
+        table_data = table_data[in_sorted(table_data.participant_id, participant_ids)]
+        table_count = table_data.assign(study_id=table_data.participant_id.map(participant_study).values).groupby(['study_id', 'session'], observed=True).size()
+        table_count = table_count.rename('table_count').reset_index()
+        table_count['task_name'] = task_name
+        table_counts.append(table_count)
+
+    if len(table_counts) > 0:
+        table_count = pd.concat(table_counts, ignore_index=True)
+    else:
+        table_count = pd.DataFrame(columns=['study_id', 'session', 'table_count', 'task_name'])
+
+    #hash join of both sides, a task missing on one side gets a 0 count
+    matrix = task_log_count.merge(table_count, on=['study_id', 'session', 'task_name'], how='outer')
+    matrix[['task_log_count', 'table_count']] = matrix[['task_log_count', 'table_count']].fillna(0).astype(int)
+    matrix['participant_id'] = matrix['study_id'].map(study_participant).astype('Int64')
+    matrix['table_name'] = matrix['task_name'].map(questionnaire_tables)
+    matrix['in_task_log'] = matrix['task_log_count'] > 0
+    matrix['in_table'] = matrix['table_count'] > 0
+
+    matrix = matrix[RECONCILIATION_COLUMNS].sort_values(by=['participant_id', 'session', 'task_name'], kind='stable')
+
+    return matrix.reset_index(drop=True)
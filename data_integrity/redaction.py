@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Redaction of the tables while they are extracted.
+
+data_cleaning/code/3_redact_data.R reads the whole raw dump again and
+writes the redacted tables. The same redaction is declared in
+redaction_spec.json, one list of rules per table, and applied by the
+extraction itself (raw_export, get_data_tables) to every chunk before it is
+written, so the raw values are never written to disk:
+
+- columns: the values of the columns are replaced, except missing values and
+  the kept values ("", "N/A", "555" by default, like redact_columns in
+  3_redact_data.R),
+- where: the column is replaced in the rows where every other column has the
+  given value (button_pressed of the FillInBlank trials of
+  angular_training), in every row if a condition column was not extracted,
+- replace: the first match of a regular expression is replaced in the values
+  (the order ids in the error messages of import_log),
+- match: values that contain every given string are replaced by a value
+  (the phone numbers in the exceptions of sms_log).
+
+Rules on columns that are not extracted (e.g. with the pruned fetch) are
+skipped.
+"""
+
+import os
+import re
+import json
+import pandas as pd
+from collections import OrderedDict
+
+
+REDACTION_SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'redaction_spec.json')
+
+#suffix of the files of the redacted tables, as written by 3_redact_data.R
+REDACTED_SUFFIX = "-redacted"
+
+
+class redaction_spec:
+    '''
+    Redaction rules of the tables.
+
+    Parameters
+    ----------
+    path : str, optional
+        redaction spec, redaction_spec.json next to this module by default.
+    '''
+
+    def __init__(self, path=REDACTION_SPEC_FILE):
+
+        with open(path) as f:
+            spec = json.load(f, object_pairs_hook=OrderedDict)
+
+        self.path = path
+        self.redacted_value = spec['redacted_value']
+        self.kept_values = list(spec.get('kept_values', []))
+        self.rules = spec['tables']
+        #the patterns are compiled once for all the chunks
+        self.patterns = {id(rule): re.compile(rule['pattern']) for rules in self.rules.values() for rule in rules if rule['rule'] == 'replace'}
+
+    def tables(self):
+        return list(self.rules.keys())
+
+    def redacts(self, tbl_name):
+        return tbl_name in self.rules
+
+    def apply(self, tbl_name, df):
+        '''
+        Redacts one table or one chunk of a table.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        df : DataFrame
+            rows of the table.
+
+        Returns
+        -------
+        df : DataFrame
+            a redacted copy, df itself if the table has no rule.
+
+        '''
+
+        if tbl_name not in self.rules or df.shape[0] == 0:
+            return df
+
+        df = df.copy()
+        for rule in self.rules[tbl_name]:
+            columns = rule['columns'] if rule['rule'] == 'columns' else [rule['column']]
+            for clm in columns:
+                if clm not in df.columns:
+                    continue
+                values = df[clm]
+
+                if rule['rule'] == 'columns':
+                    kept_values = rule.get('kept_values', self.kept_values)
+                    redacted = values.notna() & ~values.astype(str).isin(kept_values)
+                    #a numeric column keeps the numbers of the kept values (555.0 is 555, like in R)
+                    if pd.api.types.is_numeric_dtype(values):
+                        redacted &= ~values.isin(pd.to_numeric(pd.Series(kept_values), errors='coerce').dropna())
+                    new_values = self.redacted_value
+                elif rule['rule'] == 'where':
+                    #without the condition columns every row is redacted
+                    redacted = pd.Series(True, index=df.index)
+                    for where_clm, where_value in rule['where'].items():
+                        if where_clm in df.columns:
+                            redacted &= (df[where_clm] == where_value).fillna(False)
+                    new_values = self.redacted_value
+                elif rule['rule'] == 'replace':
+                    redacted = values.notna()
+                    new_values = values[redacted].astype(str).str.replace(self.patterns[id(rule)], rule['replacement'], n=1, regex=True)
+                elif rule['rule'] == 'match':
+                    redacted = values.notna()
+                    for text in rule['contains']:
+                        redacted &= values.astype(str).str.contains(text, regex=False)
+                    new_values = rule['value']
+                else:
+                    raise ValueError("unknown redaction rule {} for {}".format(rule['rule'], tbl_name))
+
+                if redacted.any():
+                    if pd.api.types.is_numeric_dtype(values):
+                        #a numeric column (e.g. phone) becomes a text column, like in R, 555.0 is written 555
+                        numbers = values.dropna()
+                        if pd.api.types.is_float_dtype(numbers) and (numbers % 1 == 0).all():
+                            numbers = numbers.astype('int64')
+                        values = values.astype(object)
+                        values[numbers.index] = numbers.astype(str)
+                    else:
+                        values = values.astype(object)
+                    values[redacted] = new_values
+                    df[clm] = values
+
+        return df
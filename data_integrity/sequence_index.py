@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Expected task sequences of the study protocols compiled for the step 2 check.
+
+Every (study, session, protocol version) is compiled once into a chain
+automaton over the task codes of a study_vocabulary: state k means the first
+k compared tasks of the participant match the protocol, the only transition
+out of k is the k-th expected task, and the optional tasks of the version
+loop on every state. Checking an ordered task list is then one walk over its
+codes that stops at the first divergence, without slicing the expected
+sequence or building difference arrays.
+
+The extra and missing tasks of a diverging session are computed from bit
+masks of the task codes: the mask of every prefix of the expected sequence is
+precomputed, so they are the set differences of two integers. Bit k + 1
+stands for code k (bit 0 for the missing code -1), so reading the bits in
+increasing order gives the tasks sorted like np.setdiff1d returns them.
+"""
+
+from collections import OrderedDict
+
+
+class compiled_sequence:
+    '''
+    Chain automaton of one protocol version.
+
+    Parameters
+    ----------
+    tasks : list
+        expected tasks of the version.
+    optional_tasks : list
+        tasks that are skipped by the walk.
+    vocabulary : study_vocabulary
+        codes of the tasks.
+    '''
+
+    __slots__ = ('tasks', 'expected', 'optional', 'prefix_masks')
+
+    def __init__(self, tasks, optional_tasks, vocabulary):
+
+        self.tasks = list(tasks)
+        self.expected = tuple(vocabulary.encode_tasks(self.tasks).tolist())
+        self.optional = frozenset(vocabulary.encode_tasks(optional_tasks).tolist())
+
+        #prefix_masks[k] is the mask of the first k expected tasks
+        self.prefix_masks = [0]
+        for code in self.expected:
+            self.prefix_masks.append(self.prefix_masks[-1] | (1 << (code + 1)))
+
+    def __len__(self):
+        return len(self.expected)
+
+    def walk(self, codes):
+        '''
+        Runs the automaton on the ordered task codes of a participant session.
+
+        Parameters
+        ----------
+        codes : list
+            task codes in completion order.
+
+        Returns
+        -------
+        divergence : int
+            index in codes of the first task that does not follow the
+            protocol, -1 if the session follows it.
+
+        '''
+
+        expected = self.expected
+        optional = self.optional
+        n_expected = len(expected)
+        state = 0
+
+        for i, code in enumerate(codes):
+            if code in optional:
+                continue
+            if state == n_expected or code != expected[state]:
+                return i
+            state += 1
+
+        return -1
+
+    def difference_masks(self, codes):
+        '''
+        Differences between the compared tasks of a participant session and
+        the same number of expected tasks, as in step2, as bit masks of the
+        codes (see mask_codes).
+
+        Parameters
+        ----------
+        codes : list
+            task codes in completion order.
+
+        Returns
+        -------
+        length_diff : int
+            number of compared tasks beyond the expected sequence.
+        extra : int
+            mask of the codes done by the participant and not expected.
+        missing : int
+            mask of the codes expected and not done by the participant.
+
+        '''
+
+        mask = 0
+        n_compared = 0
+        for code in codes:
+            if code not in self.optional:
+                mask |= 1 << (code + 1)
+                n_compared += 1
+
+        prefix_mask = self.prefix_masks[min(n_compared, len(self.expected))]
+
+        return n_compared - min(n_compared, len(self.expected)), mask & ~prefix_mask, prefix_mask & ~mask
+
+
+def mask_codes(mask):
+    '''
+    Codes of the bits set in mask, in increasing order.
+    '''
+
+    codes = []
+    while mask:
+        low_bit = mask & -mask
+        codes.append(low_bit.bit_length() - 2)
+        mask ^= low_bit
+
+    return codes
+
+
+def codes_mask(codes):
+    '''
+    Mask of codes, the inverse of mask_codes.
+    '''
+
+    mask = 0
+    for code in codes:
+        mask |= 1 << (int(code) + 1)
+
+    return mask
+
+
+class sequence_index:
+    '''
+    Compiled sequences of every (study, session, protocol version).
+
+    Parameters
+    ----------
+    protocols : protocol_registry
+        date-versioned study protocols.
+    vocabulary : study_vocabulary
+        codes of the tasks, it has to contain every task of the protocols.
+    '''
+
+    def __init__(self, protocols, vocabulary):
+
+        self.protocols = protocols
+        self.vocabulary = vocabulary
+
+        #study -> session -> list of compiled versions, in the order of the registry
+        self.sequences = OrderedDict()
+        for study in protocols.studies():
+            self.sequences[study] = OrderedDict()
+            for session in protocols.sessions(study):
+                self.sequences[study][session] = [compiled_sequence(version['tasks'], version['optional_tasks'], vocabulary)
+                                                  for version in protocols.versions(study, session)]
+
+        #sequence of the sessions that are not in the protocol of the study
+        self.empty = compiled_sequence([], [], vocabulary)
+
+    def sequence(self, study, session, date):
+        '''
+        Compiled sequence of the version of a session in effect at date. A
+        session that is not in the protocol of the study (e.g. a TET
+        PostFollowUp2) expects no task, so every task of it is flagged like
+        in check_task_log.
+        '''
+
+        if session not in self.sequences[study]:
+            return self.empty
+
+        return self.sequences[study][session][self.protocols.version_index(study, session, [date])[0]]
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local columnar snapshot of the CALM database.
+
+Each table is stored as <snapshot_dir>/<table>.parquet and a manifest
+(snapshot_manifest.json) keeps, for each table, the rows, the largest id,
+the largest date_completed/date and a hash of the content of the snapshot
+(see dump_manifest.changed_tables). A refresh only fetches the rows
+whose id or date is newer than the manifest and merges them into the
+snapshot; tables without an id column are fetched again in full.
+
+Parquet files are written with pyarrow.
+"""
+
+import os
+import json
+import time
+import hashlib
+import pandas as pd
+from collections.abc import Mapping
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+#columns used to find the rows changed since the last snapshot, in order of preference
+DATE_COLUMNS = ['date_completed', 'date']
+
+MANIFEST_NAME = 'snapshot_manifest.json'
+
+
+def frame_hash(df):
+    '''
+    SHA-256 of the columns and rows of a DataFrame, whatever the file it is
+    stored in.
+    '''
+
+    digest = hashlib.sha256(json.dumps([str(clm) for clm in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+    return digest.hexdigest()
+
+
+class snapshot_cache(Mapping):
+    '''
+    Read-only mapping of table name to DataFrame backed by the Parquet files
+    of the snapshot.
+
+    Parameters
+    ----------
+    snapshot_dir : str
+        directory of the Parquet files and of the manifest.
+    tbl_names : list, optional
+        tables seen through the mapping, all the tables of the snapshot by
+        default.
+    redaction : redaction_spec, optional
+        redaction applied to the rows fetched before they are written.
+    '''
+
+    def __init__(self, snapshot_dir, tbl_names=None, redaction=None):
+
+        if pyarrow is None:
+            raise ImportError("the snapshot cache needs pyarrow, install it with 'pip install pyarrow'")
+
+        self.snapshot_dir = snapshot_dir
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+
+        self.manifest_path = os.path.join(snapshot_dir, MANIFEST_NAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+        #tables seen through the mapping, all the tables of the snapshot by default
+        self.tbl_names = tbl_names
+        self.redaction = redaction
+
+    def save_manifest(self):
+        '''
+        Writes the manifest next to the Parquet files.
+        '''
+
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+    def refresh_table(self, tbl_name, mydb):
+        '''
+        Brings the snapshot of one table up to date with the database.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        mydb : connection
+            database connection.
+
+        Returns
+        -------
+        n_rows : int
+            number of rows fetched from the database.
+
+        '''
+
+        path = os.path.join(self.snapshot_dir, tbl_name + '.parquet')
+        entry = self.manifest.get(tbl_name)
+
+        #columns of the table, without fetching any row
+        columns = list(pd.read_sql_query("select * from {} limit 0".format(tbl_name), mydb).columns)
+        date_clm = next((clm for clm in DATE_COLUMNS if clm in columns), None)
+
+        redacted = self.redaction is not None and self.redaction.redacts(tbl_name)
+
+        #a snapshot redacted another way is fetched again in full
+        incremental = entry is not None and os.path.exists(path) and 'id' in columns and entry.get('max_id') is not None \
+            and entry.get('redacted', False) == redacted
+        if incremental:
+            #only rows added (new id) or changed (new date) since the last snapshot
+            query = "select * from {} where id > %s".format(tbl_name)
+            params = [entry['max_id']]
+            if date_clm is not None and entry.get('max_date') is not None:
+                query += " or {} > %s".format(date_clm)
+                params.append(entry['max_date'])
+            new_rows = pd.read_sql_query(query, mydb, params=params)
+            if redacted:
+                new_rows = self.redaction.apply(tbl_name, new_rows)
+
+            df = pd.read_parquet(path)
+            if new_rows.shape[0] > 0:
+                #updated rows replace their old version, rows stay in id order like in the database
+                df = pd.concat([df, new_rows], ignore_index=True)
+                df = df.drop_duplicates(subset='id', keep='last')
+                df = df.sort_values(by='id', kind='stable').reset_index(drop=True)
+        else:
+            new_rows = pd.read_sql_query("select * from {}".format(tbl_name), mydb)
+            if redacted:
+                new_rows = self.redaction.apply(tbl_name, new_rows)
+            df = new_rows
+
+        if not incremental or new_rows.shape[0] > 0:
+            df.to_parquet(path, index=False)
+
+        self.manifest[tbl_name] = {
+            'file': os.path.basename(path),
+            'rows': int(df.shape[0]),
+            'columns': list(df.columns),
+            'max_id': int(df['id'].max()) if 'id' in df.columns and df.shape[0] > 0 else None,
+            'date_column': date_clm,
+            'max_date': str(df[date_clm].max()) if date_clm is not None and df[date_clm].notna().any() else None,
+            'content_hash': frame_hash(df) if not incremental or new_rows.shape[0] > 0 else entry.get('content_hash'),
+            'redacted': redacted,
+            'refreshed': time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+
+        return new_rows.shape[0]
+
+    def refresh(self, tbl_names, mydb):
+        '''
+        Refreshes several tables and saves the manifest.
+
+        Parameters
+        ----------
+        tbl_names : list
+            names of the tables.
+        mydb : connection
+            database connection.
+
+        Returns
+        -------
+        fetched_rows : dict
+            number of rows fetched for each table.
+
+        '''
+
+        fetched_rows = {}
+        for tbl_name in tbl_names:
+            fetched_rows[tbl_name] = self.refresh_table(tbl_name, mydb)
+            print("{}: {} rows fetched, {} rows in the snapshot".format(tbl_name, fetched_rows[tbl_name], self.manifest[tbl_name]['rows']))
+            #the manifest is saved after each table so an interrupted refresh keeps what is done
+            self.save_manifest()
+
+        return fetched_rows
+
+    @property
+    def table_columns(self):
+        return {tbl_name: self.manifest[tbl_name]['columns'] for tbl_name in self}
+
+    def read(self, tbl_name, columns=None):
+        '''
+        Reads a table from the snapshot, optionally only some columns.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        columns : list, optional
+            columns to read, all columns by default.
+
+        Returns
+        -------
+        df : DataFrame
+
+        '''
+
+        return pd.read_parquet(os.path.join(self.snapshot_dir, self.manifest[tbl_name]['file']), columns=columns)
+
+    def __getitem__(self, tbl_name):
+        return self.read(tbl_name)
+
+    def __iter__(self):
+        if self.tbl_names is None:
+            return iter(self.manifest)
+        return iter([tbl_name for tbl_name in self.tbl_names if tbl_name in self.manifest])
+
+    def __len__(self):
+        return len(list(iter(self)))
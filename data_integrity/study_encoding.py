@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Integer codes for the task and session names of the step 2 check.
+
+The vocabularies are the sorted names of the study structures plus the names
+found in the task log, so the code order is the same as the string order and
+a sorted array of codes decodes to a sorted array of names (what
+np.setdiff1d returns on the strings). Codes are int8 when the vocabulary has
+less than 128 names and int16 otherwise, -1 stands for a missing name.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def code_dtype(n_names):
+    '''
+    Smallest signed integer type for n_names codes plus the -1 code.
+    '''
+
+    return np.int8 if n_names < np.iinfo(np.int8).max else np.int16
+
+
+class study_vocabulary:
+    '''
+    Task and session vocabularies of the study structures.
+
+    Parameters
+    ----------
+    study_session_order : dict
+        study -> session -> list of tasks, as built by study_structure.
+    tasks : iterable, optional
+        task names found in the task log that may not be in any structure.
+    sessions : iterable, optional
+        session names found in the task log that may not be in any structure.
+    '''
+
+    def __init__(self, study_session_order, tasks=(), sessions=()):
+
+        task_names = set(tasks)
+        session_names = set(sessions)
+        for session_order in study_session_order.values():
+            for session, session_tasks in session_order.items():
+                session_names.add(session)
+                task_names.update(session_tasks)
+
+        #missing values are not names, they get the -1 code
+        self.task_names = np.array(sorted(t for t in task_names if isinstance(t, str)), dtype=object)
+        self.session_names = np.array(sorted(s for s in session_names if isinstance(s, str)), dtype=object)
+        self.task_dtype = code_dtype(len(self.task_names))
+        self.session_dtype = code_dtype(len(self.session_names))
+
+        #expected sequences of every study as code arrays
+        self.task_codes = {}
+        self.session_codes = {}
+        for study, session_order in study_session_order.items():
+            self.session_codes[study] = self.encode_sessions(list(session_order.keys()))
+            self.task_codes[study] = {session: self.encode_tasks(session_tasks) for session, session_tasks in session_order.items()}
+
+    @classmethod
+    def from_task_log(cls, study_session_order, task_log):
+        '''
+        Vocabulary of the study structures and of the tasks (tag + task_name)
+        and sessions of a task log.
+        '''
+
+        return cls(study_session_order, distinct_tasks(task_log), task_log["session_name"].unique())
+
+    def encode_tasks(self, tasks):
+        return pd.Categorical(tasks, categories=self.task_names).codes.astype(self.task_dtype)
+
+    def encode_sessions(self, sessions):
+        return pd.Categorical(sessions, categories=self.session_names).codes.astype(self.session_dtype)
+
+    def decode_tasks(self, codes):
+        return decode(self.task_names, codes)
+
+    def decode_sessions(self, codes):
+        return decode(self.session_names, codes)
+
+
+def decode(names, codes):
+    '''
+    Names of an array of codes, None for -1.
+    '''
+
+    codes = np.asarray(codes, dtype=np.int64)
+    decoded = np.empty(len(codes), dtype=object)
+    decoded[:] = names[np.maximum(codes, 0)] if len(names) > 0 else None
+    decoded[codes < 0] = None
+
+    return decoded
+
+
+def encode_task_column(task_log, vocabulary):
+    '''
+    Task codes of a task log without building the tag + task_name strings for
+    every row: the (tag, task_name) pairs are factorized first and only the
+    distinct pairs are combined and encoded.
+
+    Parameters
+    ----------
+    task_log : DataFrame
+        task log with tag and task_name columns.
+    vocabulary : study_vocabulary
+
+    Returns
+    -------
+    codes : ndarray
+        task code of every row.
+
+    '''
+
+    #tag and task_name can be categorical columns, missing tags are only replaced in the distinct pairs
+    pair_codes, pairs = pd.MultiIndex.from_arrays([task_log["tag"], task_log["task_name"]]).factorize()
+    pair_tasks = [(tag if isinstance(tag, str) else '') + task_name if isinstance(task_name, str) else np.nan for tag, task_name in pairs]
+    pair_task_codes = vocabulary.encode_tasks(pair_tasks)
+
+    codes = pair_task_codes[pair_codes]
+    codes[pair_codes < 0] = -1
+
+    return codes
+
+
+def distinct_tasks(task_log):
+    '''
+    Distinct tag + task_name values of a task log, computed on the distinct
+    (tag, task_name) pairs.
+    '''
+
+    pairs = task_log[["tag", "task_name"]].drop_duplicates().astype(object)
+
+    return (pairs["tag"].fillna('') + pairs["task_name"]).unique()
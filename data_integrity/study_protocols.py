@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of the study protocols used by the step 2 check.
+
+The expected task sequence of every session of every study is read from
+study_protocols.json. A session has one or more versions, each with the date
+it took effect (null for the start of the study), its ordered tasks and,
+optionally, tasks that participants may have done anywhere in the session and
+that are not compared (e.g. the OA that was part of the TET preTest until
+5/12/2020). The version of a participant session is the last one that took
+effect on or before the last completion date of the session.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+PROTOCOLS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'study_protocols.json')
+
+
+class protocol_registry:
+    '''
+    Date-versioned study protocols.
+
+    Parameters
+    ----------
+    path : str, optional
+        protocol file, study_protocols.json next to this module by default.
+    '''
+
+    def __init__(self, path=PROTOCOLS_FILE):
+
+        with open(path) as f:
+            protocols = json.load(f, object_pairs_hook=OrderedDict)
+
+        #study -> session -> list of versions ordered by date
+        self.protocols = OrderedDict()
+        for study, protocol in protocols.items():
+            self.protocols[study] = OrderedDict()
+            for session, versions in protocol['sessions'].items():
+                #an optional task that is also an expected task of the version is compared
+                versions = [{'effective_from': pd.Timestamp(version['effective_from']) if version.get('effective_from') else None,
+                             'tasks': list(version['tasks']),
+                             'optional_tasks': [task for task in version.get('optional_tasks', []) if task not in version['tasks']]}
+                            for version in versions]
+                versions.sort(key=lambda version: version['effective_from'] or pd.Timestamp.min)
+                self.protocols[study][session] = versions
+
+    def studies(self):
+        return list(self.protocols.keys())
+
+    def sessions(self, study):
+        return list(self.protocols[study].keys())
+
+    def versions(self, study, session):
+        return self.protocols[study][session]
+
+    def structure(self, study=None):
+        '''
+        Latest task sequence of every session, in the study -> session ->
+        list of tasks layout of study_structure.
+        '''
+
+        studies = self.studies() if study is None else [study]
+
+        return OrderedDict((s, OrderedDict((session, versions[-1]['tasks']) for session, versions in self.protocols[s].items()))
+                           for s in studies)
+
+    def all_tasks(self):
+        '''
+        Every task of every version, optional tasks included.
+        '''
+
+        return set(task for sessions in self.protocols.values() for versions in sessions.values()
+                   for version in versions for task in version['tasks'] + version['optional_tasks'])
+
+    def version_index(self, study, session, dates):
+        '''
+        Index of the version in effect at each date, the latest version for
+        missing dates.
+
+        Parameters
+        ----------
+        study : str
+        session : str
+        dates : array-like
+            last completion date of each participant session.
+
+        Returns
+        -------
+        index : ndarray
+
+        '''
+
+        versions = self.protocols[study][session]
+        dates = pd.to_datetime(pd.Series(dates), errors='coerce').values.astype('datetime64[ns]')
+        starts = np.array([version['effective_from'] or pd.Timestamp.min for version in versions], dtype='datetime64[ns]')
+
+        index = np.searchsorted(starts, dates, side='right') - 1
+        index = np.clip(index, 0, len(versions) - 1)
+        index[pd.isna(dates)] = len(versions) - 1
+
+        return index
+
+    def version(self, study, session, date):
+        '''
+        Version of one session in effect at date.
+        '''
+
+        return self.protocols[study][session][self.version_index(study, session, [date])[0]]
+
+    def fingerprint(self, study):
+        '''
+        Text that changes when the protocol of a study changes.
+        '''
+
+        return repr([(session, [(str(version['effective_from']), version['tasks'], version['optional_tasks']) for version in versions])
+                     for session, versions in self.protocols[study].items()])
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tables extracted from the database in chunks and spilled to disk.
+
+The rows of each table are fetched with a streaming cursor and appended to a
+CSV file one chunk at a time, so at most one chunk of a table is in memory
+while it is extracted. The tables are read back from disk only when they are
+used.
+"""
+
+import os
+import pandas as pd
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+class spilled_tables(Mapping):
+    '''
+    Read-only mapping of table name to DataFrame, like the dataset_dfs
+    OrderedDict, where each table lives in a CSV file in spill_dir and is
+    loaded on access.
+
+    Parameters
+    ----------
+    spill_dir : str
+        directory of the CSV files.
+    converter : function, optional
+        applied to every DataFrame read back (e.g. compact dtypes).
+    '''
+
+    def __init__(self, spill_dir, converter=None):
+
+        self.spill_dir = spill_dir
+        self.converter = converter
+        if not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+        self.table_files = OrderedDict()
+        self.table_columns = OrderedDict()
+        self.table_rows = OrderedDict()
+
+    def spill(self, tbl_name, query, mydb, chunksize, params=None, transform=None):
+        '''
+        Streams the result of query to <spill_dir>/<tbl_name>.csv in chunks
+        of chunksize rows.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        query : str
+            select query of the table.
+        mydb : connection
+            database connection, its default cursor must not buffer the
+            whole result set (mysql.connector cursors are unbuffered).
+        chunksize : int
+            number of rows fetched and written at a time.
+        params : list, optional
+            query parameters.
+        transform : function, optional
+            applied to every chunk before it is written (e.g. redaction).
+
+        Returns
+        -------
+        n_rows : int
+            number of rows written.
+
+        '''
+
+        path = os.path.join(self.spill_dir, tbl_name + ".csv")
+        n_rows = 0
+        columns = None
+
+        for chunk in pd.read_sql_query(query, mydb, params=params, chunksize=chunksize):
+            if transform is not None:
+                chunk = transform(chunk)
+            #first chunk creates the file with the header, the others are appended
+            chunk.to_csv(path, mode='w' if columns is None else 'a', header=(columns is None), index=False)
+            n_rows += chunk.shape[0]
+            columns = list(chunk.columns)
+
+        #no chunk at all, leave an empty file instead of a file from an earlier run
+        if columns is None:
+            columns = []
+            open(path, 'w').close()
+
+        self.table_files[tbl_name] = path
+        self.table_columns[tbl_name] = columns
+        self.table_rows[tbl_name] = n_rows
+
+        return n_rows
+
+    def reorder(self, tbl_names):
+        '''
+        Puts the tables in the order of tbl_names, tables spilled by several
+        threads are registered in the order they finish.
+
+        Parameters
+        ----------
+        tbl_names : list
+            names of the tables.
+
+        '''
+
+        self.table_files = OrderedDict((tbl_name, self.table_files[tbl_name]) for tbl_name in tbl_names)
+        self.table_columns = OrderedDict((tbl_name, self.table_columns[tbl_name]) for tbl_name in tbl_names)
+        self.table_rows = OrderedDict((tbl_name, self.table_rows[tbl_name]) for tbl_name in tbl_names)
+
+    def read(self, tbl_name, columns=None, chunksize=None):
+        '''
+        Reads a spilled table, optionally only some columns or as an
+        iterator of chunks.
+
+        Parameters
+        ----------
+        tbl_name : str
+            name of the table.
+        columns : list, optional
+            columns to read, all columns by default.
+        chunksize : int, optional
+            if given, returns an iterator of DataFrames.
+
+        Returns
+        -------
+        df : DataFrame or TextFileReader
+
+        '''
+
+        if len(self.table_columns[tbl_name]) == 0:
+            return pd.DataFrame(columns=columns)
+
+        df = pd.read_csv(self.table_files[tbl_name], usecols=columns, chunksize=chunksize, low_memory=False)
+        if self.converter is None:
+            return df
+        if chunksize is not None:
+            return (self.converter(chunk) for chunk in df)
+
+        return self.converter(df)
+
+    def __getitem__(self, tbl_name):
+        return self.read(tbl_name)
+
+    def __iter__(self):
+        return iter(self.table_files)
+
+    def __len__(self):
+        return len(self.table_files)
+
+
+def read_columns(dataset_dfs, tbl_name, columns):
+    '''
+    Some columns of a table of dataset_dfs. Spilled and snapshot tables only
+    read those columns from disk, in-memory tables are sliced.
+
+    Parameters
+    ----------
+    dataset_dfs : OrderedDict, spilled_tables or snapshot_cache
+        tables extracted from the database.
+    tbl_name : str
+        name of the table.
+    columns : list
+        columns to read.
+
+    Returns
+    -------
+    df : DataFrame
+
+    '''
+
+    if hasattr(dataset_dfs, 'read'):
+        return dataset_dfs.read(tbl_name, columns=columns)
+
+    return dataset_dfs[tbl_name][columns]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task log exports read by step 2.
+
+A task log export is the CSV written by the export queries of
+MindTrails_DataIntegrity_Step2.py. Reading the CSV parses every column on
+every run, so it can be converted once to an uncompressed Arrow IPC (Feather
+v2) file:
+
+    python task_log_io.py "KAISER-TaskLog-data-2021-04-21 18_03_27.csv"
+
+The Arrow file is memory-mapped when it is read, only the columns step 2
+uses are selected (without copying the others) and only their pages are
+read from disk.
+
+Arrow files are read and written with pyarrow.
+"""
+
+import os
+import argparse
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
+
+#columns of the task log used by step 2
+TASK_LOG_COLUMNS = ["study_id", "participantID", "date_completed", "session_name", "tag", "task_name"]
+
+ARROW_EXTENSIONS = ('.arrow', '.feather')
+
+
+def is_arrow_file(path):
+    return os.path.splitext(path)[1].lower() in ARROW_EXTENSIONS
+
+
+def read_task_log(path, columns=TASK_LOG_COLUMNS):
+    '''
+    Reads the columns of a task log export, from an Arrow/Feather file
+    (memory-mapped) or from a CSV file. Columns missing from the export are
+    not read.
+
+    Parameters
+    ----------
+    path : str
+        .arrow or .feather file, CSV file otherwise.
+    columns : list, optional
+        columns to read, the ones step 2 uses by default.
+
+    Returns
+    -------
+    task_log : DataFrame
+        with date_completed as datetime64.
+
+    '''
+
+    if is_arrow_file(path):
+        if pyarrow is None:
+            raise ImportError("Arrow task logs need pyarrow, install it with 'pip install pyarrow'")
+        #the schema is read without the data, then only the selected columns are mapped
+        with pyarrow.memory_map(path) as source:
+            schema = pyarrow.ipc.open_file(source).schema
+        table = pyarrow.feather.read_table(path, columns=[clm for clm in columns if clm in schema.names], memory_map=True)
+        task_log = table.to_pandas()
+    else:
+        task_log = pd.read_csv(path, usecols=lambda clm: clm in columns, low_memory=False)
+        task_log = task_log[[clm for clm in columns if clm in task_log.columns]]
+
+    if 'date_completed' in task_log.columns:
+        task_log['date_completed'] = pd.to_datetime(task_log['date_completed'])
+
+    return task_log
+
+
+def csv_to_arrow(csv_path, arrow_path=None):
+    '''
+    Converts a task log CSV export to an uncompressed Arrow IPC file that
+    can be memory-mapped. Every column is kept.
+
+    Parameters
+    ----------
+    csv_path : str
+        CSV file.
+    arrow_path : str, optional
+        Arrow file, the CSV file with the .arrow extension by default.
+
+    Returns
+    -------
+    arrow_path : str
+
+    '''
+
+    if pyarrow is None:
+        raise ImportError("Arrow task logs need pyarrow, install it with 'pip install pyarrow'")
+
+    if arrow_path is None:
+        arrow_path = os.path.splitext(csv_path)[0] + '.arrow'
+
+    #tag is empty for most rows, it is read as a string column even if the first rows have no tag
+    #and empty strings are missing values, like with pd.read_csv
+    column_types = {clm: pyarrow.string() for clm in ['session_name', 'tag', 'task_name', 'study_extension']}
+    convert_options = pyarrow.csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+    table = pyarrow.csv.read_csv(csv_path, convert_options=convert_options)
+
+    #a compressed file would have to be decompressed in memory instead of mapped
+    pyarrow.feather.write_feather(table, arrow_path, compression='uncompressed')
+    print("{} rows written to {}".format(table.num_rows, arrow_path))
+
+    return arrow_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a task log CSV export to a memory-mappable Arrow file')
+    parser.add_argument('csv', type=str, help= 'task log CSV export')
+    parser.add_argument('--output', type=str, default=None, help= 'Arrow file, default is the CSV file with the .arrow extension')
+    args = parser.parse_args()
+
+    csv_to_arrow(args.csv, args.output)
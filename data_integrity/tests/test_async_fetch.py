@@ -0,0 +1,81 @@
+import os
+import time
+import sqlite3
+import threading
+import pytest
+import pandas as pd
+
+from async_fetch import fetch_in_order
+from data_integration import data_integrity, parse_args
+
+
+#never ends on its own
+ENDLESS_QUERY = "with recursive r(x) as (select 1 union all select x + 1 from r) select count(*) from r"
+
+
+def test_results_in_order():
+    results = fetch_in_order(lambda i: time.sleep(0.05 * (5 - i)) or i, range(5), 3)
+
+    assert results == list(range(5))
+
+
+def test_hung_thread_is_not_waited_for():
+    release = threading.Event()
+    start = time.time()
+
+    results = fetch_in_order(lambda i: release.wait() if i == 1 else i, [0, 1, 2], 2, timeout=0.5)
+    release.set()
+
+    assert time.time() - start < 5
+    assert results[0] == 0 and results[2] == 2
+    assert isinstance(results[1], TimeoutError)
+
+
+def test_hung_query_is_interrupted(tmp_path):
+    path = os.path.join(str(tmp_path), 'calm.sqlite')
+    sqlite3.connect(path).close()
+    connections = {}
+
+    def query(i):
+        connections[i] = sqlite3.connect(path, check_same_thread=False)
+        #stops the endless query after 20 seconds if it is not interrupted, so the test fails instead of hanging
+        connections[i].set_progress_handler(lambda: time.time() > start + 20, 10000)
+        return pd.read_sql_query(ENDLESS_QUERY if i == 1 else "select {} as i".format(i), connections[i]).iloc[0, 0]
+
+    interrupted = []
+    def interrupt(i):
+        interrupted.append(i)
+        connections[i].interrupt()
+
+    start = time.time()
+    results = fetch_in_order(query, [0, 1, 2], 2, timeout=0.5, on_timeout=interrupt)
+
+    assert time.time() - start < 5
+    assert results[0] == 0 and results[2] == 2
+    assert isinstance(results[1], TimeoutError)
+    assert interrupted == [1]
+
+
+def test_duckdb_fetch_timeout(tmp_path):
+    duckdb = pytest.importorskip('duckdb')
+    path = os.path.join(str(tmp_path), 'calm.duckdb')
+    connection = duckdb.connect(path)
+    connection.execute("create table study as select range as id from range(5)")
+    connection.execute("create table task_log as select range as id from range(10)")
+    #a table whose select runs for hours
+    connection.execute("create view slow as select count(*) as n from range(1000000000000) a")
+    connection.close()
+
+    integrity = data_integrity(parse_args(['--study', 'all', '--backend', 'duckdb', '--backend_path', path, '--output_dir', str(tmp_path),
+                                           '--jobs', '2', '--fetch_executor', 'asyncio', '--query_timeout', '1']))
+    integrity.connect_database()
+    start = time.time()
+    dataset_dfs = integrity.get_data_tables()
+
+    assert time.time() - start < 30
+    assert list(dataset_dfs.keys()) == ['study', 'task_log']
+    assert list(integrity.failed_tables) == ['slow']
+    #the query of slow is interrupted, its thread ends
+    while len(integrity.fetch_connections) > 0 and time.time() - start < 30:
+        time.sleep(0.1)
+    assert integrity.fetch_connections == {}
@@ -0,0 +1,34 @@
+import os
+import argparse
+import pandas as pd
+
+from backends import make_backend, csv_dump_files
+
+
+def backend_args(output_dir, backend='sqlite', csv_dir=None):
+    return argparse.Namespace(backend=backend, backend_path=None, output_dir=output_dir, csv_dir=csv_dir, chunksize=1000)
+
+
+def test_database_in_missing_output_dir(tmp_path):
+    output_dir = os.path.join(str(tmp_path), 'w', 'out')
+    backend = make_backend(backend_args(output_dir))
+
+    mydb = backend.connect()
+    pd.DataFrame({'id': [1, 2]}).to_sql('study', mydb, index=False)
+
+    assert backend.list_tables(mydb) == ['study']
+    assert os.path.exists(os.path.join(output_dir, 'calm.sqlite'))
+    mydb.close()
+
+
+def test_csv_dump_files_latest_date(tmp_path):
+    for file_name in ['task_log-12_01_2022.csv', 'task_log-01_15_2023.csv', 'task_log-01_15_2023-redacted.csv',
+                      'study-04_10_2023-redacted.csv', 'study-03_11_2023.csv', 'notes.txt']:
+        open(os.path.join(str(tmp_path), file_name), 'w').close()
+
+    files = csv_dump_files(str(tmp_path))
+
+    #MM_DD_YYYY dates, not the lexical order of the names, and the raw file at the same date
+    assert {tbl_name: os.path.basename(path) for tbl_name, path in files.items()} == \
+        {'study': 'study-04_10_2023-redacted.csv', 'task_log': 'task_log-01_15_2023.csv'}
+    assert list(files) == ['study', 'task_log']
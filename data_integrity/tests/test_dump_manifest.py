@@ -0,0 +1,35 @@
+import os
+import copy
+import pytest
+import pandas as pd
+
+from dump_manifest import build_manifest, changed_tables
+
+
+def write_table(dump_dir, file_name, df, mtime):
+    path = os.path.join(dump_dir, file_name)
+    df.to_csv(path, index=False)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_dump_overwritten_in_place(tmp_path):
+    dump_dir = str(tmp_path)
+    write_table(dump_dir, 'study-04_10_2023.csv', pd.DataFrame({'id': [1, 2], 'current_session': ['preTest', 'firstSession']}), 10**18)
+    write_table(dump_dir, 'task_log-04_10_2023.csv', pd.DataFrame({'id': [1], 'session_name': ['preTest']}), 10**18)
+    earlier = copy.deepcopy(build_manifest(dump_dir))
+
+    #the study table is exported again under the same name, with the same size
+    write_table(dump_dir, 'study-04_10_2023.csv', pd.DataFrame({'id': [1, 2], 'current_session': ['preTest', 'thirdSession']}), 2 * 10**18)
+    current = build_manifest(dump_dir)
+
+    assert current['tables']['study']['content_hash'] != earlier['tables']['study']['content_hash']
+    assert changed_tables(current, earlier) == {'study': 'changed'}
+
+
+def test_export_and_snapshot_manifests_are_not_compared(tmp_path):
+    export = {'tables': {'study': {'rows': 2, 'last_id': 2, 'content_hash': 'a'}}}
+    snapshot = {'study': {'rows': 2, 'max_id': 2, 'content_hash': 'b'}}
+
+    with pytest.raises(ValueError):
+        changed_tables(export, snapshot)
+    assert changed_tables(snapshot, dict(snapshot)) == {}
@@ -0,0 +1,91 @@
+import pandas as pd
+import pytest
+from collections import OrderedDict
+
+from data_integration import data_integrity, parse_args
+
+
+FIRST_SESSION = ["preAffect", "1", "postAffect", "CC", "SessionReview", "OA", "CoachPrompt", "ReturnIntention"]
+
+
+def integrity(tmp_path, *argv):
+    checker = data_integrity(parse_args(['--study', 'TET', '--output_dir', str(tmp_path)] + list(argv)))
+    checker.study_structure()
+    return checker
+
+
+def task_log(sessions):
+    '''
+    Task log of participants, sessions is a list of (participant, session,
+    date, tasks).
+    '''
+
+    rows = []
+    for participant, session, date, tasks in sessions:
+        for i, task in enumerate(tasks):
+            tag, task_name = {'preAffect': ('pre', 'Affect'), 'postAffect': ('post', 'Affect')}.get(task, (None, task))
+            rows.append({'id': len(rows) + 1, 'study_id': participant + 1000, 'participantID': participant,
+                         'date_completed': pd.Timestamp(date) + pd.Timedelta(minutes=i),
+                         'session_name': session, 'tag': tag, 'task_name': task_name})
+
+    return pd.DataFrame(rows)
+
+
+PRETEST = ["Credibility", "Demographics", "MentalHealthHistory", "AnxietyIdentity", "AnxietyTriggers",
+           "recognitionRatings", "RR", "BBSIQ", "Comorbid", "Wellness", "Mechanisms", "Covid19", "TechnologyUse"]
+
+
+def run_engine(checker, engine, log):
+    checker.dataset_dfs = OrderedDict(task_log=log.copy())
+    if engine == 'loop':
+        report = checker.step2()
+    else:
+        report = checker.step2_groupby()
+    return report.to_frame()
+
+
+@pytest.mark.parametrize('engine', ['loop', 'groupby'])
+def test_gidi_optional_before_it_is_required(tmp_path, engine):
+    checker = integrity(tmp_path)
+    with_gidi = FIRST_SESSION[:7] + ["Gidi"] + FIRST_SESSION[7:]
+    log = task_log([(1, 'preTest', '2020-07-15', PRETEST), (1, 'firstSession', '2020-07-20', with_gidi),
+                    (2, 'preTest', '2020-07-15', PRETEST), (2, 'firstSession', '2020-07-21', FIRST_SESSION),
+                    #Gidi is required from 2020-08-10
+                    (3, 'preTest', '2020-08-15', PRETEST), (3, 'firstSession', '2020-08-20', FIRST_SESSION)])
+
+    report = run_engine(checker, engine, log)
+
+    assert list(zip(report.ParticipantID, report.Session)) == [(3, 'firstSession')]
+    assert report.Diff_S_P.tolist() == ["['Gidi']"]
+
+
+def test_off_protocol_session_loop_engine(tmp_path):
+    checker = integrity(tmp_path)
+    log = task_log([(1, 'preTest', '2020-07-15', PRETEST), (1, 'firstSession', '2020-07-20', FIRST_SESSION),
+                    (1, 'PostFollowUp2', '2020-09-20', ["AnxietyIdentity", "OA"])])
+
+    loop_report = run_engine(checker, 'loop', log)
+    groupby_report = run_engine(checker, 'groupby', log)
+
+    flagged = loop_report[loop_report.Session == 'PostFollowUp2']
+    assert len(flagged) == 1
+    assert flagged.Diff_P_S.iloc[0] == "['AnxietyIdentity' 'OA']"
+    pd.testing.assert_frame_equal(loop_report, groupby_report)
+
+
+def test_incremental_when_eligibility_changes(tmp_path):
+    checkpoint = str(tmp_path / 'step2.pkl')
+    log = task_log([(1, 'preTest', '2020-07-15', PRETEST), (1, 'firstSession', '2020-07-20', FIRST_SESSION[:3]),
+                    (2, 'preTest', '2020-07-15', PRETEST[1:]), (2, 'firstSession', '2020-07-21', FIRST_SESSION),
+                    (3, 'preTest', '2020-07-16', PRETEST[2:])])
+    #participant 3 is a test account in the first run, participant 2 becomes one in the second run
+    first_run = log[log.participantID != 3]
+    second_run = log[log.participantID != 2]
+
+    checker = integrity(tmp_path, '--checkpoint', checkpoint)
+    checker.step2_incremental(first_run.copy())
+    incremental = checker.step2_incremental(second_run.copy()).to_frame()
+
+    full = run_engine(integrity(tmp_path), 'groupby', second_run)
+    assert sorted(set(incremental.ParticipantID)) == [3]
+    pd.testing.assert_frame_equal(incremental, full)